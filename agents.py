@@ -2,7 +2,24 @@ from agno.agent import Agent
 from agno.tools import tool
 from agno.models.google import Gemini
 from agno.models.groq import Groq
+from agno.run.response import RunEvent
 import os
+import json
+from nutrition import compute_nutrition
+from instrumentation import instrument_agent
+from llm_cache import cache_agent
+from utils import normalize_dish_name
+
+
+def stream_agent_content(agent, message):
+    """Runs an agent in streaming mode and yields the response text as it arrives."""
+    for event in agent.run(message, stream=True):
+        # Tool call events also carry `content`; only the model's text is part of the answer
+        if getattr(event, "event", None) not in (RunEvent.run_response_content, RunEvent.run_response_content.value):
+            continue
+        if isinstance(event.content, str) and event.content:
+            yield event.content
+
 
 # -----------------------------
 # Nutrition Agent
@@ -18,58 +35,7 @@ def calculate_nutrition(
     diet: str = "",
 ) -> dict:
     """Science-based nutrition report."""
-    if gender.lower().startswith("m"):
-        bmr = 10 * weight + 6.25 * height - 5 * age + 5
-    else:
-        bmr = 10 * weight + 6.25 * height - 5 * age - 161
-
-    activity = activity.lower()
-    if "sedentary" in activity:
-        factor = 1.2
-    elif "light" in activity:
-        factor = 1.375
-    elif "moderate" in activity:
-        factor = 1.55
-    elif "very" in activity:
-        factor = 1.725
-    elif "extra" in activity or "athlete" in activity:
-        factor = 1.9
-    else:
-        factor = 1.55
-
-    tdee = bmr * factor
-    goal = goal.lower()
-    if "loss" in goal:
-        calories = tdee * 0.85
-    elif "gain" in goal:
-        calories = tdee * 1.15
-    else:
-        calories = tdee
-
-    protein_g = weight * 2
-    protein_cal = protein_g * 4
-    fat_cal = calories * 0.25
-    fat_g = fat_cal / 9
-    carbs_cal = calories - (protein_cal + fat_cal)
-    carbs_g = carbs_cal / 4
-
-    vitamins = []
-    if "vegetarian" in diet.lower() or "vegan" in diet.lower():
-        vitamins += ["Vitamin B12", "Iron", "Omega-3"]
-    if gender.lower().startswith("f"):
-        vitamins.append("Iron")
-    vitamins.append("Vitamin D")
-
-    return {
-        "calories": round(calories),
-        "protein_g": round(protein_g),
-        "carbs_g": round(carbs_g),
-        "fat_g": round(fat_g),
-        "vitamins": list(set(vitamins)),
-        "analysis": f"Based on {age}y, {weight}kg, {height}cm, {activity}, and goal '{goal}', "
-        f"daily needs are {round(calories)} kcal with "
-        f"{round(protein_g)}g protein, {round(carbs_g)}g carbs, and {round(fat_g)}g fat.",
-    }
+    return compute_nutrition(age, gender, weight, height, activity, goal, diet)
 
 
 nutrition_agent = Agent(
@@ -146,6 +112,37 @@ When composing numbers, prefer integers for grams and calories. Use clear string
 """,
 )
 
+# -------------------------
+# Nutrition Prose Agent
+# -------------------------
+nutrition_prose_agent = Agent(
+    name="Nutrition Writer",
+    role="Write the explanatory parts of a nutrition report whose numbers were already computed.",
+    tools=[],
+    model=Gemini(id="gemini-2.0-flash"),
+    instructions="""
+You are a professional registered nutritionist.
+You will receive a JSON object with a user's profile, their computed daily targets, the micronutrients to focus on and the foods they must avoid.
+The numbers are final: do not recompute or change them.
+
+Return a SINGLE valid JSON object (no markdown, no extra text) with exactly these keys:
+{
+  "human_summary": "3-4 concise sentences: the daily calories, protein, carbs and fat they need, the advantages of their diet type, and that their likes and budget are taken care of",
+  "micronutrients": [
+    {"name": "Vitamin D", "reason": "deficiency risk because ...", "recommendation": "400-1000 IU/day or consult GP"}
+  ],
+  "substitutions": {
+    "egg": ["silken_tofu (equivalent in baking 1 egg = 1/4 cup)"]
+  }
+}
+
+Give one `micronutrients` entry for every micronutrient in the input, using the same name.
+Give `substitutions` only for the foods the user must avoid; use an empty object if there are none.
+Do not add anything the user did not ask for (e.g. only mention the cuisines they chose).
+""",
+)
+
+
 # -------------------------
 # Meal Planner Agent
 # -------------------------
@@ -244,6 +241,46 @@ For example:
 """,
 )
 
+# -------------------------
+# Batch Recipe Generator Agent
+# -------------------------
+recipe_batch_agent = Agent(
+    name="Batch Recipe Generator",
+    role="Generate detailed step-by-step recipe instructions for several meals in one response.",
+    tools=[],
+    model=Gemini(id="gemini-2.0-flash", api_key=os.getenv("GEMINI_API_KEY")),
+    instructions="""
+You are a professional chef and recipe generator.
+You will receive a JSON object whose keys are dish names and whose values describe the meal.
+Your task is to generate one recipe for EVERY dish in the input.
+Each recipe must be a single, step-by-step guide. Do not list the ingredients separately at the start. Instead, introduce each ingredient with its quantity directly within the instruction step where it is first used.
+Please also state the total prep and cook time for each recipe.
+
+Return a single JSON object with exactly the same keys as the input, spelled exactly as in the input, each mapping to the recipe for that dish.
+Do not add any text before or after the JSON object.
+
+For example:
+{
+  "Paneer Paratha with Yogurt": {
+    "prep_time": "20 minutes",
+    "cook_time": "15 minutes",
+    "steps": {
+      "step-1": "To make the dough, combine 2 cups of whole wheat flour...",
+      "step-2": "For the filling, crumble 1.5 cups of paneer..."
+    }
+  },
+  "Dal Tadka": {
+    "prep_time": "10 minutes",
+    "cook_time": "30 minutes",
+    "steps": {
+      "step-1": "Rinse 1 cup of toor dal...",
+      "step-2": "..."
+    }
+  }
+}
+""",
+)
+
 # -------------------------
 # Shopping List Agent
 # -------------------------
@@ -342,4 +379,96 @@ whatsapp_agent = Agent(
 
 ✨ Hey Darsh! 🌟 Lunch is served: hearty lentil soup with brown rice & spinach—38% protein, 37% calories, iron‑packed goodness. Dive in and power up! 🚀 
     """]
-)
\ No newline at end of file
+)
+
+# -------------------------
+# Batch WhatsApp Teaser Agent
+# -------------------------
+teaser_batch_agent = Agent(
+    model=Groq(
+        id="openai/gpt-oss-120b", api_key=os.getenv("GROQ_API_KEY")
+    ),
+    description="You are a creative nutrition assistant. Write short, tempting messages to encourage users to enjoy their healthy meals",
+    instructions=["""You will receive a JSON object with the user's name and a "meals" object whose keys are meal ids and whose values describe one meal (meal name and dish).
+Write one very short, exciting and tempting (<25 words) WhatsApp notification for EVERY meal, addressed to the user, that makes them look forward to eating that dish.
+Return a single JSON object with exactly the same keys as "meals", spelled exactly as in the input, each mapping to its notification text.
+Do not add any text before or after the JSON object.
+
+For example:
+{
+  "Day 1|Lunch": "✨ Hey Darsh! 🌟 Lunch is served: hearty lentil soup with brown rice & spinach—iron-packed goodness. Dive in and power up! 🚀"
+}
+"""]
+)
+
+
+# -------------------------
+# Instrumentation
+# -------------------------
+# Every model call is timed and counted under the agent's name (see instrumentation.py)
+for _name, _agent in {
+    "nutrition_agent": nutrition_agent,
+    "nutrition_prose_agent": nutrition_prose_agent,
+    "meal_agent": meal_agent,
+    "recipe_agent": recipe_agent,
+    "recipe_batch_agent": recipe_batch_agent,
+    "shopping_agent": shopping_agent,
+    "price_agent": price_agent,
+    "whatsapp_agent": whatsapp_agent,
+    "teaser_batch_agent": teaser_batch_agent,
+}.items():
+    instrument_agent(_agent, _name)
+
+
+# -------------------------
+# Response cache
+# -------------------------
+# Identical requests are answered from LLM_Cache (see llm_cache.py). The WhatsApp
+# agents are left out on purpose so notifications keep some variety.
+DAY = 24 * 3600
+
+
+def _is_recipe(value, message=None):
+    return isinstance(value, dict) and isinstance(value.get("steps"), dict) and bool(value["steps"])
+
+
+def _is_recipe_batch(recipes, message):
+    # Every requested dish has a recipe, so an empty or partial batch is never cached
+    try:
+        requested = json.loads(message)
+    except (TypeError, ValueError):
+        return False
+    returned = {normalize_dish_name(dish): recipe for dish, recipe in recipes.items()}
+    return isinstance(requested, dict) and bool(requested) and all(
+        _is_recipe(returned.get(normalize_dish_name(dish))) for dish in requested
+    )
+
+
+def _is_meal_plan(plan, message=None):
+    # Every day holds meals with a dish, so a single day or meal is never cached as a plan
+    days = [meals for day, meals in plan.items() if day.lower().startswith("day")]
+    return bool(days) and all(
+        isinstance(meals, dict) and any(isinstance(m, dict) and m.get("dish_name") for m in meals.values())
+        for meals in days
+    )
+
+
+def _is_shopping_list(value, message=None):
+    return bool(value) and all(isinstance(items, list) for items in value.values())
+
+
+def _is_price_list(value, message=None):
+    return any(isinstance(details, dict) and isinstance(details.get("items"), list) for details in value.values())
+
+
+for _name, _agent, _ttl, _validate in [
+    ("nutrition_agent", nutrition_agent, 30 * DAY, None),
+    ("nutrition_prose_agent", nutrition_prose_agent, 30 * DAY, None),
+    ("meal_agent", meal_agent, 7 * DAY, _is_meal_plan),
+    ("recipe_agent", recipe_agent, 30 * DAY, _is_recipe),
+    ("recipe_batch_agent", recipe_batch_agent, 30 * DAY, _is_recipe_batch),
+    ("shopping_agent", shopping_agent, 30 * DAY, _is_shopping_list),
+    # Prices drift, so they are only reused for a day
+    ("price_agent", price_agent, 1 * DAY, _is_price_list),
+]:
+    cache_agent(_agent, _name, ttl_seconds=_ttl, validate=_validate)
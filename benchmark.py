@@ -0,0 +1,562 @@
+import os
+import io
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import resource
+import tempfile
+import threading
+import contextvars
+import subprocess
+import tracemalloc
+from contextlib import redirect_stdout
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from pymongo import monitoring
+
+# Never run against the real database: the app modules below connect on import
+os.environ["MONGO_URI"] = os.getenv("BENCHMARK_MONGO_URI", "mongomock://localhost")
+os.environ["MONGO_DB"] = os.getenv("BENCHMARK_MONGO_DB", "MealPlannerBenchmark")
+
+# Stage the current thread is running; DB round-trips are counted per stage
+_stage = contextvars.ContextVar("benchmark_stage", default="setup")
+_round_trips = {}
+_round_trips_lock = threading.Lock()
+
+
+def _count_round_trip():
+    stage = _stage.get()
+    with _round_trips_lock:
+        _round_trips[stage] = _round_trips.get(stage, 0) + 1
+
+
+class _RoundTripListener(monitoring.CommandListener):
+    """Counts every command sent to a real MongoDB server."""
+
+    def started(self, event):
+        _count_round_trip()
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+# Must be registered before database.py creates its client
+monitoring.register(_RoundTripListener())
+
+from PIL import Image  # noqa: E402
+from agno.run.response import RunEvent  # noqa: E402
+import agents  # noqa: E402
+import dish_images  # noqa: E402
+from database import client, db, user_collection, nutrition_collection, price_catalog_collection, ensure_indexes  # noqa: E402
+from instrumentation import instrument_agent, instrumented, metrics  # noqa: E402
+from llm_cache import cache_agent, get_llm_cache_stats  # noqa: E402
+from main import (  # noqa: E402
+    generate_meal_plan_pipeline,
+    generate_recipes_pipeline,
+    generate_shopping_list_pipeline,
+    price_prediction_pipeline,
+)
+from nutrition import build_report_base, MEAL_SLOT_SPLITS  # noqa: E402
+from pricing import canonical_ingredient, load_price_catalog  # noqa: E402
+from upload_images import upload_images_and_get_urls, LocalUploader  # noqa: E402
+from charts import generate_and_save_all_charts  # noqa: E402
+
+STAGES = ["meal_plan", "recipes", "shopping_list", "pricing", "upload", "charts"]
+# Seconds per call before --latency-scale; see parse_latency for the formats
+DEFAULT_LATENCIES = {
+    "meal_agent": "lognormal:6:0.3",
+    "recipe_batch_agent": "lognormal:10:0.3",
+    "recipe_agent": "lognormal:3:0.3",
+    "shopping_agent": "lognormal:4:0.3",
+    "price_agent": "lognormal:3:0.3",
+    "teaser_batch_agent": "lognormal:2:0.3",
+    "dish_image": "lognormal:5:0.4",
+}
+STREAM_CHUNK_CHARS = 200
+# Share of the total latency spent before the first streamed chunk
+TIME_TO_FIRST_CHUNK = 0.3
+RESULTS_DIR = "benchmark_results"
+
+DISHES = [
+    "Paneer Paratha with Yogurt", "Dal Tadka with Jeera Rice", "Vegetable Poha", "Chana Masala with Roti",
+    "Palak Paneer with Brown Rice", "Masala Oats", "Rajma Chawal", "Vegetable Upma", "Moong Dal Chilla",
+    "Aloo Gobi with Phulka", "Vegetable Biryani", "Idli with Sambar", "Masala Dosa", "Besan Chilla",
+    "Paneer Bhurji with Toast", "Vegetable Pulao with Raita", "Kadhi Chawal", "Methi Thepla", "Sprout Salad",
+    "Tofu Stir Fry with Quinoa", "Mixed Vegetable Curry", "Lentil Soup with Spinach", "Bhindi Masala with Roti",
+    "Vegetable Khichdi", "Stuffed Capsicum", "Matar Paneer", "Pesarattu", "Dhokla", "Baingan Bharta",
+    "Lemon Rice", "Sambar Rice", "Vegetable Uttapam", "Rava Idli", "Soya Chunk Curry", "Mushroom Masala",
+    "Quinoa Pulao", "Ragi Dosa", "Curd Rice", "Vegetable Sandwich", "Fruit and Nut Oatmeal",
+]
+INGREDIENTS = {
+    "Groceries": ["whole wheat flour", "basmati rice", "toor dal", "moong dal", "rajma", "chickpeas", "poha",
+                  "semolina", "besan", "oats", "quinoa", "cumin seeds", "turmeric", "garam masala", "mustard seeds",
+                  "ghee", "sunflower oil", "ragi flour", "soya chunks", "peanuts"],
+    "Vegetables": ["onion", "tomato", "garlic", "ginger", "green chilli", "spinach", "potato", "cauliflower",
+                   "okra", "capsicum", "carrot", "green peas", "brinjal", "mushroom", "coriander", "curry leaves",
+                   "methi leaves", "cucumber", "beans", "cabbage"],
+    "Dairy & Proteins": ["paneer", "curd", "milk", "tofu", "butter", "cheese", "buttermilk"],
+    "Fruits": ["lemon", "banana", "apple", "dates", "pomegranate", "mango"],
+}
+ACTIVITIES = ["Sedentary", "Lightly active", "Moderately active", "Very active", "Extra active"]
+GOALS = ["Weight loss", "Maintain weight", "Muscle gain"]
+
+
+# -----------------------------
+# Latency distributions
+# -----------------------------
+def parse_latency(spec, rng):
+    """
+    Returns a function drawing one latency (seconds) from a spec:
+    "fixed:S", "uniform:LOW:HIGH", "normal:MEAN:STD" or "lognormal:MEDIAN:SIGMA".
+    """
+    kind, *params = spec.split(":")
+    try:
+        params = [float(p) for p in params]
+        if kind == "fixed":
+            (seconds,) = params
+            return lambda: seconds
+        if kind == "uniform":
+            low, high = params
+            return lambda: rng.uniform(low, high)
+        if kind == "normal":
+            mean, std = params
+            return lambda: max(0.0, rng.gauss(mean, std))
+        if kind == "lognormal":
+            median, sigma = params
+            return lambda: rng.lognormvariate(math.log(median), sigma) if median > 0 else 0.0
+    except ValueError:
+        pass
+    raise argparse.ArgumentTypeError(f"Invalid latency spec '{spec}'")
+
+
+# -----------------------------
+# Fake agents
+# -----------------------------
+class FakeResponse:
+    def __init__(self, content, input_tokens, output_tokens):
+        self.content = content
+        self.metrics = {"input_tokens": [input_tokens], "output_tokens": [output_tokens]}
+
+
+class FakeEvent:
+    def __init__(self, content):
+        self.event = RunEvent.run_response_content.value
+        self.content = content
+
+
+class FakeModel:
+    """
+    Replaces an agent's `run`: waits a latency drawn from its distribution and
+    answers with `respond(request)` as JSON, like the real agent. In streaming
+    mode the answer arrives in chunks spread over the latency.
+    """
+
+    def __init__(self, respond, latency, scale=1.0, failure_rate=0.0, rng=None):
+        self.respond = respond
+        self.latency = latency
+        self.scale = scale
+        self.failure_rate = failure_rate
+        self.rng = rng or random.Random()
+
+    def run(self, message=None, *args, stream=False, **kwargs):
+        seconds = self.latency() * self.scale
+        if self.rng.random() < self.failure_rate:
+            time.sleep(seconds)
+            raise RuntimeError("Simulated model failure")
+        text = json.dumps(self.respond(json.loads(message)), ensure_ascii=False)
+        if not stream:
+            time.sleep(seconds)
+            return FakeResponse(text, len(message) // 4, len(text) // 4)
+        return self._stream(text, seconds)
+
+    def _stream(self, text, seconds):
+        chunks = [text[i:i + STREAM_CHUNK_CHARS] for i in range(0, len(text), STREAM_CHUNK_CHARS)]
+        time.sleep(seconds * TIME_TO_FIRST_CHUNK)
+        for chunk in chunks:
+            yield FakeEvent(chunk)
+            time.sleep(seconds * (1 - TIME_TO_FIRST_CHUNK) / len(chunks))
+
+
+def _dish_ingredients(dish_name):
+    """Returns the same (category, ingredient) list for a dish on every call."""
+    rng = random.Random(dish_name)
+    return [(category, rng.choice(INGREDIENTS[category])) for category in rng.choices(list(INGREDIENTS), weights=[4, 4, 2, 1], k=7)]
+
+
+def _recipe(dish_name):
+    return {
+        "prep_time": "15 minutes",
+        "cook_time": "25 minutes",
+        "steps": {
+            f"step-{i}": f"Add 1 cup of {ingredient} and cook for 3 minutes, stirring well."
+            for i, (_, ingredient) in enumerate(_dish_ingredients(dish_name), 1)
+        },
+    }
+
+
+def _price(name):
+    return random.Random(name).randrange(20, 250, 5)
+
+
+def fake_responders(dish_pool, rng):
+    """Returns {agent name: respond(request)} producing outputs in each agent's format."""
+
+    def meal_plan(request):
+        meals_per_day = int(request.get("user", {}).get("meals_per_day") or 3)
+        slots = [slot.title() for slot, _ in MEAL_SLOT_SPLITS.get(meals_per_day, MEAL_SLOT_SPLITS[3])]
+        plan = {}
+        for day in ("Day 1", "Day 2"):
+            plan[day] = {
+                slot: {
+                    "meal_name": slot,
+                    "dish_name": rng.choice(dish_pool),
+                    "calories_percentage": round(100 / len(slots)),
+                    "protein_percentage": round(100 / len(slots)),
+                    "vitamin_mineral_highlights": "Rich in iron and vitamin C",
+                }
+                for slot in slots
+            }
+            plan[day]["summary"] = "You hit your calorie and protein goals today. Keep it up!"
+        return plan
+
+    def shopping_list(request):
+        items = {category: [] for category in INGREDIENTS}
+        for meals in request.values():
+            for meal in (meals.values() if isinstance(meals, dict) else []):
+                if isinstance(meal, dict) and meal.get("dish_name"):
+                    for category, ingredient in _dish_ingredients(meal["dish_name"]):
+                        if ingredient not in items[category]:
+                            items[category].append(ingredient)
+        return items
+
+    def prices(request):
+        result = {}
+        for category, names in request.items():
+            priced = [{"name": name, "price": _price(name)} for name in names]
+            result[category] = {"items": priced, "total_price": sum(item["price"] for item in priced)}
+        result["Grand_Total"] = sum(details["total_price"] for details in result.values())
+        return result
+
+    def teasers(request):
+        name = request.get("user_name", "Friend")
+        return {key: f"{name}, your {meal['dish']} is waiting! 🍽️" for key, meal in request.get("meals", {}).items()}
+
+    return {
+        "meal_agent": meal_plan,
+        "recipe_batch_agent": lambda request: {dish: _recipe(dish) for dish in request},
+        "recipe_agent": lambda request: _recipe(next(iter(request), "")),
+        "shopping_agent": shopping_list,
+        "price_agent": prices,
+        "teaser_batch_agent": teasers,
+    }
+
+
+def fake_image_model(latency, scale, size, failure_rate, rng):
+    """Returns a stand-in for generate_dish_image_bytes that returns one noisy PNG of `size` px."""
+    buffer = io.BytesIO()
+    Image.effect_noise((size, size), 48).convert("RGB").save(buffer, format="PNG")
+    image = buffer.getvalue()
+
+    def generate_dish_image_bytes(dish_name):
+        time.sleep(latency() * scale)
+        if rng.random() < failure_rate:
+            raise RuntimeError("Simulated image model failure")
+        return image
+
+    return instrumented("dish_image")(generate_dish_image_bytes)
+
+
+def install_fakes(args, rng):
+    """Points every agent the pipeline uses, and the image model, at fakes."""
+    latencies = {**DEFAULT_LATENCIES, **dict(spec.split("=", 1) for spec in args.latency)}
+    dish_pool = DISHES[:args.dishes] if args.dishes <= len(DISHES) else DISHES + [f"Chef Special {i}" for i in range(args.dishes - len(DISHES))]
+    for name, respond in fake_responders(dish_pool, rng).items():
+        agent = getattr(agents, name)
+        cached = getattr(agent, "_llm_cached", False)
+        agent.run = FakeModel(respond, parse_latency(latencies[name], rng), args.latency_scale, args.failure_rate, rng).run
+        agent._instrumented = agent._llm_cached = False
+        instrument_agent(agent, name)
+        # Keep the production layering: response cache in front of the instrumented model
+        if cached and args.llm_cache:
+            cache_agent(agent, name, ttl_seconds=agent._llm_cache_ttl, validate=agent._llm_cache_validate)
+    dish_images.generate_dish_image_bytes = fake_image_model(
+        parse_latency(latencies["dish_image"], rng), args.latency_scale, args.image_size, args.failure_rate, rng
+    )
+    return latencies
+
+
+# -----------------------------
+# Database stand-in
+# -----------------------------
+# mongomock collection methods that stand for one server round-trip each
+MONGOMOCK_OPERATIONS = [
+    "find", "find_one", "insert_one", "insert_many", "update_one", "update_many", "replace_one", "delete_one",
+    "delete_many", "aggregate", "bulk_write", "count_documents", "distinct", "find_one_and_update",
+    "find_one_and_delete", "create_index",
+]
+_nested = threading.local()
+
+
+def _count_mongomock_calls():
+    """Counts mongomock collection calls as round-trips (calls made by other counted calls are ignored)."""
+    import mongomock
+
+    def counted(original):
+        def wrapper(self, *args, **kwargs):
+            if getattr(_nested, "depth", 0) == 0:
+                _count_round_trip()
+            _nested.depth = getattr(_nested, "depth", 0) + 1
+            try:
+                return original(self, *args, **kwargs)
+            finally:
+                _nested.depth -= 1
+        return wrapper
+
+    for name in MONGOMOCK_OPERATIONS:
+        if hasattr(mongomock.Collection, name):
+            setattr(mongomock.Collection, name, counted(getattr(mongomock.Collection, name)))
+
+
+def seed_database(users, catalog_coverage, rng):
+    """Creates `users` synthetic users with nutrition reports and a price catalog covering `catalog_coverage` of the ingredients."""
+    client.drop_database(db.name)
+    ensure_indexes()
+
+    profiles = []
+    for i in range(users):
+        profiles.append({
+            "name": f"Bench User {i}",
+            "phone": f"9{i:09d}",
+            "goal": rng.choice(GOALS),
+            "meals_per_day": rng.choice([3, 3, 4, 5]),
+            "diet": "Vegetarian",
+            "allergies": "",
+            "likes": "paneer, dal",
+            "cuisine": "Indian",
+            "budget": rng.randrange(500, 5000, 100),
+            "age": rng.randint(18, 65),
+            "weight": rng.randint(45, 110),
+            "height": rng.randint(150, 195),
+            "gender": rng.choice(["Male", "Female"]),
+            "activity": rng.choice(ACTIVITIES),
+        })
+    user_ids = user_collection.insert_many(profiles).inserted_ids
+    nutrition_collection.insert_many([
+        {"user_id": user_id, "report": build_report_base(profile), "created_at": datetime.utcnow()}
+        for user_id, profile in zip(user_ids, profiles)
+    ])
+
+    names = [name for category in INGREDIENTS.values() for name in category]
+    known = {canonical_ingredient(name): name for name in rng.sample(names, round(len(names) * catalog_coverage))}
+    if known:
+        price_catalog_collection.insert_many([
+            {"_id": key, "name": name, "price": float(_price(name)), "source": "benchmark"}
+            for key, name in known.items()
+        ])
+    load_price_catalog(force=True)
+    return user_ids
+
+
+# -----------------------------
+# Measurement
+# -----------------------------
+def percentile(values, q):
+    """Nearest-rank percentile; 0.0 for no values."""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+class StageTimer:
+    """Times calls per stage; a call fails when it raises or returns None/False."""
+
+    def __init__(self):
+        self.samples = {stage: [] for stage in STAGES}
+        self.failures = dict.fromkeys(STAGES, 0)
+        self.lock = threading.Lock()
+
+    def run(self, stage, fn, *args, **kwargs):
+        token = _stage.set(stage)
+        started = time.perf_counter()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            result = None
+        finally:
+            _stage.reset(token)
+        seconds = time.perf_counter() - started
+        with self.lock:
+            self.samples[stage].append(seconds)
+            self.failures[stage] += result is None or result is False
+        return result
+
+    def summary(self):
+        return {
+            stage: {
+                "calls": len(samples),
+                "failures": self.failures[stage],
+                "total_seconds": round(sum(samples), 3),
+                "p50_seconds": round(percentile(samples, 50), 3),
+                "p95_seconds": round(percentile(samples, 95), 3),
+                "max_seconds": round(max(samples, default=0.0), 3),
+                "db_round_trips": _round_trips.get(stage, 0),
+            }
+            for stage, samples in self.samples.items()
+        }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(args):
+    rng = random.Random(args.seed)
+    if type(client).__module__.startswith("mongomock"):
+        _count_mongomock_calls()
+    latencies = install_fakes(args, rng)
+    user_ids = seed_database(args.users, args.catalog_coverage, rng)
+    setup_round_trips = _round_trips.get("setup", 0)
+
+    timer = StageTimer()
+    phases = {}
+    if args.trace_memory:
+        tracemalloc.start()
+
+    def phase(name, fn, items=None):
+        if args.trace_memory:
+            tracemalloc.reset_peak()
+        started = time.perf_counter()
+        if items is None:
+            result = fn()
+        else:
+            with ThreadPoolExecutor(max_workers=args.workers) as executor:
+                result = list(executor.map(fn, items))
+        phases[name] = {"seconds": round(time.perf_counter() - started, 3)}
+        if args.trace_memory:
+            phases[name]["peak_memory_mb"] = round(tracemalloc.get_traced_memory()[1] / 2**20, 1)
+        return result
+
+    def plan_stages(user_id):
+        plan_doc = timer.run("meal_plan", generate_meal_plan_pipeline, user_id)
+        if plan_doc and timer.run("recipes", generate_recipes_pipeline, plan_doc) is not None:
+            timer.run("shopping_list", generate_shopping_list_pipeline, plan_doc)
+        return plan_doc
+
+    with tempfile.TemporaryDirectory() as upload_dir:
+        uploader = LocalUploader(upload_dir, latency=args.upload_latency * args.latency_scale)
+        output = sys.stdout if args.verbose else open(os.devnull, "w")
+        started = time.perf_counter()
+        with redirect_stdout(output):
+            plan_docs = phase("plans", plan_stages, user_ids)
+            phase("pricing", lambda: timer.run("pricing", lambda: price_prediction_pipeline(workers=args.workers) or True))
+            phase("upload", lambda plan_doc: timer.run("upload", upload_images_and_get_urls, plan_doc, uploader),
+                  [plan_doc for plan_doc in plan_docs if plan_doc])
+            phase("charts", lambda user_id: timer.run("charts", generate_and_save_all_charts, str(user_id)), user_ids)
+        wall = time.perf_counter() - started
+        if output is not sys.stdout:
+            output.close()
+
+    if args.trace_memory:
+        tracemalloc.stop()
+    total_round_trips = sum(count for stage, count in _round_trips.items() if stage != "setup")
+    return {
+        "benchmark": "pipeline",
+        "created_at": datetime.utcnow().isoformat(timespec="seconds") + "Z",
+        "git_commit": _git_commit(),
+        "database": "mongomock" if type(client).__module__.startswith("mongomock") else "mongodb",
+        "config": {**vars(args), "latency": latencies},
+        "users": args.users,
+        "wall_seconds": round(wall, 3),
+        "users_per_minute": round(args.users / wall * 60, 2) if wall else 0.0,
+        "stages": timer.summary(),
+        "phases": phases,
+        "db_round_trips": {
+            "total": total_round_trips,
+            "per_user": round(total_round_trips / args.users, 1) if args.users else 0.0,
+            "setup": setup_round_trips,
+        },
+        "peak_memory_mb": max((p.get("peak_memory_mb", 0.0) for p in phases.values()), default=0.0),
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "llm_cache": {name: stats["process"] for name, stats in get_llm_cache_stats().items()},
+        "model_calls": {
+            name: {key: value for key, value in values.items() if key != "latency"}
+            for name, values in metrics.snapshot().items()
+        },
+    }
+
+
+# -----------------------------
+# Reporting
+# -----------------------------
+def print_report(results):
+    print(f"\n🏁 {results['users']} user(s) in {results['wall_seconds']:.1f}s ({results['users_per_minute']} users/min) on {results['database']}")
+    print(f"{'stage':<14} {'calls':>6} {'failed':>6} {'p50 s':>8} {'p95 s':>8} {'max s':>8} {'db trips':>9}")
+    for stage, s in results["stages"].items():
+        print(f"{stage:<14} {s['calls']:>6} {s['failures']:>6} {s['p50_seconds']:>8.3f} {s['p95_seconds']:>8.3f} {s['max_seconds']:>8.3f} {s['db_round_trips']:>9}")
+    trips = results["db_round_trips"]
+    print(f"DB round-trips: {trips['total']} ({trips['per_user']}/user, {trips['setup']} during setup)")
+    print(f"Peak traced memory: {results['peak_memory_mb']} MB, max RSS: {results['max_rss_mb']} MB")
+    for name, phase in results["phases"].items():
+        print(f"  phase {name:<8} {phase['seconds']:>8.1f}s  peak {phase.get('peak_memory_mb', '-')} MB")
+
+
+def _change(new, old):
+    return f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+
+
+def print_comparison(results, baseline):
+    """Prints the relative change of the headline numbers against a saved run."""
+    print(f"\n📊 Compared with {baseline.get('created_at')} ({baseline.get('git_commit')}):")
+    print(f"  wall time      {baseline['wall_seconds']:>9.2f} -> {results['wall_seconds']:>9.2f}  {_change(results['wall_seconds'], baseline['wall_seconds'])}")
+    print(f"  db round-trips {baseline['db_round_trips']['total']:>9} -> {results['db_round_trips']['total']:>9}  {_change(results['db_round_trips']['total'], baseline['db_round_trips']['total'])}")
+    print(f"  peak memory MB {baseline['peak_memory_mb']:>9} -> {results['peak_memory_mb']:>9}  {_change(results['peak_memory_mb'], baseline['peak_memory_mb'])}")
+    for stage, s in results["stages"].items():
+        old = baseline["stages"].get(stage)
+        if not old:
+            continue
+        print(f"  {stage:<14} p50 {_change(s['p50_seconds'], old['p50_seconds']):>8}  p95 {_change(s['p95_seconds'], old['p95_seconds']):>8}  db trips {_change(s['db_round_trips'], old['db_round_trips']):>8}")
+    if baseline.get("config", {}).get("users") != results["users"]:
+        print("  ⚠️ The runs used a different number of users.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the generation pipeline offline with fake agents.")
+    parser.add_argument("--users", type=int, default=20, help="Synthetic users")
+    parser.add_argument("--workers", type=int, default=4, help="Users processed in parallel")
+    parser.add_argument("--latency", action="append", default=[], metavar="AGENT=SPEC",
+                        help="Latency of an agent or dish_image, e.g. meal_agent=lognormal:6:0.3 (fixed:S, uniform:A:B, normal:M:SD)")
+    parser.add_argument("--latency-scale", type=float, default=0.05, help="Multiplier applied to every latency")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Probability that a fake model call fails")
+    parser.add_argument("--upload-latency", type=float, default=0.5, help="Seconds per image upload (before --latency-scale)")
+    parser.add_argument("--dishes", type=int, default=len(DISHES), help="Distinct dishes the fake planner picks from")
+    parser.add_argument("--catalog-coverage", type=float, default=0.7, help="Share of ingredients already in the price catalog")
+    parser.add_argument("--image-size", type=int, default=1024, help="Side of the fake dish images in pixels")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--no-llm-cache", dest="llm_cache", action="store_false", help="Send every request to the fake models")
+    parser.add_argument("--no-trace-memory", dest="trace_memory", action="store_false", help="Skip tracemalloc (faster, no peak memory)")
+    parser.add_argument("--verbose", action="store_true", help="Show the pipeline's own output")
+    parser.add_argument("--output", default=None, help=f"Results file (default: {RESULTS_DIR}/pipeline-<timestamp>.json)")
+    parser.add_argument("--compare", default=None, metavar="RESULTS_JSON", help="Saved results to compare against")
+    args = parser.parse_args()
+
+    results = run_benchmark(args)
+    print_report(results)
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(results, json.load(f))
+
+    output = args.output or os.path.join(RESULTS_DIR, f"pipeline-{datetime.utcnow():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2, default=str)
+    print(f"💾 Results saved to {output}")
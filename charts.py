@@ -1,33 +1,87 @@
 # AIMealPlanner/charts.py
 
+import os
+import json
+import argparse
 import plotly.express as px
+import plotly.graph_objects as go
 import plotly.io as pio
 import pandas as pd
-from database import fs, user_collection, nutrition_collection, ingredient_collection
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from database import fs, fs_files_collection, user_collection, nutrition_collection, ingredient_collection
+from utils import hash_payload
+from instrumentation import run_in_context
 from bson import ObjectId
 
 # Set default theme for plotly charts
 pio.templates.default = "plotly_dark"
 
-def save_chart_to_gridfs(user_id, chart_name, fig):
-    """Saves a Plotly figure as HTML to GridFS."""
+# Bump when a chart's look changes so stored charts are rebuilt even if their inputs did not
+CHART_VERSION = 1
+# Max number of charts rendered at the same time for one user
+CHART_WORKERS = int(os.getenv("CHART_WORKERS", "4"))
+# "json" stores the compact figure spec and rebuilds the figure when rendering; "html" stores the rendered chart
+CHART_FORMAT = os.getenv("CHART_FORMAT", "json")
+CHART_FORMATS = ("json", "html")
+
+
+def chart_filename(user_id, chart_name, chart_format=None):
+    return f"user_{user_id}_{chart_name}.{chart_format or CHART_FORMAT}"
+
+
+def figure_to_spec(fig):
+    """
+    Returns the compact JSON spec of a figure: its traces and layout without the
+    theme template, which is re-applied by figure_from_spec.
+    """
+    spec = json.loads(pio.to_json(fig, validate=False))
+    spec.get("layout", {}).pop("template", None)
+    return spec
+
+
+def figure_from_spec(spec, height=None):
+    """Rebuilds a Plotly figure from figure_to_spec output with the default theme."""
+    fig = go.Figure(spec)
+    if height:
+        fig.update_layout(height=height)
+    return fig
+
+
+def chart_input_hash(chart_name, inputs):
+    """Fingerprint of everything a chart is drawn from."""
+    return hash_payload({"chart": chart_name, "version": CHART_VERSION, "inputs": inputs})
+
+
+def save_chart_to_gridfs(user_id, chart_name, fig, input_hash=None):
+    """Saves a Plotly figure to GridFS in CHART_FORMAT, replacing the previous version of the chart."""
     try:
-        html_str = fig.to_html(full_html=False, include_plotlyjs='cdn')
-        filename = f"user_{user_id}_{chart_name}.html"
+        if CHART_FORMAT == "json":
+            content = json.dumps(figure_to_spec(fig), separators=(",", ":"))
+            content_type = "application/json"
+        else:
+            content = fig.to_html(full_html=False, include_plotlyjs='cdn')
+            content_type = "text/html"
+        filename = chart_filename(user_id, chart_name)
 
-        existing_chart = fs.find_one({"filename": filename})
-        if existing_chart:
-            fs.delete(existing_chart._id)
-            
+        # Older versions of the chart in any format are replaced
+        old_names = [chart_filename(user_id, chart_name, chart_format) for chart_format in CHART_FORMATS]
+        old_ids = [doc["_id"] for doc in fs_files_collection.find({"filename": {"$in": old_names}}, {"_id": 1})]
+        # Write the new chart before deleting the old one so readers never find no chart
         fs.put(
-            html_str.encode('utf-8'), 
+            content.encode('utf-8'), 
             filename=filename, 
             user_id=user_id, 
-            content_type="text/html"
+            content_type=content_type,
+            metadata={"input_hash": input_hash},
         )
+        for old_id in old_ids:
+            fs.delete(old_id)
         print(f"✅ Saved interactive chart to GridFS: {filename}")
+        return True
     except Exception as e:
         print(f"❌ Failed to save chart {chart_name} to GridFS: {e}")
+        return False
+
 
 def shopping_cost_breakdown(pricing_details, username, user_id):
     if not pricing_details: return
@@ -43,7 +97,7 @@ def shopping_cost_breakdown(pricing_details, username, user_id):
         title_text=f"<b>Shopping Cost Breakdown</b><br><span style='font-size: 13px;'>This chart shows the percentage of your budget spent on each food category.</span>",
         title_x=0.5, title_font_size=20, margin=dict(t=100)
     )
-    save_chart_to_gridfs(user_id, "shopping_breakdown", fig)
+    return fig
 
 def macro_distribution(summary, username, user_id):
     if not summary: return
@@ -54,7 +108,7 @@ def macro_distribution(summary, username, user_id):
         title_text=f"<b>Daily Macro Distribution</b><br><span style='font-size: 13px;'>This chart displays your daily intake of Protein, Carbs, and Fats in grams.</span>",
         title_x=0.5, title_font_size=20, showlegend=False, margin=dict(t=100)
     )
-    save_chart_to_gridfs(user_id, "macro_distribution", fig)
+    return fig
 
 def calorie_vs_target(summary, username, user_id):
     if not summary: return
@@ -66,7 +120,7 @@ def calorie_vs_target(summary, username, user_id):
         title_text=f"<b>Calories: Actual vs. Target</b><br><span style='font-size: 13px;'>This chart compares your actual daily calorie intake against your target goal.</span>",
         title_x=0.5, title_font_size=20, showlegend=False, margin=dict(t=100)
     )
-    save_chart_to_gridfs(user_id, "calories_vs_target", fig)
+    return fig
 
 # --- NEW GRAPH FUNCTION ---
 def grocery_items_chart(pricing_details, username, user_id):
@@ -100,11 +154,43 @@ def grocery_items_chart(pricing_details, username, user_id):
         yaxis_title="Grocery Item",
         margin=dict(t=100, l=150) # Add left margin for long item names
     )
-    save_chart_to_gridfs(user_id, "grocery_items", fig)
+    return fig
+
 
+# chart name -> (builder, name of its input: "pricing_details" or "nutrition_summary")
+CHART_BUILDERS = {
+    "shopping_breakdown": (shopping_cost_breakdown, "pricing_details"),
+    "macro_distribution": (macro_distribution, "nutrition_summary"),
+    "calories_vs_target": (calorie_vs_target, "nutrition_summary"),
+    "grocery_items": (grocery_items_chart, "pricing_details"),
+}
 
-def generate_and_save_all_charts(user_id_str):
-    """Main function to generate all interactive charts for a specific user."""
+
+def _stored_input_hashes(user_id):
+    """Returns {filename: input_hash} of the charts stored for a user, in one query."""
+    filenames = [chart_filename(user_id, chart_name) for chart_name in CHART_BUILDERS]
+    docs = fs_files_collection.find({"filename": {"$in": filenames}}, {"filename": 1, "metadata.input_hash": 1})
+    return {doc["filename"]: (doc.get("metadata") or {}).get("input_hash") for doc in docs}
+
+
+def _render_chart(chart_name, data, username, user_id, input_hash):
+    builder, _ = CHART_BUILDERS[chart_name]
+    fig = builder(data, username, user_id)
+    if fig is None:
+        return False
+    return save_chart_to_gridfs(user_id, chart_name, fig, input_hash=input_hash)
+
+
+def generate_and_save_all_charts(user_id_str, force=False, max_workers=CHART_WORKERS):
+    """
+    Main function to generate all interactive charts for a specific user.
+
+    Each chart's inputs are fingerprinted and the hash is stored with the chart;
+    charts whose inputs did not change since they were saved are skipped unless
+    `force` is set. The others are rendered in parallel. Returns
+    {"rendered": [...], "skipped": [...]} with chart names, or False if the
+    user does not exist.
+    """
     user_id = ObjectId(user_id_str)
     user = user_collection.find_one({"_id": user_id})
     if not user:
@@ -113,16 +199,73 @@ def generate_and_save_all_charts(user_id_str):
 
     username = user.get("name", "User")
     
-    ingredients_doc = ingredient_collection.find_one({"user_id": user_id})
+    ingredients_doc = ingredient_collection.find_one({"user_id": user_id}, {"pricing_details": 1})
     pricing_details = ingredients_doc.get("pricing_details", {}) if ingredients_doc else {}
     
-    nutrition_doc = nutrition_collection.find_one({"user_id": user_id})
+    nutrition_doc = nutrition_collection.find_one({"user_id": user_id}, {"report.nutrition_summary": 1})
     nutrition_summary = nutrition_doc.get("report", {}).get("nutrition_summary", {}) if nutrition_doc else {}
 
-    print(f"📊 Generating interactive charts for {username}...")
-    shopping_cost_breakdown(pricing_details, username, user_id)
-    macro_distribution(nutrition_summary, username, user_id)
-    calorie_vs_target(nutrition_summary, username, user_id)
-    grocery_items_chart(pricing_details, username, user_id) # Call the new function
-    print("✅ All interactive charts generated.")
-    return True
\ No newline at end of file
+    inputs = {"pricing_details": pricing_details, "nutrition_summary": nutrition_summary}
+    stored = {} if force else _stored_input_hashes(user_id)
+    result = {"rendered": [], "skipped": []}
+    pending = {}
+    for chart_name, (_, input_name) in CHART_BUILDERS.items():
+        input_hash = chart_input_hash(chart_name, {"username": username, "data": inputs[input_name]})
+        if stored.get(chart_filename(user_id, chart_name)) == input_hash:
+            result["skipped"].append(chart_name)
+        else:
+            pending[chart_name] = (inputs[input_name], input_hash)
+
+    if pending:
+        print(f"📊 Generating {len(pending)} interactive chart(s) for {username}...")
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(pending)))) as executor:
+            futures = {
+                executor.submit(run_in_context(_render_chart), chart_name, data, username, user_id, input_hash): chart_name
+                for chart_name, (data, input_hash) in pending.items()
+            }
+            for future in as_completed(futures):
+                chart_name = futures[future]
+                try:
+                    if future.result():
+                        result["rendered"].append(chart_name)
+                except Exception as e:
+                    print(f"❌ Failed to render chart {chart_name}: {e}")
+    print(f"✅ Interactive charts: {len(result['rendered'])} rendered, {len(result['skipped'])} unchanged.")
+    return result
+
+
+def migrate_html_charts(delete_orphans=True):
+    """
+    Converts charts stored as HTML to the JSON figure spec by rebuilding them
+    from their source data; saving a chart removes its HTML version. HTML charts
+    of users that no longer exist are deleted when `delete_orphans` is set.
+    Returns {"users": n, "converted": n, "deleted": n}; safe to run again.
+    """
+    if CHART_FORMAT != "json":
+        raise RuntimeError("Set CHART_FORMAT=json to migrate charts to figure specs")
+    html_files = fs_files_collection.find({"filename": {"$regex": r"^user_[0-9a-f]{24}_.*\.html$"}}, {"filename": 1})
+    user_ids = {doc["filename"].split("_")[1] for doc in html_files}
+
+    totals = {"users": len(user_ids), "converted": 0, "deleted": 0}
+    for user_id in sorted(user_ids):
+        result = generate_and_save_all_charts(user_id, force=True)
+        if result:
+            # Saving a rebuilt chart already removed its HTML version
+            totals["converted"] += len(result["rendered"])
+        elif delete_orphans:
+            for doc in fs_files_collection.find({"filename": {"$regex": rf"^user_{user_id}_.*\.html$"}}, {"_id": 1}):
+                fs.delete(doc["_id"])
+                totals["deleted"] += 1
+    print(f"🔁 Chart migration finished: {totals}")
+    return totals
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintenance tasks for the stored dashboard charts.")
+    parser.add_argument("--migrate", action="store_true", help="Convert HTML charts to JSON figure specs")
+    parser.add_argument("--keep-orphans", action="store_true", help="Keep HTML charts of users that no longer exist")
+    args = parser.parse_args()
+    if args.migrate:
+        migrate_html_charts(delete_orphans=not args.keep_orphans)
+    else:
+        parser.print_help()
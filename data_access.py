@@ -0,0 +1,138 @@
+import os
+import json
+import streamlit as st
+from database import (
+    user_collection,
+    nutrition_collection,
+    meal_plan_collection,
+    ingredient_collection,
+    fs,
+    ensure_indexes,
+    get_complete_profile,
+    read_gridfs_files,
+)
+from bson import ObjectId
+from charts import chart_filename, CHART_FORMATS
+
+# How long a user's documents stay cached when nothing invalidates them
+USER_DATA_TTL_SECONDS = int(os.getenv("USER_DATA_TTL_SECONDS", "300"))
+# Show the per-rerun database query count in the sidebar
+SHOW_DB_STATS = os.getenv("SHOW_DB_STATS", "false").lower() == "true"
+
+
+def _count_queries(count=1):
+    st.session_state["db_queries"] = st.session_state.get("db_queries", 0) + count
+
+
+@st.cache_resource
+def _data_versions():
+    """Process-wide {phone: version}; bumping a version invalidates that user's cached data in every session."""
+    return {}
+
+
+def _version(phone):
+    return _data_versions().get(phone, 0)
+
+
+@st.cache_data(ttl=USER_DATA_TTL_SECONDS, show_spinner=False)
+def _load_user_data(phone, version):
+    user = user_collection.find_one({"phone": phone})
+    _count_queries()
+    data = {"user": user, "nutrition": None, "meal_plan": None, "shopping_list": None}
+    if not user:
+        return data
+    data["nutrition"] = nutrition_collection.find_one({"user_id": user["_id"]})
+    data["meal_plan"] = meal_plan_collection.find_one({"user_id": user["_id"]})
+    _count_queries(2)
+    if data["meal_plan"]:
+        data["shopping_list"] = ingredient_collection.find_one({"source_meal_plan_id": data["meal_plan"]["_id"]})
+        _count_queries()
+    return data
+
+
+def get_user_data(phone):
+    """
+    Returns {"user", "nutrition", "meal_plan", "shopping_list"} for a phone number.
+
+    The documents are loaded once and cached until `invalidate_user_data(phone)`
+    is called or the TTL expires, so every tab of a rerun shares one load.
+    Each call returns a fresh copy that callers may modify.
+    """
+    return _load_user_data(phone, _version(phone))
+
+
+def get_user(phone):
+    return get_user_data(phone)["user"]
+
+
+def invalidate_user_data(phone):
+    """Drops the cached documents of a user; call after every write for that user."""
+    versions = _data_versions()
+    versions[phone] = versions.get(phone, 0) + 1
+
+
+@st.cache_data(ttl=USER_DATA_TTL_SECONDS, show_spinner=False)
+def _load_complete_profile(phone, version):
+    _count_queries()
+    return get_complete_profile(phone)
+
+
+def get_profile_view(phone):
+    """Returns the projected documents of the "Complete Health Plan" view, loaded with one aggregation."""
+    return _load_complete_profile(phone, _version(phone))
+
+
+@st.cache_data(max_entries=100, show_spinner=False)
+def _load_gridfs_files(file_ids, variant):
+    _count_queries(2 if variant else 1)
+    files = read_gridfs_files([ObjectId(file_id) for file_id in file_ids], variant=variant)
+    return {str(file_id): data for file_id, data in files.items()}
+
+
+def get_gridfs_files(file_ids, variant=None):
+    """
+    Reads several GridFS files in one batched query; returns {str(file_id): bytes}.
+    With `variant` ("thumb", "medium") the downscaled copies are read where they exist.
+    """
+    return _load_gridfs_files(tuple(sorted(str(file_id) for file_id in file_ids if file_id)), variant)
+
+
+@st.cache_data(ttl=USER_DATA_TTL_SECONDS, show_spinner=False)
+def _load_chart(user_id, chart_name, version):
+    _count_queries()
+    # One query finds the chart in either format; a JSON spec wins over a legacy HTML file
+    filenames = [chart_filename(user_id, chart_name, chart_format) for chart_format in CHART_FORMATS]
+    chart_file = next(fs.find({"filename": {"$in": filenames}}).sort("filename", -1).limit(1), None)
+    if not chart_file:
+        return None
+    content = chart_file.read().decode()
+    if chart_file.filename.endswith(".json"):
+        return "json", json.loads(content)
+    return "html", content
+
+
+def get_chart(phone, user_id, chart_name):
+    """
+    Returns a stored chart as ("json", figure spec) or ("html", html string), or
+    None; cached until the user's data is invalidated.
+    """
+    return _load_chart(str(user_id), chart_name, _version(phone))
+
+
+@st.cache_resource
+def _bootstrap_indexes():
+    return ensure_indexes()
+
+
+def begin_rerun():
+    """Resets the query counter and makes sure the indexes exist; call at the top of the script."""
+    _bootstrap_indexes()
+    st.session_state["db_queries"] = 0
+
+
+def report_query_stats():
+    """Logs the number of database queries issued by this rerun; call at the end of the script."""
+    queries = st.session_state.get("db_queries", 0)
+    print(f"🗄️ Streamlit rerun issued {queries} database quer{'y' if queries == 1 else 'ies'}.")
+    if SHOW_DB_STATS:
+        st.sidebar.caption(f"Database queries this rerun: {queries}")
@@ -1,22 +1,92 @@
-from pymongo import MongoClient
+from pymongo import MongoClient, ASCENDING
+from pymongo.errors import PyMongoError
 from bson import ObjectId
 import gridfs
 import os
+from datetime import datetime
 from dotenv import load_dotenv
 
 load_dotenv()
 
 MONGO_URI = os.getenv("MONGO_URI")
 DB_NAME = os.getenv("MONGO_DB", "UserDB")
+# Days the model call events of a pipeline run are kept in Run_Timeline_Events
+RUN_TIMELINE_TTL_DAYS = int(os.getenv("RUN_TIMELINE_TTL_DAYS", "30"))
 
-client = MongoClient(MONGO_URI)
+if MONGO_URI and MONGO_URI.startswith("mongomock://"):
+    # In-memory stand-in for the offline benchmark and the tests; mongomock is in requirements-dev.txt
+    import mongomock
+    import mongomock.gridfs
+    mongomock.gridfs.enable_gridfs_integration()
+    client = mongomock.MongoClient()
+else:
+    client = MongoClient(MONGO_URI)
 db = client[DB_NAME]
 
 user_collection = db["UserCo"]
 nutrition_collection = db["Nutrition_Reports"]
 meal_plan_collection = db["Weekly_Meal_Plans"]
 ingredient_collection = db["IngredientsCol"]
+cache_stats_collection = db["Cache_Stats"]
+pipeline_progress_collection = db["Pipeline_Progress"]
+recipe_cache_collection = db["Recipe_Cache"]
+price_catalog_collection = db["Price_Catalog"]
+notification_runs_collection = db["Notification_Runs"]
+notification_deliveries_collection = db["Notification_Deliveries"]
+jobs_collection = db["Jobs"]
+run_timeline_collection = db["Run_Timeline_Events"]
+llm_cache_collection = db["LLM_Cache"]
 fs = gridfs.GridFS(db)
+fs_files_collection = db["fs.files"]
+
+# (collection, keys, options) for every index the app relies on; see ensure_indexes()
+INDEX_SPECS = [
+    (user_collection, [("phone", ASCENDING)], {"unique": True}),
+    (nutrition_collection, [("user_id", ASCENDING)], {}),
+    (meal_plan_collection, [("user_id", ASCENDING)], {}),
+    (ingredient_collection, [("source_meal_plan_id", ASCENDING)], {}),
+    (ingredient_collection, [("user_id", ASCENDING)], {}),
+    (fs_files_collection, [("filename", ASCENDING), ("uploadDate", ASCENDING)], {}),
+    (fs_files_collection, [("user_id", ASCENDING)], {}),
+    (fs_files_collection, [("metadata.cache_key", ASCENDING)], {}),
+    (fs_files_collection, [("metadata.last_used_at", ASCENDING)], {}),
+    (fs_files_collection, [("metadata.derivative_of", ASCENDING), ("metadata.variant", ASCENDING)], {}),
+    (pipeline_progress_collection, [("run_id", ASCENDING), ("user_id", ASCENDING)], {"unique": True}),
+    (recipe_cache_collection, [("expires_at", ASCENDING)], {"expireAfterSeconds": 0}),
+    (notification_runs_collection, [("slot", ASCENDING), ("started_at", ASCENDING)], {}),
+    (notification_deliveries_collection, [("run_id", ASCENDING), ("user_id", ASCENDING)], {"unique": True}),
+    (notification_deliveries_collection, [("sent_at", ASCENDING)], {"expireAfterSeconds": 7 * 24 * 3600}),
+    (jobs_collection, [("status", ASCENDING), ("type", ASCENDING), ("available_at", ASCENDING)], {}),
+    (jobs_collection, [("status", ASCENDING), ("lease_expires_at", ASCENDING)], {}),
+    (jobs_collection, [("idempotency_key", ASCENDING)], {"unique": True, "partialFilterExpression": {"idempotency_key": {"$type": "string"}}}),
+    (run_timeline_collection, [("run_id", ASCENDING), ("started_at", ASCENDING)], {}),
+    (run_timeline_collection, [("started_at", ASCENDING)], {"expireAfterSeconds": RUN_TIMELINE_TTL_DAYS * 24 * 3600}),
+    (llm_cache_collection, [("expires_at", ASCENDING)], {"expireAfterSeconds": 0}),
+    (llm_cache_collection, [("agent", ASCENDING)], {}),
+]
+_indexes_ensured = False
+
+
+def ensure_indexes(force=False):
+    """
+    Creates every index in INDEX_SPECS. Safe to call on each startup: existing
+    indexes are left alone. An index that cannot be built (e.g. a unique index
+    over duplicate data) is reported and skipped. Returns the names of the
+    indexes that failed.
+    """
+    global _indexes_ensured
+    if _indexes_ensured and not force:
+        return []
+    failed = []
+    for collection, keys, options in INDEX_SPECS:
+        try:
+            collection.create_index(keys, **options)
+        except PyMongoError as e:
+            name = f"{collection.name}.{'_'.join(field for field, _ in keys)}"
+            print(f"⚠️ Could not create index {name}: {e}")
+            failed.append(name)
+    _indexes_ensured = True
+    return failed
 
 
 def get_user_and_nutrition(user_id: str):
@@ -30,12 +100,147 @@ def get_user_and_nutrition(user_id: str):
     return user, nutrition["report"]
 
 
-def save_image_to_gridfs(image_bytes, filename):
-    """Saves an image to GridFS and returns the file ID."""
-    file_id = fs.put(image_bytes, filename=filename)
+def get_complete_profile(phone):
+    """
+    Returns everything the "Complete Health Plan" view renders for a user in one
+    aggregation: {"user", "nutrition", "meal_plan", "shopping_list"}, with each
+    document projected to the fields the view uses. Returns None if the user
+    does not exist.
+    """
+    pipeline = [
+        {"$match": {"phone": phone}},
+        {"$limit": 1},
+        {"$project": {"name": 1, "phone": 1}},
+        {"$lookup": {
+            "from": nutrition_collection.name,
+            "let": {"uid": "$_id"},
+            "pipeline": [
+                {"$match": {"$expr": {"$eq": ["$user_id", "$$uid"]}}},
+                {"$limit": 1},
+                {"$project": {"report.nutrition_summary": 1, "report.human_summary": 1}},
+            ],
+            "as": "nutrition",
+        }},
+        {"$lookup": {
+            "from": meal_plan_collection.name,
+            "let": {"uid": "$_id"},
+            "pipeline": [
+                {"$match": {"$expr": {"$eq": ["$user_id", "$$uid"]}}},
+                {"$limit": 1},
+                {"$project": {"meal_plan": 1, "image_file_ids": 1}},
+                {"$lookup": {
+                    "from": ingredient_collection.name,
+                    "let": {"mpid": "$_id"},
+                    "pipeline": [
+                        {"$match": {"$expr": {"$eq": ["$source_meal_plan_id", "$$mpid"]}}},
+                        {"$limit": 1},
+                        {"$project": {"pricing_details": 1}},
+                    ],
+                    "as": "shopping_list",
+                }},
+            ],
+            "as": "meal_plan",
+        }},
+        {"$project": {
+            "name": 1,
+            "phone": 1,
+            "nutrition": {"$arrayElemAt": ["$nutrition", 0]},
+            "meal_plan": {"$arrayElemAt": ["$meal_plan", 0]},
+        }},
+    ]
+    result = next(user_collection.aggregate(pipeline), None)
+    if not result:
+        return None
+    nutrition = result.pop("nutrition", None)
+    meal_plan = result.pop("meal_plan", None)
+    shopping_list = (meal_plan.pop("shopping_list", None) or [None])[0] if meal_plan else None
+    return {"user": result, "nutrition": nutrition, "meal_plan": meal_plan, "shopping_list": shopping_list}
+
+
+def read_gridfs_files(file_ids, variant=None):
+    """
+    Reads several GridFS files with one query on the chunks collection; returns {file_id: bytes}.
+
+    With `variant` ("thumb", "medium") the linked downscaled copy of each file is
+    read instead, falling back to the original for files that have none. The
+    result is still keyed by the original file ids.
+    """
+    file_ids = list({file_id for file_id in file_ids if file_id})
+    if not file_ids:
+        return {}
+    read_ids = {file_id: file_id for file_id in file_ids}
+    if variant:
+        derivatives = fs_files_collection.find(
+            {"metadata.derivative_of": {"$in": file_ids}, "metadata.variant": variant},
+            {"metadata.derivative_of": 1},
+        )
+        for doc in derivatives:
+            read_ids[doc["metadata"]["derivative_of"]] = doc["_id"]
+    originals = {read_id: file_id for file_id, read_id in read_ids.items()}
+
+    parts = {}
+    chunks = db["fs.chunks"].find({"files_id": {"$in": list(originals)}}, {"files_id": 1, "n": 1, "data": 1}).sort([("files_id", 1), ("n", 1)])
+    for chunk in chunks:
+        parts.setdefault(originals[chunk["files_id"]], []).append(chunk["data"])
+    return {file_id: b"".join(data) for file_id, data in parts.items()}
+
+
+def save_image_variants(file_id, filename, variants):
+    """
+    Stores downscaled copies of a GridFS image as separate files linked to it
+    through `metadata.derivative_of`. `variants` maps a variant name to
+    (bytes, content_type). Returns {variant: file_id}.
+    """
+    stem = filename.rsplit(".", 1)[0]
+    variant_ids = {}
+    for variant, (data, content_type) in variants.items():
+        variant_ids[variant] = fs.put(
+            data,
+            filename=f"{stem}_{variant}.{content_type.split('/')[-1]}",
+            contentType=content_type,
+            metadata={"derivative_of": file_id, "variant": variant},
+        )
+    fs_files_collection.update_one({"_id": file_id}, {"$set": {"metadata.variants": variant_ids}})
+    return variant_ids
+
+
+def save_image_to_gridfs(image_bytes, filename, metadata=None, variants=None):
+    """Saves an image to GridFS, plus its downscaled `variants` if given, and returns the file ID."""
+    if metadata:
+        file_id = fs.put(image_bytes, filename=filename, metadata=metadata)
+    else:
+        file_id = fs.put(image_bytes, filename=filename)
+    if variants:
+        save_image_variants(file_id, filename, variants)
     return file_id
 
 
+def delete_gridfs_file(file_id):
+    """Deletes a GridFS file together with its downscaled variants."""
+    for doc in fs_files_collection.find({"metadata.derivative_of": file_id}, {"_id": 1}):
+        fs.delete(doc["_id"])
+    fs.delete(file_id)
+
+
+def record_cache_stats(cache_name, hits=0, misses=0):
+    """Adds hit/miss counts for a shared cache to the Cache_Stats collection."""
+    if not hits and not misses:
+        return
+    cache_stats_collection.update_one(
+        {"_id": cache_name},
+        {"$inc": {"hits": hits, "misses": misses}, "$set": {"updated_at": datetime.utcnow()}},
+        upsert=True,
+    )
+
+
+def get_cache_stats(cache_name):
+    """Returns hits, misses and hit rate recorded for a shared cache."""
+    doc = cache_stats_collection.find_one({"_id": cache_name}) or {}
+    hits, misses = doc.get("hits", 0), doc.get("misses", 0)
+    total = hits + misses
+    return {"hits": hits, "misses": misses, "hit_rate": round(hits / total, 4) if total else 0.0}
+
+
 def get_ingredients_collection():
     """Returns the ingredients collection object."""
     return ingredient_collection
\ No newline at end of file
@@ -0,0 +1,94 @@
+import sys
+import argparse
+from datetime import datetime
+from bson import ObjectId
+from database import (
+    user_collection,
+    nutrition_collection,
+    meal_plan_collection,
+    ingredient_collection,
+    fs_files_collection,
+    pipeline_progress_collection,
+    recipe_cache_collection,
+    ensure_indexes,
+)
+
+
+def _sample(collection, field, default):
+    """Returns a real value of `field` so the explained query matches production data."""
+    doc = collection.find_one({field: {"$exists": True}}, {field: 1})
+    value = doc
+    for part in field.split("."):
+        value = value.get(part) if isinstance(value, dict) else None
+    return value if value is not None else default
+
+
+def query_shapes():
+    """Returns (name, collection, filter, sort) for every query shape the app issues."""
+    user_id = _sample(user_collection, "_id", ObjectId())
+    meal_plan_id = _sample(meal_plan_collection, "_id", ObjectId())
+    return [
+        ("UserCo by phone", user_collection, {"phone": _sample(user_collection, "phone", "0000000000")}, None),
+        ("UserCo by _id", user_collection, {"_id": user_id}, None),
+        ("Nutrition_Reports by user_id", nutrition_collection, {"user_id": user_id}, None),
+        ("Weekly_Meal_Plans by user_id", meal_plan_collection, {"user_id": user_id}, None),
+        ("IngredientsCol by source_meal_plan_id", ingredient_collection, {"source_meal_plan_id": meal_plan_id}, None),
+        ("IngredientsCol by user_id", ingredient_collection, {"user_id": user_id}, None),
+        ("GridFS chart by filename", fs_files_collection, {"filename": {"$in": [f"user_{user_id}_macro_distribution.json", f"user_{user_id}_macro_distribution.html"]}}, [("filename", -1)]),
+        ("GridFS by user_id", fs_files_collection, {"user_id": user_id}, None),
+        ("GridFS by image cache key", fs_files_collection, {"metadata.cache_key": _sample(fs_files_collection, "metadata.cache_key", "")}, None),
+        ("GridFS image cache LRU scan", fs_files_collection, {"metadata.cache_key": {"$exists": True}}, [("metadata.last_used_at", -1)]),
+        ("GridFS image variants", fs_files_collection, {"metadata.derivative_of": {"$in": [_sample(fs_files_collection, "metadata.derivative_of", ObjectId())]}, "metadata.variant": "medium"}, None),
+        ("Recipe_Cache by dish", recipe_cache_collection, {"_id": "dal tadka", "version": 1, "expires_at": {"$gt": datetime.utcnow()}}, None),
+        ("Pipeline_Progress by run and user", pipeline_progress_collection, {"run_id": "nightly", "user_id": user_id}, None),
+    ]
+
+
+def _stages(plan):
+    """Yields every stage name in an explain() plan tree."""
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for value in plan.values():
+            yield from _stages(value)
+    elif isinstance(plan, list):
+        for item in plan:
+            yield from _stages(item)
+
+
+def explain_query_shapes():
+    """Runs explain() on every query shape and returns one result dict per shape."""
+    results = []
+    for name, collection, query, sort in query_shapes():
+        cursor = collection.find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        plan = cursor.explain().get("queryPlanner", {}).get("winningPlan", {})
+        stages = list(_stages(plan))
+        results.append({
+            "query": name,
+            "collection": collection.name,
+            "stages": stages,
+            "collection_scan": "COLLSCAN" in stages,
+        })
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Explain every query shape used by the app and flag collection scans.")
+    parser.add_argument("--skip-indexes", action="store_true", help="Do not create missing indexes first")
+    args = parser.parse_args()
+
+    if not args.skip_indexes:
+        ensure_indexes()
+
+    results = explain_query_shapes()
+    for result in results:
+        flag = "❌ COLLSCAN" if result["collection_scan"] else "✅"
+        print(f"{flag:12} {result['query']:40} {' <- '.join(result['stages'])}")
+
+    scans = [result["query"] for result in results if result["collection_scan"]]
+    if scans:
+        print(f"\n⚠️ {len(scans)} query shape(s) scan a whole collection: {', '.join(scans)}")
+        sys.exit(1)
+    print("\n🎉 Every query shape uses an index.")
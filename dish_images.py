@@ -0,0 +1,238 @@
+import os
+import hashlib
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from database import (
+    save_image_to_gridfs,
+    save_image_variants,
+    delete_gridfs_file,
+    record_cache_stats,
+    get_cache_stats,
+    fs,
+    fs_files_collection,
+    meal_plan_collection,
+)
+from utils import generate_dish_image_bytes, normalize_dish_name, make_image_variants, IMAGE_MODEL, IMAGE_VARIANTS
+from instrumentation import run_in_context
+
+# Max number of dish images generated at the same time for one plan
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "4"))
+# Eviction policy of the shared dish image cache
+IMAGE_CACHE_MAX_ENTRIES = int(os.getenv("IMAGE_CACHE_MAX_ENTRIES", "5000"))
+IMAGE_CACHE_MAX_IDLE_DAYS = int(os.getenv("IMAGE_CACHE_MAX_IDLE_DAYS", "90"))
+# Referenced image ids looked up per query by backfill_image_variants
+VARIANT_BACKFILL_PAGE_SIZE = int(os.getenv("VARIANT_BACKFILL_PAGE_SIZE", "500"))
+
+CACHE_NAME = "dish_images"
+
+# Counters for this process; the totals across processes live in Cache_Stats
+image_cache_stats = {"hits": 0, "misses": 0}
+_stats_lock = threading.Lock()
+
+
+def image_key(day, dish_name):
+    """Returns the key used for a dish in `image_file_ids` and `image_urls`."""
+    return f"{day}_{dish_name.replace(' ', '_')}"
+
+
+def dish_cache_key(dish_name, model=IMAGE_MODEL):
+    """Content address of a dish image: normalized dish name plus image model id."""
+    return hashlib.sha256(f"{model}|{normalize_dish_name(dish_name)}".encode("utf-8")).hexdigest()
+
+
+def iter_plan_dishes(meal_plan_json):
+    """Yields (day, meal_key, dish_name) for every dish in a meal plan."""
+    for day, meals in meal_plan_json.items():
+        if not isinstance(meals, dict): continue
+        for meal_key, meal_val in meals.items():
+            if isinstance(meal_val, dict) and meal_val.get("dish_name"):
+                yield day, meal_key, meal_val["dish_name"]
+
+
+def image_variant_for_width(pixels):
+    """Returns the smallest stored variant at least `pixels` wide, or None when only the original is big enough."""
+    fitting = [(max_side, variant) for variant, max_side in IMAGE_VARIANTS.items() if max_side >= pixels]
+    return min(fitting)[1] if fitting else None
+
+
+def _count(hit):
+    with _stats_lock:
+        image_cache_stats["hits" if hit else "misses"] += 1
+    record_cache_stats(CACHE_NAME, hits=int(hit), misses=int(not hit))
+
+
+def _lookup_cached_image(cache_key):
+    """Returns the GridFS id of a cached image and refreshes its last-used time."""
+    doc = fs_files_collection.find_one_and_update(
+        {"metadata.cache_key": cache_key},
+        {"$set": {"metadata.last_used_at": datetime.utcnow()}, "$inc": {"metadata.use_count": 1}},
+        projection={"_id": 1},
+    )
+    return doc["_id"] if doc else None
+
+
+def get_or_create_dish_image(dish_name, filename=None, use_cache=True):
+    """
+    Returns the GridFS id of an image of `dish_name`, generating it only when the
+    shared cache has no image for this dish and image model yet.
+    """
+    cache_key = dish_cache_key(dish_name)
+    if use_cache:
+        file_id = _lookup_cached_image(cache_key)
+        if file_id:
+            _count(hit=True)
+            return file_id
+        _count(hit=False)
+
+    img_bytes = generate_dish_image_bytes(dish_name)
+    if not img_bytes:
+        raise RuntimeError("Image model returned no image data")
+    now = datetime.utcnow()
+    metadata = {
+        "cache_key": cache_key,
+        "dish_name": normalize_dish_name(dish_name),
+        "model": IMAGE_MODEL,
+        "created_at": now,
+        "last_used_at": now,
+        "use_count": 1,
+    }
+    filename = filename or f"{normalize_dish_name(dish_name).replace(' ', '_')}.png"
+    return save_image_to_gridfs(img_bytes, filename, metadata=metadata, variants=_variants_or_none(img_bytes, dish_name))
+
+
+def _variants_or_none(img_bytes, dish_name):
+    # Readers fall back to the full-size image, so a failed resize must not lose the image
+    try:
+        return make_image_variants(img_bytes)
+    except Exception as e:
+        print(f"⚠️ Could not create image variants for {dish_name}: {e}")
+        return None
+
+
+def generate_plan_images(meal_plan_json, max_workers=IMAGE_WORKERS, on_progress=None, use_cache=True):
+    """
+    Generates and stores the images for every dish of a meal plan in parallel.
+
+    Returns a tuple `(image_file_ids, failures)`. `image_file_ids` uses the same
+    keys as before ("Day 1_Paneer_Paratha"); `failures` maps the keys of dishes
+    whose image could not be generated to the error message. A failing dish never
+    fails the whole plan. `on_progress(key, file_id, error)` is called from the
+    calling thread as each dish finishes.
+
+    Dishes already in the shared image cache are not regenerated, and a dish that
+    appears several times in the plan is only looked up or generated once.
+    """
+    jobs = {}
+    for day, _, dish_name in iter_plan_dishes(meal_plan_json):
+        job = jobs.setdefault(dish_cache_key(dish_name), {"dish_name": dish_name, "keys": []})
+        key = image_key(day, dish_name)
+        if key not in job["keys"]:
+            job["keys"].append(key)
+
+    image_ids, failures = {}, {}
+    if not jobs:
+        return image_ids, failures
+
+    workers = max(1, min(max_workers, len(jobs)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(run_in_context(get_or_create_dish_image), job["dish_name"], f"{job['keys'][0]}.png", use_cache): job
+            for job in jobs.values()
+        }
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                file_id, error = future.result(), None
+            except Exception as e:
+                file_id, error = None, str(e)
+                print(f"⚠️ Image generation failed for {job['dish_name']}: {e}")
+            for key in job["keys"]:
+                if file_id:
+                    image_ids[key] = file_id
+                else:
+                    failures[key] = error
+                if on_progress:
+                    on_progress(key, file_id, error)
+
+    return image_ids, failures
+
+
+def _referenced_image_ids():
+    """Returns the set of GridFS ids still referenced by any meal plan."""
+    # One result document per id, so the set is streamed instead of built in a single 16MB document
+    pipeline = [
+        {"$project": {"ids": {"$objectToArray": {"$ifNull": ["$image_file_ids", {}]}}}},
+        {"$unwind": "$ids"},
+        {"$group": {"_id": "$ids.v"}},
+    ]
+    return {doc["_id"] for doc in meal_plan_collection.aggregate(pipeline, allowDiskUse=True)}
+
+
+def evict_dish_image_cache(max_entries=IMAGE_CACHE_MAX_ENTRIES, max_idle_days=IMAGE_CACHE_MAX_IDLE_DAYS):
+    """
+    Evicts least recently used cached dish images.
+
+    Keeps the `max_entries` most recently used images and drops anything idle
+    for more than `max_idle_days`. Images still referenced by a meal plan are
+    never deleted. Returns the number of deleted files.
+    """
+    cutoff = datetime.utcnow() - timedelta(days=max_idle_days)
+    cursor = fs_files_collection.find(
+        {"metadata.cache_key": {"$exists": True}},
+        {"_id": 1, "metadata.last_used_at": 1},
+    ).sort("metadata.last_used_at", -1)
+
+    candidates = []
+    for position, doc in enumerate(cursor):
+        last_used = doc.get("metadata", {}).get("last_used_at")
+        if position >= max_entries or (last_used and last_used < cutoff):
+            candidates.append(doc["_id"])
+    if not candidates:
+        return 0
+
+    referenced = _referenced_image_ids()
+    deleted = 0
+    for file_id in candidates:
+        if file_id in referenced:
+            continue
+        delete_gridfs_file(file_id)
+        deleted += 1
+    print(f"🧹 Evicted {deleted} cached dish image(s).")
+    return deleted
+
+
+def _images_without_variants(page_size):
+    """Yields the fs.files docs of cached and plan-referenced images without variants, paging the referenced ids."""
+    missing = {"metadata.variants": {"$exists": False}, "metadata.derivative_of": {"$exists": False}}
+    yield from fs_files_collection.find({"metadata.cache_key": {"$exists": True}, **missing}, {"_id": 1, "filename": 1})
+    referenced = sorted(_referenced_image_ids(), key=str)
+    for start in range(0, len(referenced), page_size):
+        page = referenced[start:start + page_size]
+        yield from fs_files_collection.find({"_id": {"$in": page}, **missing}, {"_id": 1, "filename": 1})
+
+
+def backfill_image_variants(limit=None, page_size=VARIANT_BACKFILL_PAGE_SIZE):
+    """
+    Creates the downscaled variants of dish images stored before variants
+    existed (cached images and images referenced by a meal plan). Returns the
+    number of images processed.
+    """
+    done = 0
+    for doc in _images_without_variants(page_size):
+        if limit and done >= limit:
+            break
+        variants = _variants_or_none(fs.get(doc["_id"]).read(), doc.get("filename"))
+        if variants:
+            save_image_variants(doc["_id"], doc.get("filename") or f"{doc['_id']}.png", variants)
+            done += 1
+    if done:
+        print(f"🖼️ Created variants for {done} stored dish image(s).")
+    return done
+
+
+def get_image_cache_stats():
+    """Returns the hit/miss counters of this process and across all processes."""
+    with _stats_lock:
+        local = dict(image_cache_stats)
+    return {"process": local, "total": get_cache_stats(CACHE_NAME)}
@@ -0,0 +1,320 @@
+import os
+import json
+import time
+import bisect
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from database import run_timeline_collection
+
+# Port of the local metrics endpoint (0 disables it)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+# Timeline events buffered before they are written to Run_Timeline_Events
+TIMELINE_FLUSH_EVENTS = 500
+
+LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120]
+COUNTERS = ["calls", "errors", "parse_failures", "retries", "cache_hits", "input_chars", "output_chars", "input_tokens", "output_tokens"]
+
+# Name of the last model call of this thread/context; parse failures are charged to it
+_last_call = contextvars.ContextVar("last_model_call", default=None)
+# Timeline of the pipeline run in progress, if any
+_current_run = contextvars.ContextVar("pipeline_run", default=None)
+# Ids (user_id, job_id) added to the timeline events recorded in this context
+_timeline_tags = contextvars.ContextVar("timeline_tags", default={})
+
+
+class _Metrics:
+    """Thread-safe per-call-name counters and latency histograms."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def _entry(self, name):
+        if name not in self.counters:
+            self.counters[name] = dict.fromkeys(COUNTERS, 0)
+            self.histograms[name] = {"buckets": [0] * (len(LATENCY_BUCKETS) + 1), "sum": 0.0, "count": 0}
+        return self.counters[name], self.histograms[name]
+
+    def add(self, name, **counts):
+        with self.lock:
+            counters, _ = self._entry(name)
+            for key, value in counts.items():
+                counters[key] += value or 0
+
+    def observe(self, name, seconds):
+        with self.lock:
+            _, histogram = self._entry(name)
+            histogram["buckets"][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                name: {**self.counters[name], "latency": json.loads(json.dumps(self.histograms[name]))}
+                for name in self.counters
+            }
+
+
+metrics = _Metrics()
+
+
+def _token_count(value):
+    # agno keeps one entry per model message
+    if isinstance(value, (list, tuple)):
+        return sum(v for v in value if isinstance(v, (int, float)))
+    return value if isinstance(value, (int, float)) else 0
+
+
+def _tokens(run_response):
+    usage = getattr(run_response, "metrics", None) or {}
+    return _token_count(usage.get("input_tokens")), _token_count(usage.get("output_tokens"))
+
+
+def _size(value):
+    if value is None:
+        return 0
+    if isinstance(value, (bytes, str)):
+        return len(value)
+    return len(json.dumps(value, default=str))
+
+
+def _record(name, started, seconds, ok, input_chars, output_chars=0, input_tokens=0, output_tokens=0, error=None):
+    metrics.observe(name, seconds)
+    metrics.add(
+        name,
+        calls=1,
+        errors=0 if ok else 1,
+        input_chars=input_chars,
+        output_chars=output_chars,
+        input_tokens=input_tokens,
+        output_tokens=output_tokens,
+    )
+    _last_call.set(name)
+    run = _current_run.get()
+    if run:
+        run.add({
+            "name": name,
+            "started_at": started,
+            "seconds": round(seconds, 3),
+            "ok": ok,
+            "input_chars": input_chars,
+            "output_chars": output_chars,
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "error": error,
+            **_timeline_tags.get(),
+        })
+
+
+def instrument_agent(agent, name):
+    """
+    Wraps `agent.run` so every call records its latency, input/output size and
+    token usage under `name`, in both normal and streaming mode.
+    """
+    if getattr(agent, "_instrumented", False):
+        return agent
+    run = agent.run
+
+    def instrumented_run(message=None, *args, **kwargs):
+        started, clock = datetime.utcnow(), time.perf_counter()
+        input_chars = _size(message)
+        try:
+            response = run(message, *args, **kwargs)
+        except Exception as e:
+            _record(name, started, time.perf_counter() - clock, False, input_chars, error=str(e))
+            raise
+        if not kwargs.get("stream"):
+            input_tokens, output_tokens = _tokens(response)
+            _record(name, started, time.perf_counter() - clock, True, input_chars,
+                    _size(getattr(response, "content", None)), input_tokens, output_tokens)
+            return response
+
+        def stream():
+            output_chars, ok, error = 0, True, None
+            try:
+                for event in response:
+                    content = getattr(event, "content", None)
+                    if isinstance(content, str):
+                        output_chars += len(content)
+                    yield event
+            except Exception as e:
+                ok, error = False, str(e)
+                raise
+            finally:
+                input_tokens, output_tokens = _tokens(getattr(agent, "run_response", None))
+                _record(name, started, time.perf_counter() - clock, ok, input_chars, output_chars, input_tokens, output_tokens, error)
+
+        return stream()
+
+    agent.run = instrumented_run
+    agent._instrumented = True
+    return agent
+
+
+def instrumented(name):
+    """Decorator that records latency and input/output size of a model call made by a plain function."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            started, clock = datetime.utcnow(), time.perf_counter()
+            input_chars = sum(_size(arg) for arg in args if isinstance(arg, str))
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                _record(name, started, time.perf_counter() - clock, False, input_chars, error=str(e))
+                raise
+            _record(name, started, time.perf_counter() - clock, True, input_chars, _size(result))
+            return result
+        return wrapper
+    return decorator
+
+
+def record_parse_failure(name=None):
+    """Counts a model output that could not be parsed, charged to the last model call of this context."""
+    metrics.add(name or _last_call.get() or "unknown", parse_failures=1)
+
+
+def record_retry(name):
+    """Counts a model call repeated because an earlier attempt failed or was incomplete."""
+    metrics.add(name, retries=1)
+
+
+# -----------------------------
+# Per-run timeline
+# -----------------------------
+class RunTimeline:
+    """Collects the model calls of one pipeline run and writes them to Run_Timeline_Events in batches."""
+
+    def __init__(self, run_id):
+        self.run_id = run_id
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.count = 0
+
+    def add(self, event):
+        with self.lock:
+            self.buffer.append({"run_id": self.run_id, **event})
+            self.count += 1
+            if len(self.buffer) < TIMELINE_FLUSH_EVENTS:
+                return
+            events, self.buffer = self.buffer, []
+        self._write(events)
+
+    def flush(self):
+        with self.lock:
+            events, self.buffer = self.buffer, []
+        self._write(events)
+
+    def _write(self, events):
+        if not events:
+            return
+        try:
+            run_timeline_collection.insert_many(events, ordered=False)
+        except Exception as e:
+            print(f"⚠️ Could not store {len(events)} timeline event(s) of run {self.run_id}: {e}")
+
+
+@contextmanager
+def pipeline_run(run_id):
+    """
+    Records every instrumented model call made inside the block, including in
+    threads started with `run_in_context`, as the timeline of `run_id`. Inside a
+    run with the same id the enclosing timeline is reused.
+    """
+    current = _current_run.get()
+    if current and current.run_id == run_id:
+        yield current
+        return
+    timeline = RunTimeline(run_id)
+    token = _current_run.set(timeline)
+    try:
+        yield timeline
+    finally:
+        _current_run.reset(token)
+        timeline.flush()
+
+
+@contextmanager
+def timeline_tags(**tags):
+    """Adds `tags` (e.g. user_id, job_id) to every timeline event recorded inside the block; None values are left out."""
+    token = _timeline_tags.set({**_timeline_tags.get(), **{key: value for key, value in tags.items() if value is not None}})
+    try:
+        yield
+    finally:
+        _timeline_tags.reset(token)
+
+
+def run_in_context(fn):
+    """Binds `fn` to the current context so a worker thread records into the same run timeline."""
+    context = contextvars.copy_context()
+    return functools.partial(context.run, fn)
+
+
+def get_run_timeline(run_id, **tags):
+    """Returns the stored timeline events of a run in start order, optionally only those with `tags` (e.g. user_id=...)."""
+    return list(run_timeline_collection.find({"run_id": run_id, **tags}, {"_id": 0}).sort("started_at", 1))
+
+
+# -----------------------------
+# Metrics endpoint
+# -----------------------------
+def render_prometheus(snapshot=None):
+    """Returns the metrics in the Prometheus text format."""
+    snapshot = snapshot if snapshot is not None else metrics.snapshot()
+    lines = []
+    for counter in COUNTERS:
+        lines.append(f"# TYPE model_{counter}_total counter")
+        lines += [f'model_{counter}_total{{call="{name}"}} {values[counter]}' for name, values in snapshot.items()]
+    lines.append("# TYPE model_call_seconds histogram")
+    for name, values in snapshot.items():
+        histogram = values["latency"]
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ["+Inf"], histogram["buckets"]):
+            cumulative += count
+            lines.append(f'model_call_seconds_bucket{{call="{name}",le="{bound}"}} {cumulative}')
+        lines.append(f'model_call_seconds_sum{{call="{name}"}} {histogram["sum"]:.6f}')
+        lines.append(f'model_call_seconds_count{{call="{name}"}} {histogram["count"]}')
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            body, content_type = render_prometheus().encode(), "text/plain; version=0.0.4"
+        elif self.path == "/metrics.json":
+            body, content_type = json.dumps(metrics.snapshot()).encode(), "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+
+
+def start_metrics_server(port=METRICS_PORT):
+    """Serves /metrics (Prometheus) and /metrics.json on localhost in a background thread."""
+    global _server
+    if _server or not port:
+        return _server
+    try:
+        _server = ThreadingHTTPServer(("127.0.0.1", port), _MetricsHandler)
+    except OSError as e:
+        print(f"⚠️ Metrics endpoint not started on port {port}: {e}")
+        return None
+    threading.Thread(target=_server.serve_forever, daemon=True).start()
+    print(f"📈 Metrics at http://127.0.0.1:{port}/metrics")
+    return _server
@@ -0,0 +1,406 @@
+import os
+import time
+import socket
+import argparse
+import threading
+import contextvars
+from datetime import datetime, timedelta
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, PyMongoError
+from database import (
+    jobs_collection,
+    user_collection,
+    meal_plan_collection,
+    ingredient_collection,
+    ensure_indexes,
+)
+from main import (
+    generate_meal_plan_pipeline,
+    generate_images_pipeline,
+    generate_recipes_pipeline,
+    generate_shopping_list_pipeline,
+    _price_document,
+)
+from upload_images import upload_plan_images
+from charts import generate_and_save_all_charts
+from instrumentation import pipeline_run, timeline_tags, start_metrics_server
+
+# How long a claimed job stays invisible to other workers without a heartbeat
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "300"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+# Retry delay: JOB_BACKOFF_SECONDS * 2^(attempt - 1), capped at JOB_MAX_BACKOFF_SECONDS
+JOB_BACKOFF_SECONDS = float(os.getenv("JOB_BACKOFF_SECONDS", "30"))
+JOB_MAX_BACKOFF_SECONDS = float(os.getenv("JOB_MAX_BACKOFF_SECONDS", "3600"))
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "2"))
+
+# Job types enqueued after a job of the key type succeeds, with the same payload
+JOB_CHAIN = {
+    "meal_plan": ["images", "recipes"],
+    "images": ["upload"],
+    "recipes": ["shopping_list"],
+    "shopping_list": ["pricing"],
+    "pricing": ["charts"],
+}
+
+
+class JobError(Exception):
+    """A job failed in a way that retrying cannot fix; it is marked dead immediately."""
+
+
+class LeaseLost(Exception):
+    """The job's lease was taken over by another worker; this worker must stop working on it."""
+
+
+# Set by process_job's heartbeat when the lease of the job run by this context is lost
+_lease_lost = contextvars.ContextVar("job_lease_lost", default=None)
+
+
+def check_lease():
+    """Raises LeaseLost when the job being run lost its lease; handlers call it before each write."""
+    lost = _lease_lost.get()
+    if lost is not None and lost.is_set():
+        raise LeaseLost("Lease lost to another worker")
+
+
+# -----------------------------
+# Handlers: payload -> result (raise to retry)
+# -----------------------------
+def _plan_doc(payload):
+    plan_doc = meal_plan_collection.find_one({"user_id": ObjectId(payload["user_id"])})
+    if not plan_doc:
+        raise JobError(f"No meal plan for user {payload['user_id']}")
+    return plan_doc
+
+
+def _handle_meal_plan(payload):
+    check_lease()
+    user_id = ObjectId(payload["user_id"])
+    if not user_collection.find_one({"_id": user_id}, {"_id": 1}):
+        raise JobError(f"User {user_id} does not exist")
+    plan_doc = generate_meal_plan_pipeline(user_id, with_images=False)
+    if plan_doc is None:
+        raise RuntimeError("Meal plan generation failed")
+    return {"meal_plan_id": plan_doc["_id"]}
+
+
+def _handle_images(payload):
+    check_lease()
+    image_errors = generate_images_pipeline(_plan_doc(payload))
+    if image_errors:
+        raise RuntimeError(f"{len(image_errors)} image(s) failed: {', '.join(image_errors)}")
+    return {}
+
+
+def _handle_recipes(payload):
+    check_lease()
+    if generate_recipes_pipeline(_plan_doc(payload)) is None:
+        raise RuntimeError("Saving the recipes failed")
+    return {}
+
+
+def _handle_shopping_list(payload):
+    check_lease()
+    shopping_list = generate_shopping_list_pipeline(_plan_doc(payload))
+    if shopping_list is None:
+        raise RuntimeError("Shopping list generation failed")
+    return {"categories": len(shopping_list)}
+
+
+def _handle_pricing(payload):
+    document = ingredient_collection.find_one(
+        {"user_id": ObjectId(payload["user_id"]), "shopping_list": {"$type": "object"}},
+        {"shopping_list": 1},
+    )
+    if not document:
+        raise JobError(f"No shopping list for user {payload['user_id']}")
+    operation = _price_document(document)
+    check_lease()
+    ingredient_collection.bulk_write([operation])
+    return {}
+
+
+def _handle_upload(payload):
+    plan_doc = _plan_doc(payload)
+    result = upload_plan_images(plan_doc)
+    check_lease()
+    meal_plan_collection.update_one(
+        {"_id": plan_doc["_id"]},
+        {"$set": {"image_urls": result.urls, "image_upload_errors": result.failed}},
+    )
+    if result.failed:
+        # Uploaded images are skipped on the retry
+        raise RuntimeError(f"{len(result.failed)} upload(s) failed: {', '.join(result.failed)}")
+    return {"uploaded": len(result.succeeded)}
+
+
+def _handle_charts(payload):
+    check_lease()
+    result = generate_and_save_all_charts(payload["user_id"])
+    if not result:
+        raise JobError(f"User {payload['user_id']} does not exist")
+    return result
+
+
+JOB_HANDLERS = {
+    "meal_plan": _handle_meal_plan,
+    "images": _handle_images,
+    "recipes": _handle_recipes,
+    "shopping_list": _handle_shopping_list,
+    "pricing": _handle_pricing,
+    "upload": _handle_upload,
+    "charts": _handle_charts,
+}
+
+
+# -----------------------------
+# Queue operations
+# -----------------------------
+def enqueue(job_type, payload, idempotency_key=None, max_attempts=JOB_MAX_ATTEMPTS, delay_seconds=0):
+    """
+    Adds a job and returns its id. A job whose `idempotency_key` was already
+    enqueued is not added again; the id of the existing job is returned.
+    """
+    if job_type not in JOB_HANDLERS:
+        raise ValueError(f"Unknown job type: {job_type}")
+    now = datetime.utcnow()
+    job = {
+        "type": job_type,
+        "payload": payload,
+        "status": "queued",
+        "attempts": 0,
+        "max_attempts": max_attempts,
+        "available_at": now + timedelta(seconds=delay_seconds),
+        "created_at": now,
+        "updated_at": now,
+    }
+    if idempotency_key is None:
+        return jobs_collection.insert_one(job).inserted_id
+    try:
+        doc = jobs_collection.find_one_and_update(
+            {"idempotency_key": idempotency_key},
+            {"$setOnInsert": {**job, "idempotency_key": idempotency_key}},
+            upsert=True,
+            projection={"_id": 1},
+            return_document=ReturnDocument.AFTER,
+        )
+    except DuplicateKeyError:
+        # Two processes upserted the same key at once; the other one won
+        doc = jobs_collection.find_one({"idempotency_key": idempotency_key}, {"_id": 1})
+    return doc["_id"]
+
+
+def claim_job(worker_id, job_types=None, lease_seconds=JOB_LEASE_SECONDS):
+    """
+    Atomically claims the next available job for `worker_id` and returns it, or
+    None. Jobs whose lease expired (their worker died) become visible again and
+    are claimed before new ones.
+    """
+    now = datetime.utcnow()
+    type_filter = {"type": {"$in": list(job_types)}} if job_types else {}
+    claim = {
+        "$set": {
+            "status": "running",
+            "lease_owner": worker_id,
+            "lease_expires_at": now + timedelta(seconds=lease_seconds),
+            "started_at": now,
+            "updated_at": now,
+        },
+        "$inc": {"attempts": 1},
+    }
+    for query, sort in [
+        ({"status": "running", "lease_expires_at": {"$lt": now}, **type_filter}, [("lease_expires_at", 1)]),
+        ({"status": "queued", "available_at": {"$lte": now}, **type_filter}, [("available_at", 1)]),
+    ]:
+        job = jobs_collection.find_one_and_update(query, claim, sort=sort, return_document=ReturnDocument.AFTER)
+        if job:
+            return job
+    return None
+
+
+def extend_lease(job, worker_id, lease_seconds=JOB_LEASE_SECONDS):
+    """Extends the lease of a running job; returns False if another worker took it over."""
+    result = jobs_collection.update_one(
+        {"_id": job["_id"], "status": "running", "lease_owner": worker_id},
+        {"$set": {"lease_expires_at": datetime.utcnow() + timedelta(seconds=lease_seconds)}},
+    )
+    return result.matched_count == 1
+
+
+def complete_job(job, worker_id, result=None):
+    """Marks a job done and enqueues its chained jobs; returns False if the worker no longer holds the lease."""
+    now = datetime.utcnow()
+    updated = jobs_collection.update_one(
+        {"_id": job["_id"], "lease_owner": worker_id, "status": "running"},
+        {"$set": {"status": "done", "result": result, "finished_at": now, "updated_at": now},
+         "$unset": {"lease_expires_at": ""}},
+    )
+    if updated.matched_count != 1:
+        return False
+    for next_type in JOB_CHAIN.get(job["type"], []):
+        key = f"{job['idempotency_key']}>{next_type}" if job.get("idempotency_key") else None
+        enqueue(next_type, job["payload"], idempotency_key=key)
+    return True
+
+
+def fail_job(job, worker_id, error, retryable=True):
+    """Schedules a retry with exponential backoff, or marks the job dead when attempts are used up."""
+    now = datetime.utcnow()
+    attempts = job.get("attempts", 1)
+    if retryable and attempts < job.get("max_attempts", JOB_MAX_ATTEMPTS):
+        delay = min(JOB_BACKOFF_SECONDS * 2 ** (attempts - 1), JOB_MAX_BACKOFF_SECONDS)
+        update = {"status": "queued", "available_at": now + timedelta(seconds=delay)}
+    else:
+        update = {"status": "dead", "finished_at": now}
+    updated = jobs_collection.update_one(
+        {"_id": job["_id"], "lease_owner": worker_id, "status": "running"},
+        {"$set": {**update, "last_error": error, "updated_at": now},
+         "$unset": {"lease_expires_at": ""},
+         "$push": {"errors": {"$each": [{"attempt": attempts, "error": error, "at": now}], "$slice": -10}}},
+    )
+    return update["status"] if updated.matched_count == 1 else "lease_lost"
+
+
+def process_job(job, worker_id, lease_seconds=JOB_LEASE_SECONDS):
+    """
+    Runs a claimed job's handler while a heartbeat keeps its lease alive. When
+    the lease is lost (another worker reclaimed the job), the handler is stopped
+    at its next check_lease() and nothing is recorded; returns "lease_lost".
+    """
+    stop, lost = threading.Event(), threading.Event()
+
+    def heartbeat():
+        while not stop.wait(lease_seconds / 3):
+            try:
+                if not extend_lease(job, worker_id, lease_seconds):
+                    lost.set()
+                    return
+            except PyMongoError as e:
+                print(f"⚠️ Could not extend the lease of job {job['_id']}: {e}")
+
+    threading.Thread(target=heartbeat, daemon=True).start()
+    token = _lease_lost.set(lost)
+    try:
+        if job.get("attempts", 1) > job.get("max_attempts", JOB_MAX_ATTEMPTS):
+            raise JobError("Lease expired too many times")
+        # The chained jobs of one enqueue_all_users run share its timeline; events carry the job and user
+        user_id = job["payload"].get("user_id")
+        with pipeline_run(job["payload"].get("run_id") or f"job-{job['_id']}"), \
+                timeline_tags(job_id=job["_id"], user_id=ObjectId(user_id) if ObjectId.is_valid(user_id) else user_id):
+            result = JOB_HANDLERS[job["type"]](job["payload"])
+        check_lease()
+    except LeaseLost:
+        print(f"🔒 Job {job['_id']} ({job['type']}): lease lost, another worker took it over.")
+        return "lease_lost"
+    except JobError as e:
+        print(f"💀 Job {job['_id']} ({job['type']}) cannot succeed: {e}")
+        return fail_job(job, worker_id, str(e), retryable=False)
+    except Exception as e:
+        status = fail_job(job, worker_id, str(e))
+        print(f"⚠️ Job {job['_id']} ({job['type']}) failed on attempt {job.get('attempts')}: {e} -> {status}")
+        return status
+    finally:
+        stop.set()
+        _lease_lost.reset(token)
+    if not complete_job(job, worker_id, result):
+        print(f"🔒 Job {job['_id']} ({job['type']}) finished after its lease was lost; the result is not recorded.")
+        return "lease_lost"
+    print(f"✅ Job {job['_id']} ({job['type']}) done.")
+    return "done"
+
+
+def run_worker(worker_id=None, job_types=None, concurrency=1, poll_seconds=JOB_POLL_SECONDS, max_jobs=None):
+    """
+    Claims and runs jobs until stopped, with `concurrency` threads. Start as many
+    workers on as many hosts as needed; claims are atomic, so every job runs on
+    one worker at a time. With `max_jobs` the worker stops after that many jobs.
+    """
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    processed = {"count": 0}
+    lock = threading.Lock()
+    print(f"👷 Worker {worker_id} started ({concurrency} thread(s), types: {', '.join(job_types or JOB_HANDLERS)}).")
+
+    def loop(thread_id):
+        owner = f"{worker_id}/{thread_id}"
+        while True:
+            with lock:
+                if max_jobs is not None and processed["count"] >= max_jobs:
+                    return
+            job = claim_job(owner, job_types)
+            if not job:
+                if max_jobs is not None and not claimable_jobs(job_types):
+                    return
+                time.sleep(poll_seconds)
+                continue
+            with lock:
+                processed["count"] += 1
+            process_job(job, owner)
+
+    threads = [threading.Thread(target=loop, args=(i,), daemon=True) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return processed["count"]
+
+
+def pending_jobs(job_types=None):
+    """Counts jobs that are queued or running."""
+    query = {"status": {"$in": ["queued", "running"]}}
+    if job_types:
+        query["type"] = {"$in": list(job_types)}
+    return jobs_collection.count_documents(query)
+
+
+def claimable_jobs(job_types=None):
+    """Counts jobs that could be claimed now: queued and available, or running with an expired lease."""
+    now = datetime.utcnow()
+    query = {"$or": [
+        {"status": "queued", "available_at": {"$lte": now}},
+        {"status": "running", "lease_expires_at": {"$lt": now}},
+    ]}
+    if job_types:
+        query["type"] = {"$in": list(job_types)}
+    return jobs_collection.count_documents(query)
+
+
+def enqueue_all_users(run_id=None):
+    """Enqueues one meal_plan job per user; the chain enqueues the later stages. Returns the count."""
+    run_id = run_id or f"nightly-{datetime.utcnow():%Y-%m-%d}"
+    count = 0
+    for user in user_collection.find({}, {"_id": 1}, batch_size=500):
+        enqueue("meal_plan", {"user_id": str(user["_id"]), "run_id": run_id}, idempotency_key=f"{run_id}:{user['_id']}")
+        count += 1
+    print(f"📥 Enqueued {count} meal plan job(s) for run '{run_id}'.")
+    return count
+
+
+def queue_stats():
+    """Returns {job type: {status: count}}."""
+    stats = {}
+    for row in jobs_collection.aggregate([{"$group": {"_id": {"type": "$type", "status": "$status"}, "count": {"$sum": 1}}}]):
+        stats.setdefault(row["_id"]["type"], {})[row["_id"]["status"]] = row["count"]
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Durable job queue for the meal planner pipeline.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    worker = commands.add_parser("worker", help="Run jobs")
+    worker.add_argument("--types", nargs="+", choices=list(JOB_HANDLERS), help="Only run these job types")
+    worker.add_argument("--concurrency", type=int, default=1, help="Jobs run in parallel by this process")
+    worker.add_argument("--max-jobs", type=int, default=None, help="Stop after this many jobs, or when no job can be claimed right now")
+    enqueue_cmd = commands.add_parser("enqueue", help="Enqueue the full pipeline for every user")
+    enqueue_cmd.add_argument("--run-id", default=None, help="Idempotency prefix; reusing it does not enqueue users twice")
+    commands.add_parser("stats", help="Show job counts by type and status")
+    args = parser.parse_args()
+    ensure_indexes()
+
+    if args.command == "worker":
+        start_metrics_server()
+        run_worker(job_types=args.types, concurrency=args.concurrency, max_jobs=args.max_jobs)
+    elif args.command == "enqueue":
+        enqueue_all_users(args.run_id)
+    else:
+        for job_type, counts in sorted(queue_stats().items()):
+            print(f"{job_type:15} {counts}")
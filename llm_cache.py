@@ -0,0 +1,271 @@
+import os
+import re
+import json
+import time
+import atexit
+import hashlib
+import threading
+import contextvars
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from agno.run.response import RunEvent
+from database import llm_cache_collection, record_cache_stats, get_cache_stats
+from instrumentation import metrics
+
+# Bump when the cached response format changes so old entries are ignored
+# (2: entries are only stored when the whole response is one valid JSON object)
+LLM_CACHE_VERSION = 2
+# "off" disables the cache for every agent
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE", "on").lower() != "off"
+LLM_CACHE_TTL_SECONDS = int(os.getenv("LLM_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+# Responses kept in the in-process LRU in front of the LLM_Cache collection
+LLM_CACHE_LRU_SIZE = int(os.getenv("LLM_CACHE_LRU_SIZE", "512"))
+# Comma-separated agent names that skip the cache, e.g. "meal_agent,price_agent"
+LLM_CACHE_BYPASS_AGENTS = {name.strip() for name in os.getenv("LLM_CACHE_BYPASS_AGENTS", "").split(",") if name.strip()}
+# Hit/miss counts are added to Cache_Stats in one write per agent at most this often, not per lookup
+LLM_CACHE_STATS_FLUSH_SECONDS = float(os.getenv("LLM_CACHE_STATS_FLUSH_SECONDS", "60"))
+
+CACHE_NAME_PREFIX = "llm_"
+_FENCE = re.compile(r"^```(?:json)?\s*|\s*```$")
+
+# Set by bypass(): skip cached responses in this context but store the fresh ones
+_bypass = contextvars.ContextVar("llm_cache_bypass", default=False)
+
+_lru = OrderedDict()
+_lru_lock = threading.Lock()
+llm_cache_stats = {}
+_stats_lock = threading.Lock()
+# Counts not yet written to Cache_Stats: {name: {"hits": n, "misses": n}}
+_unflushed_stats = {}
+_stats_flushed_at = time.monotonic()
+
+
+class CachedRunResponse:
+    """Stands in for an agno RunResponse served from the cache."""
+
+    def __init__(self, content):
+        self.content = content
+        self.event = RunEvent.run_response_content.value
+        self.metrics = {}
+        self.cached = True
+
+
+def canonical_input(message):
+    """JSON input is re-serialized with sorted keys and no whitespace; other text is whitespace-normalized."""
+    if not isinstance(message, str):
+        return json.dumps(message, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    try:
+        return json.dumps(json.loads(message), sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    except ValueError:
+        return " ".join(message.split())
+
+
+def agent_fingerprint(agent):
+    """Hash of everything besides the input that shapes an agent's answer: prompt fields and tools."""
+    tools = [getattr(t, "name", None) or getattr(t, "__name__", str(t)) for t in getattr(agent, "tools", None) or []]
+    prompt = {
+        field: getattr(agent, field, None)
+        for field in ["description", "role", "instructions", "expected_output", "additional_context"]
+    }
+    return hashlib.sha256(json.dumps({**prompt, "tools": tools}, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def cache_key(name, model_id, fingerprint, message):
+    payload = json.dumps([LLM_CACHE_VERSION, name, model_id, fingerprint, canonical_input(message)], ensure_ascii=False)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def _count(name, outcome):
+    hit = outcome in ("memory_hits", "db_hits")
+    with _stats_lock:
+        stats = llm_cache_stats.setdefault(name, {"memory_hits": 0, "db_hits": 0, "misses": 0, "bypassed": 0})
+        stats[outcome] += 1
+        if hit or outcome == "misses":
+            unflushed = _unflushed_stats.setdefault(name, {"hits": 0, "misses": 0})
+            unflushed["hits" if hit else "misses"] += 1
+        flush_due = time.monotonic() - _stats_flushed_at >= LLM_CACHE_STATS_FLUSH_SECONDS
+    if hit:
+        metrics.add(name, cache_hits=1)
+    if flush_due:
+        flush_cache_stats()
+
+
+def flush_cache_stats():
+    """Adds the hit/miss counts gathered since the last flush to Cache_Stats, one write per agent."""
+    global _unflushed_stats, _stats_flushed_at
+    with _stats_lock:
+        unflushed, _unflushed_stats = _unflushed_stats, {}
+        _stats_flushed_at = time.monotonic()
+    for name, counts in unflushed.items():
+        try:
+            record_cache_stats(CACHE_NAME_PREFIX + name, **counts)
+        except Exception as e:
+            print(f"⚠️ Could not record the LLM cache stats of {name}: {e}")
+
+
+atexit.register(flush_cache_stats)
+
+
+def _lru_get(key):
+    with _lru_lock:
+        entry = _lru.get(key)
+        if not entry:
+            return None
+        content, expires_at = entry
+        if expires_at <= datetime.utcnow():
+            del _lru[key]
+            return None
+        _lru.move_to_end(key)
+        return content
+
+
+def _lru_put(key, content, expires_at):
+    with _lru_lock:
+        _lru[key] = (content, expires_at)
+        _lru.move_to_end(key)
+        while len(_lru) > LLM_CACHE_LRU_SIZE:
+            _lru.popitem(last=False)
+
+
+def lookup(key):
+    """Returns (content, tier) of a cached response, tier being "memory_hits" or "db_hits", or (None, None)."""
+    content = _lru_get(key)
+    if content is not None:
+        return content, "memory_hits"
+    # The key is the _id, so lookups use the _id index; the TTL monitor may lag, hence the expiry filter
+    doc = llm_cache_collection.find_one(
+        {"_id": key, "expires_at": {"$gt": datetime.utcnow()}},
+        {"content": 1, "expires_at": 1},
+    )
+    if not doc:
+        return None, None
+    _lru_put(key, doc["content"], doc["expires_at"])
+    return doc["content"], "db_hits"
+
+
+def parse_single_object(text):
+    """Returns the response parsed as exactly one JSON object (optionally in a markdown fence), or None."""
+    if not isinstance(text, str):
+        return None
+    try:
+        value = json.loads(_FENCE.sub("", text.strip()))
+    except ValueError:
+        return None
+    return value if isinstance(value, dict) else None
+
+
+def store(key, name, model_id, content, ttl_seconds, validate=None, message=None):
+    """
+    Saves a response in the LRU and the LLM_Cache collection. Only a response
+    that is one whole JSON object, accepted by `validate(value, message)` when
+    given, is cached, so a malformed or incomplete answer is asked for again.
+    """
+    value = parse_single_object(content)
+    if value is None or (validate and not validate(value, message)):
+        return
+    now = datetime.utcnow()
+    expires_at = now + timedelta(seconds=ttl_seconds)
+    _lru_put(key, content, expires_at)
+    try:
+        llm_cache_collection.update_one(
+            {"_id": key},
+            {"$set": {"agent": name, "model": model_id, "content": content, "created_at": now, "expires_at": expires_at}},
+            upsert=True,
+        )
+    except Exception as e:
+        print(f"⚠️ Could not store the {name} response in the LLM cache: {e}")
+
+
+def cache_agent(agent, name, ttl_seconds=LLM_CACHE_TTL_SECONDS, validate=None):
+    """
+    Serves repeated `agent.run` calls from the response cache. The key is the
+    agent name, model id, a hash of the agent's prompt and tools, and the
+    canonicalized input, so any prompt or model change misses. Only answers that
+    parse as one JSON object and pass `validate(value, message)` are stored. Streaming calls
+    are cached too; a streamed answer is stored once it completed, or when the
+    caller stopped reading after a complete JSON object. A hit in streaming mode
+    yields the whole answer as one chunk.
+
+    Pass `cache=False` to a call, or run it inside `bypass()`, to skip the cached
+    answer and store a fresh one. Agents listed in LLM_CACHE_BYPASS_AGENTS, or
+    every agent with LLM_CACHE=off, are not cached at all.
+    """
+    if getattr(agent, "_llm_cached", False) or not LLM_CACHE_ENABLED or name in LLM_CACHE_BYPASS_AGENTS:
+        return agent
+    run = agent.run
+    model_id = getattr(getattr(agent, "model", None), "id", None)
+    fingerprint = agent_fingerprint(agent)
+
+    def cached_run(message=None, *args, cache=True, **kwargs):
+        # Calls with extra arguments (images, session state, ...) are not keyed and go straight through
+        if args or set(kwargs) - {"stream"}:
+            return run(message, *args, **kwargs)
+        stream = kwargs.get("stream", False)
+        key = cache_key(name, model_id, fingerprint, message)
+        if cache and not _bypass.get():
+            content, tier = lookup(key)
+            if content is not None:
+                _count(name, tier)
+                response = CachedRunResponse(content)
+                return iter([response]) if stream else response
+            _count(name, "misses")
+        else:
+            _count(name, "bypassed")
+
+        if not stream:
+            response = run(message, **kwargs)
+            store(key, name, model_id, getattr(response, "content", None), ttl_seconds, validate, message)
+            return response
+
+        def stream_and_store():
+            parts, failed = [], False
+            try:
+                for event in run(message, **kwargs):
+                    if getattr(event, "event", None) in (RunEvent.run_response_content, RunEvent.run_response_content.value) \
+                            and isinstance(event.content, str):
+                        parts.append(event.content)
+                    yield event
+            except Exception:
+                failed = True
+                raise
+            finally:
+                # Also reached when parse_json_stream stops reading after the JSON object; store() checks it is complete
+                if not failed:
+                    store(key, name, model_id, "".join(parts), ttl_seconds, validate, message)
+
+        return stream_and_store()
+
+    agent.run = cached_run
+    agent._llm_cached = True
+    agent._llm_cache_ttl = ttl_seconds
+    agent._llm_cache_validate = validate
+    return agent
+
+
+@contextmanager
+def bypass():
+    """Skips cached responses for the agent calls inside the block (e.g. "Regenerate"); fresh answers are still stored."""
+    token = _bypass.set(True)
+    try:
+        yield
+    finally:
+        _bypass.reset(token)
+
+
+def clear_llm_cache(name=None):
+    """Deletes the cached responses of one agent, or of all agents. Returns how many were deleted."""
+    with _lru_lock:
+        _lru.clear()
+    return llm_cache_collection.delete_many({"agent": name} if name else {}).deleted_count
+
+
+def get_llm_cache_stats():
+    """Returns per-agent hit counters of this process and the hit rate recorded across all processes."""
+    flush_cache_stats()
+    with _stats_lock:
+        local = {name: dict(stats) for name, stats in llm_cache_stats.items()}
+    return {
+        name: {"process": stats, "total": get_cache_stats(CACHE_NAME_PREFIX + name)}
+        for name, stats in local.items()
+    }
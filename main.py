@@ -1,24 +1,43 @@
+import os
 import json
-import re
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pymongo import UpdateOne
 from datetime import datetime
-from agents import meal_agent, recipe_agent, shopping_agent, price_agent
+from agents import meal_agent, shopping_agent
 from database import (
     get_user_and_nutrition,
-    save_image_to_gridfs,
     meal_plan_collection,
     ingredient_collection,
     user_collection,
+    pipeline_progress_collection,
+    ensure_indexes,
 )
-from utils import clean_mongo_doc, generate_dish_image_bytes
+from utils import clean_mongo_doc, hash_payload, extract_json, JSONExtractionError
+from dish_images import generate_plan_images, evict_dish_image_cache, backfill_image_variants, get_image_cache_stats
+from recipes import fill_plan_recipes, get_recipe_cache_stats
+from pricing import price_shopping_list, load_price_catalog
 from upload_images import upload_images
-from whatsapp_message import send_meal_notifications
+from whatsapp_message import schedule_meal_notifications, store_plan_teasers
+from instrumentation import pipeline_run, run_in_context, timeline_tags, start_metrics_server
 import schedule
 import time
 
+# Number of users processed in parallel by the batch runner
+PIPELINE_WORKERS = int(os.getenv("PIPELINE_WORKERS", "4"))
+BATCH_STAGES = ["meal_plan", "recipes", "shopping_list"]
+# User ids read per query by the batch runner
+USER_PAGE_SIZE = 100
+# Number of shopping lists priced in parallel
+PRICING_WORKERS = int(os.getenv("PRICING_WORKERS", "4"))
 
-def generate_meal_plan_pipeline(user_id):
+
+def generate_meal_plan_pipeline(user_id, with_images=True):
     """
     Runs the entire pipeline to generate and upsert a meal plan for a given user.
+    With `with_images=False` the dish images are left to a separate step
+    (see generate_images_pipeline).
     """
     print(f"\nProcessing user: {user_id}")
     try:
@@ -28,36 +47,25 @@ def generate_meal_plan_pipeline(user_id):
         input_data = {"user": user_clean, "nutrition_report": report_clean}
 
         response = meal_agent.run(json.dumps(input_data, indent=2))
-        raw = response.content
-        if not raw: raise RuntimeError("Agent returned empty response")
-
-        match = re.search(r"(\{.*\})", raw, re.DOTALL)
-        if not match:
+        try:
+            meal_plan_json = extract_json(response.content)
+        except JSONExtractionError:
             print("Invalid agent output. Expected JSON object.")
-            print(raw)
-            raise RuntimeError("Failed to find JSON in agent response")
-
-        json_str = match.group(1)
-        meal_plan_json = json.loads(json_str)
-
-        image_ids = {}
-        for day in ["Day 1", "Day 2"]:
-            day_content = meal_plan_json.get(day)
-            if not day_content: continue
-            for meal_key, meal_val in day_content.items():
-                if meal_key.lower() == "summary": continue
-                dish_name = meal_val.get("dish_name")
-                if dish_name:
-                    print(f"Generating image for {dish_name}...")
-                    img_bytes = generate_dish_image_bytes(dish_name)
-                    if img_bytes:
-                        file_id = save_image_to_gridfs(img_bytes, f"{day}_{dish_name.replace(' ', '_')}.png")
-                        image_ids[f"{day}_{dish_name.replace(' ', '_')}"] = file_id
+            print(response.content)
+            raise
+
+        image_ids, image_errors = {}, {}
+        if with_images:
+            print(f"Generating images for {user_id}...")
+            image_ids, image_errors = generate_plan_images(meal_plan_json)
+            if image_errors:
+                print(f"⚠️ {len(image_errors)} image(s) failed for user {user_id}: {', '.join(image_errors)}")
 
         record = {
             "user_id": user_id,
             "meal_plan": meal_plan_json,
             "image_file_ids": image_ids,
+            "image_errors": image_errors,
             "generated_at": datetime.utcnow(),
         }
 
@@ -65,13 +73,39 @@ def generate_meal_plan_pipeline(user_id):
         meal_plan_collection.update_one({"user_id": user_id}, {"$set": record}, upsert=True)
         print(f"Upserted meal plan with images for user {user_id} in MongoDB.")
 
-        return meal_plan_collection.find_one({"user_id": user_id})
+        plan_doc = meal_plan_collection.find_one({"user_id": user_id})
+        try:
+            print(f"Stored {store_plan_teasers(user, plan_doc)} WhatsApp teaser(s) for {user_id}.")
+        except Exception as e:
+            print(f"⚠️ Teasers for user {user_id} will be written at send time: {e}")
+        return plan_doc
 
     except Exception as e:
         print(f"Error processing user {user_id}: {e}")
         return None
 
 
+def generate_images_pipeline(meal_plan_doc):
+    """
+    Generates the missing dish images of a stored meal plan. Returns the image
+    errors ({} when every dish has an image), or None without a meal plan.
+    """
+    if not meal_plan_doc:
+        print("❌ No meal plan found in the database.")
+        return None
+
+    existing = meal_plan_doc.get("image_file_ids") or {}
+    image_ids, image_errors = generate_plan_images(meal_plan_doc.get("meal_plan", {}))
+    image_ids = {**image_ids, **existing}
+    image_errors = {key: error for key, error in image_errors.items() if key not in image_ids}
+    meal_plan_collection.update_one(
+        {"_id": meal_plan_doc["_id"]},
+        {"$set": {"image_file_ids": image_ids, "image_errors": image_errors}},
+    )
+    print(f"🖼️ Stored {len(image_ids)} image(s) for user {meal_plan_doc.get('user_id')}, {len(image_errors)} failed.")
+    return image_errors
+
+
 def generate_recipes_pipeline(meal_plan_doc):
     """
     Generates recipes for the given meal plan.
@@ -83,30 +117,13 @@ def generate_recipes_pipeline(meal_plan_doc):
     print(f"📄 Found a meal plan for user: {meal_plan_doc.get('user_id')}")
     meal_plan = meal_plan_doc.get("meal_plan", {})
 
-    for day, meals in meal_plan.items():
-        if not isinstance(meals, dict): continue
-        for meal_name, meal_details in meals.items():
-            if not isinstance(meal_details, dict): continue
-            dish_name = meal_details.get("dish_name")
-            if not dish_name: continue
-            if "recipe" in meal_details:
-                print(f"⏭️ Skipping {dish_name}, recipe already exists.")
-                continue
-
-            print(f"\n🍳 Generating recipe for: {day} - {dish_name}...")
-            cleaned_meal_details = clean_mongo_doc({dish_name: meal_details})
-            response = recipe_agent.run(json.dumps(cleaned_meal_details, indent=2))
-
-            try:
-                raw_content = response.content.strip()
-                if raw_content.startswith("```json"): raw_content = raw_content[7:]
-                if raw_content.endswith("```"): raw_content = raw_content[:-3]
-                recipe_content = json.loads(raw_content.strip())
-                meal_details["recipe"] = recipe_content
-                print(f"👍 Recipe generated for {dish_name}.")
-            except json.JSONDecodeError:
-                print(f"⚠️ Could not parse the recipe for {dish_name}. Response was: {raw_content}")
-                meal_details["recipe"] = {"error": "Failed to generate recipe."}
+    failures = fill_plan_recipes(
+        meal_plan, on_progress=lambda day, dish_name: print(f"\n🍳 Getting recipe for: {day} - {dish_name}...")
+    )
+    for (day, meal_name), error in failures.items():
+        print(f"⚠️ Could not generate the recipe for {day} - {meal_name}: {error}")
+        meal_plan[day][meal_name]["recipe"] = {"error": "Failed to generate recipe."}
+    print(f"📚 Recipe cache: {get_recipe_cache_stats()}")
 
     print("\n💾 Saving updated meal plan back to the database...")
     try:
@@ -117,8 +134,10 @@ def generate_recipes_pipeline(meal_plan_doc):
             print("✅ Database updated successfully!")
         else:
             print("ℹ️ No changes were needed in the database.")
+        return meal_plan
     except Exception as e:
         print(f"❌ Failed to update database. Error: {e}")
+        return None
 
 
 def generate_shopping_list_pipeline(meal_plan_doc):
@@ -141,14 +160,11 @@ def generate_shopping_list_pipeline(meal_plan_doc):
 
     shopping_list = None
     try:
-        raw_content = response.content.strip()
-        if raw_content.startswith("```json"): raw_content = raw_content[7:]
-        if raw_content.endswith("```"): raw_content = raw_content[:-3]
-        shopping_list = json.loads(raw_content)
+        shopping_list = extract_json(response.content)
         print("\n\n--- 🛍️ Generated Shopping List ---")
         print(json.dumps(shopping_list, indent=2))
-    except json.JSONDecodeError:
-        print(f"⚠️ Could not parse the agent's response. Raw output:\n{raw_content}")
+    except JSONExtractionError as e:
+        print(f"⚠️ Could not parse the agent's response ({e}). Raw output:\n{response.content}")
 
     if shopping_list:
         print(f"\n💾 Upserting shopping list to 'IngredientsCol' collection...")
@@ -157,6 +173,7 @@ def generate_shopping_list_pipeline(meal_plan_doc):
                 "user_id": user_id,
                 "source_meal_plan_id": meal_plan_id,
                 "shopping_list": shopping_list,
+                "shopping_list_hash": hash_payload(shopping_list),
                 "created_at": datetime.utcnow(),
             }
             result = ingredient_collection.update_one(
@@ -170,69 +187,202 @@ def generate_shopping_list_pipeline(meal_plan_doc):
                 print(f"✅ Successfully updated existing shopping list for meal plan ID: {meal_plan_id}")
             else:
                 print("ℹ️ No changes were needed for the shopping list in the database.")
+            return shopping_list
         except Exception as e:
             print(f"❌ Failed to save ingredients to the database. Error: {e}")
-
-
-def price_prediction_pipeline():
+    return None
+
+
+def _price_document(document):
+    """Prices one shopping list and returns the bulk update for it."""
+    doc_id = document["_id"]
+    shopping_list = document["shopping_list"]
+    with timeline_tags(user_id=document.get("user_id")):
+        pricing_details = price_shopping_list(shopping_list)
+    return UpdateOne(
+        {"_id": doc_id},
+        {"$set": {
+            "pricing_details": pricing_details,
+            "pricing_source_hash": hash_payload(shopping_list),
+            "priced_at": datetime.utcnow(),
+        }},
+    )
+
+
+def price_prediction_pipeline(workers=PRICING_WORKERS):
     """
-    Predicts prices for all shopping lists in the database.
+    Predicts prices for the shopping lists that are unpriced or changed since they were priced.
+
+    Each priced document stores a hash of its shopping list in `pricing_source_hash`;
+    only documents without pricing or whose `shopping_list_hash` differs are priced.
+    Items are priced from the local price catalog and only unknown items go to
+    price_agent. Documents are priced concurrently and the results are written
+    with a single bulk_write.
     """
-    all_documents_cursor = ingredient_collection.find({})
-    print(f"\nFound documents to process. Starting loop...")
+    query = {
+        "shopping_list": {"$type": "object"},
+        "$or": [
+            {"pricing_details": {"$exists": False}},
+            {"$expr": {"$ne": ["$shopping_list_hash", "$pricing_source_hash"]}},
+        ],
+    }
+    documents = [
+        doc for doc in ingredient_collection.find(query, {"user_id": 1, "shopping_list": 1, "pricing_source_hash": 1})
+        if hash_payload(doc["shopping_list"]) != doc.get("pricing_source_hash")
+    ]
+    print(f"\nFound {len(documents)} shopping list(s) to price. Starting...")
     print("-" * 40)
+    if not documents:
+        print("🎉 All shopping lists are already priced.")
+        return
 
-    for document in all_documents_cursor:
-        doc_id = document.get("_id")
-        print(f"Processing document with ID: {doc_id}")
-        if "shopping_list" in document and isinstance(document["shopping_list"], dict):
-            ingredients_to_price = document["shopping_list"]
-            input_data = clean_mongo_doc(ingredients_to_price)
-            response = price_agent.run(json.dumps(input_data, indent=2))
+    operations = []
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(documents)))) as executor:
+        futures = {executor.submit(run_in_context(_price_document), doc): doc["_id"] for doc in documents}
+        for future in as_completed(futures):
             try:
-                cleaned_response = response.content.strip()
-                if cleaned_response.startswith("```json"): cleaned_response = cleaned_response[7:]
-                if cleaned_response.endswith("```"): cleaned_response = cleaned_response[:-3]
-                pricing_details = json.loads(cleaned_response)
-                result = ingredient_collection.update_one(
-                    {"_id": doc_id}, {"$set": {"pricing_details": pricing_details}}
-                )
-                if result.modified_count > 0:
-                    print(f"✅ Successfully updated document ID: {doc_id}\n")
-                else:
-                    print(f"⚠️ Document {doc_id} was not updated.\n")
-            except json.JSONDecodeError:
-                print(f"❌ Error parsing AI response for doc {doc_id}. Skipping.")
-                print("   Raw response:", response.content, "\n")
+                operation = future.result()
             except Exception as e:
-                print(f"❌ An unexpected error occurred while updating doc {doc_id}: {e}\n")
-        else:
-            print(f"⚠️ Document {doc_id} does not have a 'shopping_list' field. Skipping.\n")
+                print(f"❌ An unexpected error occurred while pricing doc {futures[future]}: {e}")
+                continue
+            if operation:
+                operations.append(operation)
+
+    if operations:
+        try:
+            result = ingredient_collection.bulk_write(operations, ordered=False)
+            print(f"✅ Updated pricing for {result.modified_count} document(s).")
+        except Exception as e:
+            print(f"❌ Failed to write pricing results. Error: {e}")
     print("-" * 40)
-    print("🎉 All documents processed.")
+    print(f"🎉 Priced {len(operations)} of {len(documents)} shopping list(s).")
+
+
+def _run_user_stages(user_id, run_id):
+    """
+    Runs plan -> recipes -> shopping list for one user, skipping the stages that
+    are already checkpointed as done for this run. Returns "done", "skipped" or "failed".
+    """
+    checkpoint_filter = {"run_id": run_id, "user_id": user_id}
+    progress = pipeline_progress_collection.find_one(checkpoint_filter) or {}
+    if progress.get("status") == "done":
+        return "skipped"
+    stages_done = {stage for stage, info in progress.get("stages", {}).items() if info.get("status") == "done"}
+
+    meal_plan_doc = None
+    for stage in BATCH_STAGES:
+        if stage in stages_done:
+            continue
+        if stage == "meal_plan":
+            meal_plan_doc = generate_meal_plan_pipeline(user_id)
+            ok = meal_plan_doc is not None
+        else:
+            meal_plan_doc = meal_plan_doc or meal_plan_collection.find_one({"user_id": user_id})
+            if stage == "recipes":
+                ok = generate_recipes_pipeline(meal_plan_doc) is not None
+            else:
+                ok = generate_shopping_list_pipeline(meal_plan_doc) is not None
+
+        pipeline_progress_collection.update_one(
+            checkpoint_filter,
+            {"$set": {
+                f"stages.{stage}": {"status": "done" if ok else "failed", "finished_at": datetime.utcnow()},
+                "status": "running" if ok else "failed",
+                "updated_at": datetime.utcnow(),
+            }},
+            upsert=True,
+        )
+        if not ok:
+            return "failed"
+
+    pipeline_progress_collection.update_one(
+        checkpoint_filter, {"$set": {"status": "done", "updated_at": datetime.utcnow()}}, upsert=True
+    )
+    return "done"
+
+
+def _iter_user_ids(page_size=USER_PAGE_SIZE):
+    """
+    Yields every user _id in _id-ordered pages. Each page is read in full by its
+    own query, so no cursor stays open (and times out) while the workers are busy.
+    """
+    last_id = None
+    while True:
+        query = {"_id": {"$gt": last_id}} if last_id is not None else {}
+        page = [doc["_id"] for doc in user_collection.find(query, {"_id": 1}).sort("_id", 1).limit(page_size)]
+        if not page:
+            return
+        yield from page
+        last_id = page[-1]
+
+
+def run_batch(run_id=None, workers=PIPELINE_WORKERS):
+    """
+    Runs the per-user pipeline stages for every user through a worker pool.
+
+    User ids are read page by page instead of loaded into memory, and at most
+    `workers * 2` of them are queued at once. Progress is checkpointed in
+    Pipeline_Progress per user and per stage, so running again with the same
+    `run_id` resumes where a crashed run stopped.
+    """
+    run_id = run_id or f"nightly-{datetime.utcnow():%Y-%m-%d}"
+    print(f"🚀 Starting batch run '{run_id}' with {workers} worker(s)...")
+
+    counts = {"done": 0, "skipped": 0, "failed": 0}
+    counts_lock = threading.Lock()
+    slots = threading.BoundedSemaphore(workers * 2)
+
+    def on_done(future, user_id):
+        try:
+            outcome = future.result()
+        except Exception as e:
+            print(f"❌ Batch run failed for user {user_id}: {e}")
+            outcome = "failed"
+        with counts_lock:
+            counts[outcome] += 1
+        slots.release()
+
+    started = time.time()
+    with pipeline_run(run_id), ThreadPoolExecutor(max_workers=workers) as executor:
+        for user_id in _iter_user_ids():
+            slots.acquire()
+            # The worker's copy of the context tags its timeline events with the user
+            with timeline_tags(user_id=user_id):
+                future = executor.submit(run_in_context(_run_user_stages), user_id, run_id)
+            future.add_done_callback(lambda f, uid=user_id: on_done(f, uid))
+
+    print(f"🏁 Batch run '{run_id}' finished in {time.time() - started:.1f}s: {counts}")
+    return counts
 
 
 if __name__ == "__main__":
-    # 1. Generate meal plans for all users
-    all_users = list(user_collection.find({}))
-    for user in all_users:
-        meal_plan_doc = generate_meal_plan_pipeline(user["_id"])
-        if meal_plan_doc:
-            # 2. Generate recipes for the meal plan
-            generate_recipes_pipeline(meal_plan_doc)
-            # 3. Generate shopping list
-            generate_shopping_list_pipeline(meal_plan_doc)
-
-    # 4. Predict prices for all shopping lists
-    price_prediction_pipeline()
-
-    # 5. Upload images to Cloudinary
-    upload_images()
+    parser = argparse.ArgumentParser(description="Run the meal planner pipeline for all users.")
+    parser.add_argument("--workers", type=int, default=PIPELINE_WORKERS, help="Users processed in parallel")
+    parser.add_argument("--run-id", default=None, help="Checkpoint id; reuse it to resume a crashed run")
+    args = parser.parse_args()
+    ensure_indexes()
+    start_metrics_server()
+    run_id = args.run_id or f"nightly-{datetime.utcnow():%Y-%m-%d}"
+
+    # Every model call of steps 1-5 is recorded in the run's timeline
+    with pipeline_run(run_id):
+        # 1-3. Generate meal plans, recipes and shopping lists for all users
+        run_batch(run_id=run_id, workers=args.workers)
+
+        # Trim the shared dish image cache once the plans no longer need old entries
+        evict_dish_image_cache()
+        backfill_image_variants()
+        print(f"🖼️ Dish image cache: {get_image_cache_stats()}")
+
+        # 4. Predict prices for all shopping lists
+        load_price_catalog()
+        price_prediction_pipeline()
+
+        # 5. Upload images to Cloudinary
+        upload_images()
 
     # 6. Schedule WhatsApp notifications
-    schedule.every().day.at("07:00").do(send_meal_notifications)
-    schedule.every().day.at("12:00").do(send_meal_notifications)
-    schedule.every().day.at("20:00").do(send_meal_notifications)
+    schedule_meal_notifications()
 
     print("✅ WhatsApp notification system started...")
 
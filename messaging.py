@@ -0,0 +1,216 @@
+import os
+import time
+import random
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from twilio.rest import Client
+from twilio.http.http_client import TwilioHttpClient
+from twilio.base.exceptions import TwilioRestException
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# --- CONFIG ---
+TWILIO_SID = os.getenv("TWILIO_SID")
+TWILIO_AUTH = os.getenv("TWILIO_AUTH_TOKEN")
+TWILIO_WHATSAPP = os.getenv("TWILIO_WHATSAPP_NUMBER")
+# "twilio" sends for real; "fake" records messages locally (see FakeTransport)
+MESSAGING_TRANSPORT = os.getenv("MESSAGING_TRANSPORT", "twilio")
+# Size of the shared HTTP connection pool; keep it >= the number of send workers
+MESSAGING_POOL_SIZE = int(os.getenv("MESSAGING_POOL_SIZE", "32"))
+# Retries of a message rejected with HTTP 429, and the base backoff between them
+MESSAGING_MAX_RETRIES = int(os.getenv("MESSAGING_MAX_RETRIES", "3"))
+MESSAGING_BACKOFF_SECONDS = float(os.getenv("MESSAGING_BACKOFF_SECONDS", "1.0"))
+
+
+class RateLimitedError(Exception):
+    """The provider rejected a message with HTTP 429; it can be retried later."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TwilioTransport:
+    """
+    Sends WhatsApp messages through one long-lived Twilio client whose HTTP
+    session keeps a pool of `pool_size` connections, shared by all threads.
+    """
+
+    def __init__(self, sid=TWILIO_SID, auth_token=TWILIO_AUTH, sender=TWILIO_WHATSAPP, pool_size=MESSAGING_POOL_SIZE):
+        http_client = TwilioHttpClient(pool_connections=True)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        http_client.session.mount("https://", adapter)
+        self.client = Client(sid, auth_token, http_client=http_client)
+        self.sender = sender
+
+    def send(self, to, body, media_url=None):
+        try:
+            msg = self.client.messages.create(
+                from_=self.sender,
+                body=body,
+                to=to,
+                media_url=[media_url] if media_url else None
+            )
+        except TwilioRestException as e:
+            if e.status == 429:
+                raise RateLimitedError(str(e)) from e
+            raise
+        return msg.sid
+
+
+class FakeTransport:
+    """
+    Local stand-in for TwilioTransport for load tests. Records every message,
+    waits `latency` (+ up to `jitter`) seconds per send, and rejects sends with
+    RateLimitedError above `rate_limit` messages per second or with probability
+    `throttle_rate`.
+    """
+
+    def __init__(self, latency=0.2, jitter=0.05, rate_limit=None, throttle_rate=0.0, record=True):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.throttle_rate = throttle_rate
+        self.record = record
+        self.messages = []
+        self.stats = {"sent": 0, "throttled": 0}
+        self._lock = threading.Lock()
+        self._window = (0, 0)  # (second, sends in that second)
+
+    def _over_limit(self):
+        if not self.rate_limit:
+            return False
+        second = int(time.monotonic())
+        with self._lock:
+            window_second, count = self._window
+            count = count + 1 if window_second == second else 1
+            self._window = (second, count)
+        return count > self.rate_limit
+
+    def send(self, to, body, media_url=None):
+        time.sleep(self.latency + random.uniform(0, self.jitter))
+        if self._over_limit() or random.random() < self.throttle_rate:
+            with self._lock:
+                self.stats["throttled"] += 1
+            raise RateLimitedError("Too Many Requests (simulated)", retry_after=1.0)
+        with self._lock:
+            self.stats["sent"] += 1
+            sid = f"FAKE{self.stats['sent']:08d}"
+            if self.record:
+                self.messages.append({"sid": sid, "to": to, "body": body, "media_url": media_url})
+        return sid
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def get_transport():
+    """Returns the messaging transport shared by all sends of this process."""
+    global _transport
+    with _transport_lock:
+        if _transport is None:
+            _transport = FakeTransport() if MESSAGING_TRANSPORT == "fake" else TwilioTransport()
+        return _transport
+
+
+def set_transport(transport):
+    """Replaces the shared transport, e.g. with a FakeTransport in load tests."""
+    global _transport
+    with _transport_lock:
+        _transport = transport
+
+
+def send_with_retry(transport, to, body, media_url=None, max_retries=MESSAGING_MAX_RETRIES, backoff=MESSAGING_BACKOFF_SECONDS):
+    """Sends one message, retrying with exponential backoff while the provider answers 429."""
+    for attempt in range(max_retries + 1):
+        try:
+            return transport.send(to, body, media_url)
+        except RateLimitedError as e:
+            if attempt == max_retries:
+                raise
+            time.sleep(e.retry_after or backoff * 2 ** attempt * (1 + random.random() / 2))
+
+
+class RateLimiter:
+    """Thread-safe limiter that spaces calls to at most `rate` per second."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def fan_out(items, send_one, workers, rate_per_second=0, max_failures=100):
+    """
+    Calls `send_one(item)` for every item of an iterable (which may be a
+    streaming cursor) on a bounded worker pool, at most `rate_per_second` calls
+    started per second (0 = unlimited). Items are only pulled as workers free
+    up. Returns {"sent", "failed", "duration_seconds", "failures"} where
+    `failures` holds up to `max_failures` (item, error) pairs.
+    """
+    limiter = RateLimiter(rate_per_second)
+    result = {"sent": 0, "failed": 0, "failures": []}
+    lock = threading.Lock()
+    slots = threading.BoundedSemaphore(workers * 2)
+
+    def run(item):
+        try:
+            limiter.wait()
+            send_one(item)
+            outcome, error = "sent", None
+        except Exception as e:
+            outcome, error = "failed", str(e)
+        with lock:
+            result[outcome] += 1
+            if error and len(result["failures"]) < max_failures:
+                result["failures"].append((item, error))
+        slots.release()
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for item in items:
+            slots.acquire()
+            executor.submit(run, item)
+    result["duration_seconds"] = time.monotonic() - started
+    return result
+
+
+def benchmark(users, workers_options, latency, rate_limit, throttle_rate, rate_per_second):
+    """Sends `users` fake messages per pool size and prints the throughput of each."""
+    print(f"{'workers':>8} {'sent':>7} {'failed':>7} {'throttled':>10} {'seconds':>8} {'msg/s':>8}")
+    for workers in workers_options:
+        transport = FakeTransport(latency=latency, rate_limit=rate_limit, throttle_rate=throttle_rate, record=False)
+        result = fan_out(
+            range(users),
+            lambda i: send_with_retry(transport, f"whatsapp:+9100000{i:05d}", "Benchmark message"),
+            workers=workers,
+            rate_per_second=rate_per_second,
+        )
+        duration = result["duration_seconds"]
+        print(f"{workers:>8} {result['sent']:>7} {result['failed']:>7} {transport.stats['throttled']:>10} {duration:>8.1f} {result['sent'] / duration if duration else 0:>8.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark notification send throughput against the fake transport.")
+    parser.add_argument("--users", type=int, default=2000, help="Messages sent per run")
+    parser.add_argument("--workers", type=int, nargs="+", default=[4, 8, 16, 32], help="Pool sizes to compare")
+    parser.add_argument("--latency", type=float, default=0.2, help="Simulated seconds per send")
+    parser.add_argument("--rate-limit", type=int, default=None, help="Simulated provider limit (messages/second) before 429s")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Probability of a random 429")
+    parser.add_argument("--rate", type=float, default=0, help="Client-side rate limit (messages/second, 0 = none)")
+    args = parser.parse_args()
+    benchmark(args.users, args.workers, args.latency, args.rate_limit, args.throttle_rate, args.rate)
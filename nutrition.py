@@ -0,0 +1,362 @@
+import os
+import re
+import json
+import argparse
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from pymongo import UpdateOne
+from database import user_collection, nutrition_collection
+
+# (keywords, factor) checked in order; the first activity level that matches wins
+ACTIVITY_FACTORS = [
+    (("sedentary",), 1.2),
+    (("light",), 1.375),
+    (("moderate",), 1.55),
+    (("very",), 1.725),
+    (("extra", "athlete"), 1.9),
+]
+DEFAULT_ACTIVITY_FACTOR = 1.55
+# (keyword, multiplier of TDEE) checked in order
+GOAL_MULTIPLIERS = [
+    ("loss", 0.85),
+    ("gain", 1.15),
+]
+DEFAULT_GOAL_MULTIPLIER = 1.0
+PROTEIN_G_PER_KG = 2
+FAT_CALORIE_SHARE = 0.25
+# Share of the daily targets per meal slot, by meals per day
+MEAL_SLOT_SPLITS = {
+    1: [("main meal", 1.0)],
+    2: [("brunch", 0.5), ("dinner", 0.5)],
+    3: [("breakfast", 0.3), ("lunch", 0.4), ("dinner", 0.3)],
+    4: [("breakfast", 0.25), ("lunch", 0.35), ("snack", 0.1), ("dinner", 0.3)],
+    5: [("breakfast", 0.25), ("snack 1", 0.1), ("lunch", 0.3), ("snack 2", 0.1), ("dinner", 0.25)],
+    6: [("breakfast", 0.2), ("snack 1", 0.1), ("lunch", 0.25), ("snack 2", 0.1), ("dinner", 0.25), ("snack 3", 0.1)],
+}
+MIN_MAIN_MEAL_PROTEIN_G = 25
+DIET_TYPES = {"vegetarian": "Vegetarian", "vegan": "Vegan", "non-veg": "Non-vegetarian", "non-vegetarian": "Non-vegetarian"}
+
+# Users loaded, computed and written per round of the bulk job
+NUTRITION_BATCH_SIZE = int(os.getenv("NUTRITION_BATCH_SIZE", "5000"))
+
+USER_FIELDS = ["age", "gender", "weight", "height", "activity", "goal", "diet"]
+
+
+def activity_factor(activity):
+    activity = activity.lower()
+    for keywords, factor in ACTIVITY_FACTORS:
+        if any(keyword in activity for keyword in keywords):
+            return factor
+    return DEFAULT_ACTIVITY_FACTOR
+
+
+def goal_multiplier(goal):
+    goal = goal.lower()
+    for keyword, multiplier in GOAL_MULTIPLIERS:
+        if keyword in goal:
+            return multiplier
+    return DEFAULT_GOAL_MULTIPLIER
+
+
+def _vitamins(diet, gender):
+    vitamins = []
+    if "vegetarian" in diet.lower() or "vegan" in diet.lower():
+        vitamins += ["Vitamin B12", "Iron", "Omega-3"]
+    if gender.lower().startswith("f"):
+        vitamins.append("Iron")
+    vitamins.append("Vitamin D")
+    return list(dict.fromkeys(vitamins))
+
+
+def basal_metabolic_rate(age, gender, weight, height):
+    """Mifflin-St Jeor BMR in kcal/day."""
+    if gender.lower().startswith("m"):
+        return 10 * weight + 6.25 * height - 5 * age + 5
+    return 10 * weight + 6.25 * height - 5 * age - 161
+
+
+def compute_nutrition(age, gender, weight, height, activity, goal, diet=""):
+    """Science-based nutrition targets (Mifflin-St Jeor BMR, activity factor, goal multiplier) for one person."""
+    bmr = basal_metabolic_rate(age, gender, weight, height)
+
+    activity = activity.lower()
+    goal = goal.lower()
+    calories = bmr * activity_factor(activity) * goal_multiplier(goal)
+
+    protein_g = weight * PROTEIN_G_PER_KG
+    protein_cal = protein_g * 4
+    fat_cal = calories * FAT_CALORIE_SHARE
+    fat_g = fat_cal / 9
+    carbs_cal = calories - (protein_cal + fat_cal)
+    carbs_g = carbs_cal / 4
+
+    return {
+        "calories": round(calories),
+        "protein_g": round(protein_g),
+        "carbs_g": round(carbs_g),
+        "fat_g": round(fat_g),
+        "vitamins": _vitamins(diet, gender),
+        "analysis": f"Based on {age}y, {weight}kg, {height}cm, {activity}, and goal '{goal}', "
+        f"daily needs are {round(calories)} kcal with "
+        f"{round(protein_g)}g protein, {round(carbs_g)}g carbs, and {round(fat_g)}g fat.",
+    }
+
+
+def _split_list(text):
+    """Turns a free-text form field ("peanut, gluten\nmilk") into a list of items."""
+    if isinstance(text, (list, tuple)):
+        return [str(item).strip() for item in text if str(item).strip()]
+    return [item.strip() for item in re.split(r"[,;\n]+", str(text or "")) if item.strip()]
+
+
+def build_report_base(profile):
+    """
+    Builds every deterministic field of the nutrition report from the profile
+    form: nutrition_summary, meal_targets, diet_constraints, preferences,
+    meal_planner_instructions, warnings and the micronutrients to focus on.
+    Only human_summary, the micronutrient reasons and the substitutions are left
+    for the nutrition prose agent (see merge_report_prose).
+    """
+    age, weight, height = float(profile["age"]), float(profile["weight"]), float(profile["height"])
+    gender, activity, goal = str(profile.get("gender", "")), str(profile.get("activity", "")), str(profile.get("goal", ""))
+    diet = str(profile.get("diet", ""))
+    targets = compute_nutrition(age, gender, weight, height, activity, goal, diet)
+
+    meals_per_day = min(max(int(profile.get("meals_per_day") or 3), min(MEAL_SLOT_SPLITS)), max(MEAL_SLOT_SPLITS))
+    per_meal = []
+    for slot, share in MEAL_SLOT_SPLITS[meals_per_day]:
+        meal = {field: round(targets[field] * share) for field in ["calories", "protein_g", "carbs_g", "fat_g"]}
+        main_meal = not slot.startswith("snack")
+        if main_meal and meals_per_day > 2:
+            meal["notes"] = f"Keep protein >= {MIN_MAIN_MEAL_PROTEIN_G}g"
+        per_meal.append({"slot": slot, **meal})
+
+    avoid = _split_list(profile.get("allergies"))
+    likes = _split_list(profile.get("likes"))
+    cuisines = _split_list(profile.get("cuisine"))
+    budget = profile.get("budget")
+
+    instructions = [
+        f"Plan {meals_per_day} meals per day close to {targets['calories']} kcal and {targets['protein_g']}g protein in total",
+        "Do not repeat the same main protein more than twice a week",
+    ]
+    if avoid:
+        instructions.append(f"Do not include {', '.join(avoid)} anywhere (user allergy/dislike)")
+    if cuisines:
+        instructions.append(f"Only use {', '.join(cuisines)} cuisine")
+    if budget:
+        instructions.append(f"Keep the weekly groceries within ₹{budget}")
+
+    warnings = []
+    bmr = basal_metabolic_rate(age, gender, weight, height)
+    if targets["calories"] < bmr:
+        warnings.append({"type": "low_calorie", "message": "Target calories below estimated BMR", "severity": "medium"})
+    bmi = weight / (height / 100) ** 2 if height else 0
+    if bmi and (bmi < 17 or bmi > 35):
+        warnings.append({"type": "extreme_bmi", "message": f"BMI of {bmi:.1f} is outside the healthy range; consult a doctor", "severity": "high"})
+
+    return {
+        "nutrition_summary": {
+            "calories": targets["calories"],
+            "protein_g": targets["protein_g"],
+            "carbs_g": targets["carbs_g"],
+            "fat_g": targets["fat_g"],
+            "protein_g_per_kg": float(PROTEIN_G_PER_KG),
+        },
+        "micronutrients": [{"name": name, "reason": None, "recommendation": None} for name in targets["vitamins"]],
+        "meal_targets": {
+            "meals_per_day": meals_per_day,
+            "per_meal": per_meal,
+            "snack_guidelines": "Snacks fill the gap to the daily protein and calorie targets; prefer whole foods over packaged snacks.",
+        },
+        "diet_constraints": {
+            "diet_type": DIET_TYPES.get(diet.lower(), diet or "Other"),
+            "allergies": avoid,
+            "dislikes": avoid,
+            "forbidden_ingredients": avoid,
+        },
+        "preferences": {
+            "likes": likes,
+            "cuisines": cuisines,
+            "budget_weekly_inr": budget,
+        },
+        "substitutions": {},
+        "meal_planner_instructions": instructions,
+        "warnings": warnings,
+        "human_summary": targets["analysis"],
+    }
+
+
+def merge_report_prose(base, prose):
+    """
+    Adds the nutrition prose agent's output ({"human_summary", "micronutrients",
+    "substitutions"}) to a report from build_report_base. Deterministic fields
+    are never overwritten; missing prose keeps the base values.
+    """
+    report = dict(base)
+    if not isinstance(prose, dict):
+        return report
+    if isinstance(prose.get("human_summary"), str) and prose["human_summary"].strip():
+        report["human_summary"] = prose["human_summary"].strip()
+    if isinstance(prose.get("substitutions"), dict):
+        report["substitutions"] = prose["substitutions"]
+
+    reasons = {
+        str(item.get("name", "")).lower(): item
+        for item in prose.get("micronutrients") or [] if isinstance(item, dict) and item.get("name")
+    }
+    micronutrients = []
+    for item in base["micronutrients"]:
+        detail = reasons.pop(item["name"].lower(), {})
+        micronutrients.append({"name": item["name"], "reason": detail.get("reason"), "recommendation": detail.get("recommendation")})
+    # Extra micronutrients the agent found relevant are kept after the computed ones
+    micronutrients += [
+        {"name": item["name"], "reason": item.get("reason"), "recommendation": item.get("recommendation")}
+        for item in reasons.values()
+    ]
+    report["micronutrients"] = micronutrients
+    return report
+
+
+def report_prose_request(profile, base):
+    """Returns the compact message sent to the nutrition prose agent."""
+    return json.dumps({
+        "profile": {field: profile.get(field) for field in ["name", "age", "gender", "weight", "height", "activity", "goal", "diet", "allergies", "likes", "cuisine", "budget"]},
+        "daily_targets": base["nutrition_summary"],
+        "meals_per_day": base["meal_targets"]["meals_per_day"],
+        "micronutrients": [item["name"] for item in base["micronutrients"]],
+        "avoid": base["diet_constraints"]["allergies"],
+    }, default=str)
+
+
+def _keyword_select(text, rules, default):
+    """Vectorized first-match lookup of (keywords, value) rules over a lowercase string Series."""
+    conditions = [
+        np.logical_or.reduce([text.str.contains(keyword, regex=False).to_numpy() for keyword in keywords])
+        for keywords, _ in rules
+    ]
+    return np.select(conditions, [value for _, value in rules], default=default)
+
+
+def compute_nutrition_batch(people):
+    """
+    Computes the fields of `compute_nutrition` for every row of a DataFrame with
+    the columns age, gender, weight, height, activity, goal and diet in one
+    vectorized pass. Returns a DataFrame with the same index and the columns
+    calories, protein_g, carbs_g, fat_g, protein_g_per_kg, vitamins and
+    analysis. Rows with a missing or non-numeric age, weight or height get NaN
+    targets.
+    """
+    age = pd.to_numeric(people["age"], errors="coerce")
+    weight = pd.to_numeric(people["weight"], errors="coerce")
+    height = pd.to_numeric(people["height"], errors="coerce")
+    gender = people["gender"].fillna("").astype(str).str.lower()
+    activity = people["activity"].fillna("").astype(str).str.lower()
+    goal = people["goal"].fillna("").astype(str).str.lower()
+    diet = people.get("diet", pd.Series("", index=people.index)).fillna("").astype(str).str.lower()
+
+    bmr = 10 * weight + 6.25 * height - 5 * age + np.where(gender.str.startswith("m"), 5, -161)
+    factors = _keyword_select(activity, ACTIVITY_FACTORS, DEFAULT_ACTIVITY_FACTOR)
+    multipliers = _keyword_select(goal, [((keyword,), value) for keyword, value in GOAL_MULTIPLIERS], DEFAULT_GOAL_MULTIPLIER)
+    calories = bmr * factors * multipliers
+
+    protein_g = weight * PROTEIN_G_PER_KG
+    fat_g = calories * FAT_CALORIE_SHARE / 9
+    carbs_g = (calories - protein_g * 4 - calories * FAT_CALORIE_SHARE) / 4
+
+    result = pd.DataFrame(
+        {
+            "calories": calories.round(),
+            "protein_g": protein_g.round(),
+            "carbs_g": carbs_g.round(),
+            "fat_g": fat_g.round(),
+            "protein_g_per_kg": float(PROTEIN_G_PER_KG),
+        },
+        index=people.index,
+    )
+
+    plant_based = (diet.str.contains("vegetarian", regex=False) | diet.str.contains("vegan", regex=False)).to_numpy()
+    female = gender.str.startswith("f").to_numpy()
+    # Same lists as _vitamins(), which only depend on these two flags
+    result["vitamins"] = [_vitamins("vegan" if plant else "", "f" if fem else "") for plant, fem in zip(plant_based, female)]
+
+    grams = {field: result[field].astype("Int64").astype(str) for field in ["calories", "protein_g", "carbs_g", "fat_g"]}
+    result["analysis"] = (
+        "Based on " + people["age"].astype(str) + "y, " + people["weight"].astype(str) + "kg, "
+        + people["height"].astype(str) + "cm, " + activity + ", and goal '" + goal + "', daily needs are "
+        + grams["calories"] + " kcal with " + grams["protein_g"] + "g protein, "
+        + grams["carbs_g"] + "g carbs, and " + grams["fat_g"] + "g fat."
+    )
+    return result
+
+
+def _summary_updates(users, reports):
+    """Returns UpdateOne operations for the reports whose stored summary differs from the recomputed one."""
+    targets = compute_nutrition_batch(users).dropna(subset=["calories", "protein_g", "carbs_g", "fat_g"])
+    now = datetime.utcnow()
+    operations = []
+    for user_id, row in zip(users.loc[targets.index, "_id"], targets.itertuples(index=False)):
+        if user_id not in reports:
+            continue
+        summary = {
+            "calories": int(row.calories),
+            "protein_g": int(row.protein_g),
+            "carbs_g": int(row.carbs_g),
+            "fat_g": int(row.fat_g),
+            "protein_g_per_kg": row.protein_g_per_kg,
+        }
+        stored = reports[user_id]
+        if all(stored.get(field) == value for field, value in summary.items()):
+            continue
+        operations.append(UpdateOne(
+            {"user_id": user_id},
+            {"$set": {
+                **{f"report.nutrition_summary.{field}": value for field, value in summary.items()},
+                "report.nutrition_summary_recomputed_at": now,
+            }},
+        ))
+    return operations
+
+
+def recompute_nutrition_summaries(batch_size=NUTRITION_BATCH_SIZE, dry_run=False):
+    """
+    Recomputes `report.nutrition_summary` of every Nutrition_Reports document from
+    its user's profile with the current ACTIVITY_FACTORS and GOAL_MULTIPLIERS,
+    without calling the nutrition agent.
+
+    Users are processed in batches of `batch_size`: one query for the profiles,
+    one for their reports, one vectorized computation and one bulk_write of the
+    summaries that changed. Other fields of the report are left as they are.
+    Returns {"users", "changed", "written"}.
+    """
+    totals = {"users": 0, "changed": 0, "written": 0}
+    cursor = user_collection.find({}, {field: 1 for field in USER_FIELDS}, batch_size=batch_size)
+    while True:
+        docs = [doc for _, doc in zip(range(batch_size), cursor)]
+        if not docs:
+            break
+        users = pd.DataFrame(docs).reindex(columns=["_id"] + USER_FIELDS)
+        reports = {
+            doc["user_id"]: doc.get("report", {}).get("nutrition_summary") or {}
+            for doc in nutrition_collection.find(
+                {"user_id": {"$in": list(users["_id"])}},
+                {"user_id": 1, "report.nutrition_summary": 1},
+            )
+        }
+        operations = _summary_updates(users, reports)
+        totals["users"] += len(docs)
+        totals["changed"] += len(operations)
+        if operations and not dry_run:
+            result = nutrition_collection.bulk_write(operations, ordered=False)
+            totals["written"] += result.modified_count
+    print(f"🥗 Nutrition summaries recomputed: {totals}{' (dry run)' if dry_run else ''}")
+    return totals
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recompute the nutrition targets of all users without the nutrition agent.")
+    parser.add_argument("--batch-size", type=int, default=NUTRITION_BATCH_SIZE, help="Users per query and bulk write")
+    parser.add_argument("--dry-run", action="store_true", help="Only count the summaries that would change")
+    args = parser.parse_args()
+    recompute_nutrition_summaries(batch_size=args.batch_size, dry_run=args.dry_run)
@@ -0,0 +1,151 @@
+import os
+import re
+import json
+import time
+import threading
+from datetime import datetime
+import pandas as pd
+from pymongo import UpdateOne
+from agents import price_agent
+from database import price_catalog_collection
+from utils import extract_json
+
+# How often the in-process price table is reloaded from Price_Catalog
+PRICE_CATALOG_REFRESH_SECONDS = int(os.getenv("PRICE_CATALOG_REFRESH_SECONDS", "600"))
+
+_catalog = pd.Series(dtype="float64")
+_catalog_loaded_at = 0.0
+_catalog_lock = threading.Lock()
+
+
+def canonical_ingredient_names(names):
+    """Maps a Series of ingredient names to canonical catalog keys ("Tomatoes (ripe)" -> "tomato")."""
+    return (
+        names.astype(str)
+        .str.lower()
+        .str.replace(r"\(.*?\)", " ", regex=True)
+        .str.replace(r"[^a-z0-9&\s]", " ", regex=True)
+        .str.replace(r"\s+", " ", regex=True)
+        .str.strip()
+        .str.replace(r"oes$", "o", regex=True)
+        .str.replace(r"(?<=\w{3})(?<![su])s$", "", regex=True)
+    )
+
+
+def canonical_ingredient(name):
+    """Returns the canonical catalog key of a single ingredient name."""
+    return canonical_ingredient_names(pd.Series([name])).iloc[0]
+
+
+def load_price_catalog(force=False):
+    """Loads Price_Catalog into the in-process lookup table (canonical name -> price)."""
+    global _catalog, _catalog_loaded_at
+    with _catalog_lock:
+        if not force and _catalog_loaded_at and time.time() - _catalog_loaded_at < PRICE_CATALOG_REFRESH_SECONDS:
+            return _catalog
+        docs = list(price_catalog_collection.find({}, {"price": 1}))
+        _catalog = pd.Series({doc["_id"]: float(doc["price"]) for doc in docs}, dtype="float64")
+        _catalog_loaded_at = time.time()
+        print(f"📒 Loaded {len(_catalog)} item(s) from the price catalog.")
+        return _catalog
+
+
+def _update_catalog(prices, display_names):
+    """Writes newly learned prices to Price_Catalog and the in-process table."""
+    global _catalog
+    if not prices:
+        return
+    now = datetime.utcnow()
+    operations = [
+        UpdateOne(
+            {"_id": key},
+            {"$set": {"name": display_names.get(key, key), "price": price, "source": "price_agent", "updated_at": now}},
+            upsert=True,
+        )
+        for key, price in prices.items()
+    ]
+    price_catalog_collection.bulk_write(operations, ordered=False)
+    with _catalog_lock:
+        _catalog = pd.concat([_catalog.drop(list(prices), errors="ignore"), pd.Series(prices, dtype="float64")])
+
+
+def _parse_price(value):
+    """Returns a price given as a number or as text such as "₹1,200", or None."""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = re.search(r"\d[\d,]*(?:\.\d+)?", value) if isinstance(value, str) else None
+    return float(match.group().replace(",", "")) if match else None
+
+
+def _ask_price_agent(unknown_items):
+    """Asks price_agent for the prices of {category: [names]}; returns {canonical name: price}."""
+    response = price_agent.run(json.dumps(unknown_items, indent=2))
+    pricing_details = extract_json(response.content)
+
+    returned = [
+        (item.get("name"), item.get("price"))
+        for details in pricing_details.values() if isinstance(details, dict)
+        for item in details.get("items", []) if isinstance(item, dict)
+    ]
+    returned = [(name, _parse_price(price)) for name, price in returned if name]
+    returned = [(name, price) for name, price in returned if price is not None]
+    if not returned:
+        return {}
+    names = pd.Series([name for name, _ in returned])
+    return dict(zip(canonical_ingredient_names(names), (float(price) for _, price in returned)))
+
+
+def _as_number(value):
+    value = round(float(value), 2)
+    return int(value) if value.is_integer() else value
+
+
+def price_shopping_list(shopping_list):
+    """
+    Prices a categorized shopping list ({category: [item names]}).
+
+    Known items are priced from the local price catalog in one vectorized
+    lookup. Only unknown items are sent to price_agent, and their prices are
+    written back to the catalog. Category totals and `Grand_Total` are computed
+    locally. Returns the same structure price_agent used to return. Raises when
+    price_agent fails or leaves any unknown item without a price, so callers
+    never store a list with unpriced items.
+    """
+    rows = [
+        (category, str(name))
+        for category, names in shopping_list.items() if isinstance(names, list)
+        for name in names if name
+    ]
+    if not rows:
+        return {"Grand_Total": 0}
+
+    items = pd.DataFrame(rows, columns=["category", "name"])
+    items["key"] = canonical_ingredient_names(items["name"])
+    items = items.drop_duplicates(subset=["category", "key"])
+    items["price"] = items["key"].map(load_price_catalog())
+
+    unknown = items[items["price"].isna()]
+    if not unknown.empty:
+        print(f"🔎 Asking price agent for {len(unknown)} unknown item(s)...")
+        request = unknown.groupby("category", sort=False)["name"].apply(list).to_dict()
+        # A failure propagates so the list is not saved with the unknown items at 0 and is priced again later
+        learned = _ask_price_agent(request)
+        learned = {key: price for key, price in learned.items() if key in set(unknown["key"])}
+        _update_catalog(learned, dict(zip(unknown["key"], unknown["name"])))
+        items.loc[items["price"].isna(), "price"] = items["key"].map(learned)
+        missing = items.loc[items["price"].isna(), "name"]
+        if not missing.empty:
+            raise ValueError(f"price_agent returned no price for {len(missing)} item(s): {', '.join(missing)}")
+
+    totals = items.groupby("category", sort=False)["price"].sum()
+
+    pricing_details = {}
+    for category, group in items.groupby("category", sort=False):
+        pricing_details[category] = {
+            "items": [{"name": name, "price": _as_number(price)} for name, price in zip(group["name"], group["price"])],
+            "total_price": _as_number(totals[category]),
+        }
+    pricing_details["Grand_Total"] = _as_number(totals.sum())
+    return pricing_details
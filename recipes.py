@@ -0,0 +1,203 @@
+import os
+import json
+from datetime import datetime, timedelta
+from agents import recipe_agent, recipe_batch_agent, stream_agent_content
+from database import recipe_cache_collection, record_cache_stats, get_cache_stats
+from utils import clean_mongo_doc, normalize_dish_name, extract_json, parse_json_stream
+from instrumentation import record_retry
+
+# Bump when the recipe prompt or format changes so old cached recipes are ignored
+RECIPE_CACHE_VERSION = 1
+RECIPE_CACHE_TTL_DAYS = int(os.getenv("RECIPE_CACHE_TTL_DAYS", "30"))
+# Limits for one batched recipe request: number of dishes and size of the JSON input
+RECIPE_BATCH_SIZE = int(os.getenv("RECIPE_BATCH_SIZE", "8"))
+RECIPE_BATCH_MAX_CHARS = int(os.getenv("RECIPE_BATCH_MAX_CHARS", "12000"))
+
+CACHE_NAME = "recipes"
+
+
+def get_cached_recipe(dish_name):
+    """Returns the shared recipe for a dish, or None when it is missing or stale."""
+    # The normalized dish name is the _id, so lookups use the _id index
+    doc = recipe_cache_collection.find_one(
+        {
+            "_id": normalize_dish_name(dish_name),
+            "version": RECIPE_CACHE_VERSION,
+            "expires_at": {"$gt": datetime.utcnow()},
+        },
+        {"recipe": 1},
+    )
+    return doc["recipe"] if doc else None
+
+
+def store_recipe(dish_name, recipe):
+    """Saves a generated recipe in the shared cache; malformed recipes are never shared."""
+    if not _is_valid_recipe(recipe) or "error" in recipe:
+        return
+    now = datetime.utcnow()
+    recipe_cache_collection.update_one(
+        {"_id": normalize_dish_name(dish_name)},
+        {"$set": {
+            "dish_name": dish_name,
+            "recipe": recipe,
+            "version": RECIPE_CACHE_VERSION,
+            "updated_at": now,
+            "expires_at": now + timedelta(days=RECIPE_CACHE_TTL_DAYS),
+        }},
+        upsert=True,
+    )
+
+
+def _is_valid_recipe(recipe):
+    return isinstance(recipe, dict) and isinstance(recipe.get("steps"), dict) and bool(recipe["steps"])
+
+
+def _generate_single_recipe(dish_name, meal_details):
+    cleaned_meal_details = clean_mongo_doc({dish_name: meal_details})
+    response = recipe_agent.run(json.dumps(cleaned_meal_details, indent=2))
+    recipe = extract_json(response.content)
+    if not _is_valid_recipe(recipe):
+        raise ValueError(f"recipe_agent returned no steps for {dish_name}")
+    store_recipe(dish_name, recipe)
+    return recipe
+
+
+def generate_recipe(dish_name, meal_details):
+    """Returns the recipe for a dish from the shared cache, calling recipe_agent only on a miss."""
+    recipe = get_cached_recipe(dish_name)
+    if recipe is not None:
+        record_cache_stats(CACHE_NAME, hits=1)
+        return recipe
+
+    record_cache_stats(CACHE_NAME, misses=1)
+    return _generate_single_recipe(dish_name, meal_details)
+
+
+def _chunk_dishes(dishes, max_dishes=RECIPE_BATCH_SIZE, max_chars=RECIPE_BATCH_MAX_CHARS):
+    """Splits {dish_name: meal_details} into chunks that respect the batch limits."""
+    chunk, chunk_chars = {}, 0
+    for dish_name, meal_details in dishes.items():
+        size = len(json.dumps(clean_mongo_doc({dish_name: meal_details})))
+        if chunk and (len(chunk) >= max_dishes or chunk_chars + size > max_chars):
+            yield chunk
+            chunk, chunk_chars = {}, 0
+        chunk[dish_name] = meal_details
+        chunk_chars += size
+    if chunk:
+        yield chunk
+
+
+def _run_batch_request(chunk, on_recipe=None):
+    message = json.dumps(clean_mongo_doc(chunk), indent=2)
+    if not on_recipe:
+        response = recipe_batch_agent.run(message)
+        return extract_json(response.content)
+
+    def on_object(path, value):
+        # Each top-level entry of the response is one dish's recipe
+        if len(path) == 1 and _is_valid_recipe(value):
+            on_recipe(path[0], value)
+
+    return parse_json_stream(stream_agent_content(recipe_batch_agent, message), on_object=on_object, event_depth=1)
+
+
+def generate_recipes_batch(dishes, on_recipe=None):
+    """
+    Generates recipes for {dish_name: meal_details} with one recipe_batch_agent
+    call per chunk of dishes.
+
+    Returns `(recipes, failures)`, both keyed by dish name. Only the dishes whose
+    entries are missing or fail to parse are retried, one by one, with recipe_agent.
+    With `on_recipe(dish_name, recipe)` the response is streamed and each recipe
+    is reported as soon as it is complete.
+    """
+    recipes, failures = {}, {}
+    for chunk in _chunk_dishes(dishes):
+        try:
+            batch_result = _run_batch_request(chunk, on_recipe)
+            if not isinstance(batch_result, dict):
+                raise ValueError("Batch response is not a JSON object")
+        except Exception as e:
+            print(f"⚠️ Batch recipe request failed ({e}); retrying {len(chunk)} dish(es) one by one.")
+            batch_result = {}
+
+        # Match returned keys on the normalized name in case the model respelled them
+        returned = {normalize_dish_name(key): value for key, value in batch_result.items()}
+        for dish_name, meal_details in chunk.items():
+            recipe = returned.get(normalize_dish_name(dish_name))
+            if _is_valid_recipe(recipe):
+                store_recipe(dish_name, recipe)
+                recipes[dish_name] = recipe
+                continue
+            record_retry("recipe_batch_agent")
+            try:
+                recipes[dish_name] = _generate_single_recipe(dish_name, meal_details)
+            except Exception as e:
+                failures[dish_name] = str(e)
+                continue
+            if on_recipe:
+                on_recipe(dish_name, recipes[dish_name])
+    return recipes, failures
+
+
+def fill_plan_recipes(meal_plan, on_progress=None, batch=True, on_recipe=None):
+    """
+    Adds a recipe to every dish of `meal_plan` that does not have one yet.
+
+    Updates `meal_plan[day][meal]["recipe"]` in place and returns a dict that
+    maps (day, meal_key) of the dishes that failed to the error message.
+    `on_progress(day, dish_name)` is called before each dish is processed.
+
+    Dishes found in the shared cache are filled directly. With `batch=True` the
+    remaining dishes are generated with one request per chunk instead of one
+    request per dish. `on_recipe(dish_name, recipe)` streams the batched
+    responses and reports every recipe as soon as it is available.
+    """
+    failures = {}
+    pending = {}
+    for day, meals in meal_plan.items():
+        if not isinstance(meals, dict): continue
+        for meal_key, meal_details in meals.items():
+            if not isinstance(meal_details, dict): continue
+            dish_name = meal_details.get("dish_name")
+            if not dish_name or "recipe" in meal_details: continue
+            if on_progress:
+                on_progress(day, dish_name)
+            if not batch:
+                try:
+                    meal_details["recipe"] = generate_recipe(dish_name, meal_details)
+                except Exception as e:
+                    failures[(day, meal_key)] = str(e)
+                    continue
+                if on_recipe:
+                    on_recipe(dish_name, meal_details["recipe"])
+                continue
+
+            recipe = get_cached_recipe(dish_name)
+            if recipe is not None:
+                record_cache_stats(CACHE_NAME, hits=1)
+                meal_details["recipe"] = recipe
+                if on_recipe:
+                    on_recipe(dish_name, recipe)
+            else:
+                pending.setdefault(normalize_dish_name(dish_name), []).append((day, meal_key, dish_name, meal_details))
+
+    if not pending:
+        return failures
+
+    record_cache_stats(CACHE_NAME, misses=len(pending))
+    dishes = {entries[0][2]: entries[0][3] for entries in pending.values()}
+    recipes, batch_failures = generate_recipes_batch(dishes, on_recipe=on_recipe)
+    for entries in pending.values():
+        dish_name = entries[0][2]
+        for day, meal_key, _, meal_details in entries:
+            if dish_name in recipes:
+                meal_details["recipe"] = recipes[dish_name]
+            else:
+                failures[(day, meal_key)] = batch_failures.get(dish_name, "Recipe was not generated")
+    return failures
+
+
+def get_recipe_cache_stats():
+    """Returns hits, misses and hit rate of the shared recipe cache."""
+    return get_cache_stats(CACHE_NAME)
@@ -2,33 +2,83 @@ import streamlit as st
 import pandas as pd # Import pandas for the new UI
 from pymongo import MongoClient
 import os
-import re
 import json
 from dotenv import load_dotenv
-from PIL import Image
-from io import BytesIO
 
 # --- Agent and DB Imports ---
-from agents import nutrition_agent, meal_agent, recipe_agent, shopping_agent, price_agent
+from agents import nutrition_agent, nutrition_prose_agent, meal_agent, shopping_agent, stream_agent_content
 from datetime import datetime, timezone
 from database import (
     user_collection,
     nutrition_collection,
     meal_plan_collection,
     ingredient_collection,
-    get_user_and_nutrition,
-    save_image_to_gridfs,
-    fs,
 )
-from utils import clean_mongo_doc, generate_dish_image_bytes
-from upload_images import upload_images_and_get_urls # New import
-from whatsapp_message import send_whatsapp_message # New import
-from charts import generate_and_save_all_charts # New Import
+from data_access import (
+    get_user_data,
+    get_user,
+    invalidate_user_data,
+    get_gridfs_files,
+    get_profile_view,
+    get_chart,
+    begin_rerun,
+    report_query_stats,
+)
+from utils import clean_mongo_doc, hash_payload, extract_json, parse_json_stream
+from dish_images import generate_plan_images, image_variant_for_width
+from recipes import fill_plan_recipes
+from nutrition import build_report_base, report_prose_request, merge_report_prose
+from pricing import price_shopping_list
+from upload_images import upload_plan_images
+from whatsapp_message import send_whatsapp_message, store_plan_teasers, stored_teaser
+from charts import generate_and_save_all_charts, figure_from_spec
 import streamlit.components.v1 as components
 
 load_dotenv()
 
+# Render agent responses while they are generated instead of after they finish
+STREAM_AGENT_OUTPUT = os.getenv("STREAM_AGENT_OUTPUT", "true").lower() == "true"
+# Build the nutrition report's numbers locally and ask the agent only for the prose
+NUTRITION_FAST_PATH = os.getenv("NUTRITION_FAST_PATH", "true").lower() == "true"
+# Width (CSS px) of a row of meal cards in the wide layout and the pixel density images are served for;
+# the meal cards read the smallest image variant that fills one card. MEAL_CARD_IMAGE_VARIANT forces a variant.
+MEAL_CARD_ROW_WIDTH = int(os.getenv("MEAL_CARD_ROW_WIDTH", "1200"))
+MEAL_CARD_PIXEL_DENSITY = float(os.getenv("MEAL_CARD_PIXEL_DENSITY", "1.5"))
+MEAL_CARD_IMAGE_VARIANT = os.getenv("MEAL_CARD_IMAGE_VARIANT")
+
+
+def meal_card_image_variant(meal_plan_json):
+    """Returns the image variant for a plan's meal cards, sized for its widest card (the day with the fewest meals)."""
+    if MEAL_CARD_IMAGE_VARIANT:
+        return MEAL_CARD_IMAGE_VARIANT
+    columns = min(
+        (sum(isinstance(meal, dict) for meal in meals.values()) for meals in meal_plan_json.values() if isinstance(meals, dict)),
+        default=1,
+    )
+    return image_variant_for_width(MEAL_CARD_ROW_WIDTH / max(columns, 1) * MEAL_CARD_PIXEL_DENSITY)
+
+
+def run_agent_json(agent, message, on_object=None, event_depth=0, raw=None):
+    """
+    Runs an agent and returns its JSON output. In streaming mode `on_object(path, value)`
+    is called for nested values as soon as they close. The raw text is appended to `raw`.
+    """
+    raw = raw if raw is not None else []
+    if not STREAM_AGENT_OUTPUT:
+        response = agent.run(message)
+        raw.append(response.content or "")
+        return extract_json(response.content)
+
+    def chunks():
+        for chunk in stream_agent_content(agent, message):
+            raw.append(chunk)
+            yield chunk
+
+    return parse_json_stream(chunks(), on_object=on_object, event_depth=event_depth)
+
+
 st.set_page_config(layout="wide")
+begin_rerun()
 st.title("🍽️ AI Personalized Meal Planner")
 
 # --- CSS STYLES ---
@@ -73,7 +123,7 @@ with tab1:
     st.header("Create or Update Your Nutrition Profile")
     phone_input = st.text_input("Enter your phone number to continue")
     if phone_input:
-        existing_user = user_collection.find_one({"phone": phone_input})
+        existing_user = get_user(phone_input)
         if existing_user: st.success(f"Welcome back {existing_user.get('name', '')}! Your details are pre-filled below.")
         else: st.info("New user detected. Please fill in your details.")
         with st.form("user_form"):
@@ -96,11 +146,31 @@ with tab1:
                 user_data = { "name": name, "phone": phone_input, "goal": goal, "meals_per_day": meals_per_day, "diet": diet, "allergies": allergies, "likes": likes, "cuisine": cuisine, "budget": budget, "age": age, "weight": weight, "height": height, "gender": gender, "activity": activity }
                 if existing_user: user_collection.update_one({"_id": existing_user["_id"]}, {"$set": user_data}); user_id = existing_user["_id"]
                 else: result = user_collection.insert_one(user_data); user_id = result.inserted_id
+                invalidate_user_data(phone_input)
                 st.success("✅ User profile saved!")
-                response = nutrition_agent.run(str(user_data))
+                raw_output = []
+                live_summary = st.empty()
+
+                def show_early_summary(path, value):
+                    if path == ("nutrition_summary",) and isinstance(value, dict):
+                        live_summary.info(f"⚡ Daily targets: {value.get('calories', 'N/A')} kcal · {value.get('protein_g', 'N/A')} g protein · {value.get('carbs_g', 'N/A')} g carbs · {value.get('fat_g', 'N/A')} g fat. Writing the rest of your report...")
+
                 try:
-                    match = re.search(r'(\{.*\})', response.content, re.DOTALL); report_json = json.loads(match.group(1))
+                    if NUTRITION_FAST_PATH:
+                        # Numbers come from the formulas; the agent only writes the prose
+                        report_json = build_report_base(user_data)
+                        show_early_summary(("nutrition_summary",), report_json["nutrition_summary"])
+                        try:
+                            prose = run_agent_json(nutrition_prose_agent, report_prose_request(user_data, report_json), raw=raw_output)
+                        except Exception as e:
+                            prose = None
+                            st.warning(f"The written summary could not be generated ({e}); showing the computed report.")
+                        report_json = merge_report_prose(report_json, prose)
+                    else:
+                        report_json = run_agent_json(nutrition_agent, str(user_data), on_object=show_early_summary, event_depth=1, raw=raw_output)
+                    live_summary.empty()
                     nutrition_collection.update_one({"user_id": user_id}, {"$set": {"report": report_json, "generated_at": datetime.now(timezone.utc)}}, upsert=True)
+                    invalidate_user_data(phone_input)
                     st.success("✅ Nutrition report generated and saved!"); st.session_state.update(nutrition_report_generated=True, meal_plan_generated=False, recipes_generated=False, shopping_list_generated=False)
                     # --- UI ENHANCEMENT: Display the formatted summary ---
                     st.subheader("Your Personalized Nutrition Summary")
@@ -138,7 +208,7 @@ with tab1:
                     
                     human_summary = report_json.get("human_summary", "No summary was generated by the agent.")
                     st.info(f"**Agent's Summary:** {human_summary}")
-                except Exception as e: st.error(f"An error occurred: {e}"); st.code(response.content)
+                except Exception as e: st.error(f"An error occurred: {e}"); st.code("".join(raw_output))
 
 
 # --- TAB 2: Meal Plan ---
@@ -150,39 +220,54 @@ with tab2:
         if st.button("✨ Generate Meal Plan Now"):
             with st.spinner("🧑‍🍳 Our AI chef is creating your meal plan..."):
                 try:
-                    user = user_collection.find_one({"phone": phone_input})
+                    user_docs = get_user_data(phone_input)
+                    user = user_docs["user"]
                     user_id = user["_id"]
-                    _, nutrition_report = get_user_and_nutrition(str(user_id))
+                    if not user_docs["nutrition"]: raise ValueError("Nutrition report not found in Nutrition_Reports")
+                    nutrition_report = user_docs["nutrition"]["report"]
                     input_data = {"user": clean_mongo_doc(user), "nutrition_report": clean_mongo_doc(nutrition_report)}
-                    response = meal_agent.run(json.dumps(input_data, indent=2))
-                    match = re.search(r'(\{.*\})', response.content, re.DOTALL)
-                    meal_plan_json = json.loads(match.group(1))
+                    live_meals = st.container()
+
+                    def show_meal_card(path, value):
+                        if len(path) == 2 and isinstance(value, dict) and value.get("dish_name"):
+                            live_meals.markdown(f"🍽️ **{path[0]} – {path[1]}:** {value['dish_name']} (Calories: {value.get('calories_percentage', 'N/A')}%, Protein: {value.get('protein_percentage', 'N/A')}%)")
+                        elif len(path) == 1 and isinstance(value, dict) and value.get("summary"):
+                            live_meals.caption(f"📌 {path[0]}: {value['summary']}")
+
+                    meal_plan_json = run_agent_json(meal_agent, json.dumps(input_data, indent=2), on_object=show_meal_card, event_depth=2)
                     
-                    image_ids = {}
-                    for day, meals in meal_plan_json.items():
-                        if isinstance(meals, dict):
-                            for meal_details in meals.values():
-                                if isinstance(meal_details, dict) and "dish_name" in meal_details:
-                                    dish_name = meal_details["dish_name"]
-                                    st.write(f"Generating image for {dish_name}...")
-                                    img_bytes = generate_dish_image_bytes(dish_name)
-                                    if img_bytes:
-                                        filename = f"{day}_{dish_name.replace(' ', '_')}.png"
-                                        file_id = save_image_to_gridfs(img_bytes, filename)
-                                        image_ids[filename[:-4]] = file_id
-                                        
+                    st.write("Generating images for your dishes...")
+                    image_ids, image_errors = generate_plan_images(
+                        meal_plan_json,
+                        on_progress=lambda key, fid, err: st.write(f"{'✅' if fid else '⚠️'} {key.replace('_', ' ')}"),
+                    )
+                    if image_errors:
+                        st.warning(f"Could not generate {len(image_errors)} image(s): {', '.join(k.replace('_', ' ') for k in image_errors)}")
+
                     record = {
                         "user_id": user_id,
                         "meal_plan": meal_plan_json,
                         "image_file_ids": image_ids,
+                        "image_errors": image_errors,
                         "generated_at": datetime.now(timezone.utc)
                     }
                     
                     st.write("Uploading images for sharing...")
-                    image_urls = upload_images_and_get_urls(record)
-                    record["image_urls"] = image_urls
+                    upload_result = upload_plan_images(record)
+                    record["image_urls"] = upload_result.urls
+                    record["image_upload_errors"] = upload_result.failed
+                    if upload_result.failed:
+                        st.warning(f"{len(upload_result.failed)} image(s) could not be uploaded for sharing: {', '.join(upload_result.failed)}")
                     
                     meal_plan_collection.update_one({"user_id": user_id}, {"$set": record}, upsert=True)
+
+                    st.write("Writing your WhatsApp meal reminders...")
+                    try:
+                        store_plan_teasers(user, meal_plan_collection.find_one({"user_id": user_id}, {"meal_plan": 1}))
+                    except Exception as e:
+                        # Reminders without a stored teaser get one written when they are sent
+                        st.warning(f"Meal reminder texts will be written at send time ({e}).")
+                    invalidate_user_data(phone_input)
                     st.success("🎉 Your meal plan has been generated and saved!")
                     st.session_state.update(meal_plan_generated=True, recipes_generated=False, shopping_list_generated=False)
                     
@@ -190,12 +275,13 @@ with tab2:
                     st.error(f"An error occurred: {e}")
 
         if st.session_state.get('meal_plan_generated'):
-            user = user_collection.find_one({"phone": phone_input})
-            meal_plan_doc = meal_plan_collection.find_one({"user_id": user["_id"]})
+            user_docs = get_user_data(phone_input)
+            user, meal_plan_doc = user_docs["user"], user_docs["meal_plan"]
             if meal_plan_doc:
                 st.markdown(f"## Meal Plan for **{user.get('name', 'User')}**")
                 meal_plan_json = meal_plan_doc.get("meal_plan", {})
                 image_ids = meal_plan_doc.get("image_file_ids", {})
+                plan_images = get_gridfs_files(image_ids.values(), variant=meal_card_image_variant(meal_plan_json))
                 
                 for day in sorted(meal_plan_json.keys()):
                     day_data = meal_plan_json[day]
@@ -218,10 +304,9 @@ with tab2:
                                 st.markdown(f"<div class='dish-name'>{display_meal_name}: {dish}</div>", unsafe_allow_html=True)
                                 
                                 image_key = f"{day}_{dish.replace(' ', '_')}"
-                                fid = image_ids.get(image_key)
-                                if fid:
-                                    img_bytes = fs.get(fid).read()
-                                    st.image(Image.open(BytesIO(img_bytes)), use_container_width=True)
+                                img_bytes = plan_images.get(str(image_ids.get(image_key)))
+                                if img_bytes:
+                                    st.image(img_bytes, use_container_width=True)
                                     
                                 st.markdown(f"<div class='metrics-row'><div>Calories: {meal_val.get('calories_percentage', 'N/A')}%</div><div>Protein: {meal_val.get('protein_percentage', 'N/A')}%</div></div>", unsafe_allow_html=True)
                                 st.markdown(f"<div class='vitamins'>Vitamins: {meal_val.get('vitamin_mineral_highlights', '')}</div>", unsafe_allow_html=True)
@@ -241,20 +326,28 @@ with tab3:
         if st.button("🍳 Generate All Recipes"):
             with st.spinner("📜 Our AI chef is writing down your recipes..."):
                 try:
-                    user = user_collection.find_one({"phone": phone_input}); user_id = user["_id"]
-                    meal_plan_doc = meal_plan_collection.find_one({"user_id": user_id}); meal_plan = meal_plan_doc.get("meal_plan", {})
-                    for day, meals in meal_plan.items():
-                        if isinstance(meals, dict):
-                            for meal_key, meal_details in meals.items():
-                                if isinstance(meal_details, dict) and "dish_name" in meal_details and "recipe" not in meal_details:
-                                    dish_name = meal_details["dish_name"]; st.write(f"Generating recipe for {dish_name}...")
-                                    response = recipe_agent.run(json.dumps({dish_name: meal_details}, indent=2))
-                                    match = re.search(r'(\{.*\})', response.content.strip(), re.DOTALL); meal_plan[day][meal_key]["recipe"] = json.loads(match.group(1))
-                    meal_plan_collection.update_one({"_id": meal_plan_doc["_id"]}, {"$set": {"meal_plan": meal_plan}})
-                    st.success("✅ All recipes have been generated and saved!"); st.session_state['recipes_generated'] = True
+                    meal_plan_doc = get_user_data(phone_input)["meal_plan"]; meal_plan = meal_plan_doc.get("meal_plan", {})
+                    # Streamed recipes are shown here until the full plan below replaces them
+                    live_placeholder = st.empty(); live_recipes = live_placeholder.container()
+
+                    def show_recipe(dish_name, recipe):
+                        with live_recipes.expander(f"✅ **Dish:** {dish_name}"):
+                            st.write(f"**Prep Time:** {recipe.get('prep_time', 'N/A')} | **Cook Time:** {recipe.get('cook_time', 'N/A')}")
+                            for step, instruction in recipe.get("steps", {}).items(): st.write(f"**{step.replace('-', ' ').title()}:** {instruction}")
+
+                    failures = fill_plan_recipes(
+                        meal_plan,
+                        on_progress=lambda day, dish_name: st.write(f"Getting recipe for {dish_name}..."),
+                        on_recipe=show_recipe if STREAM_AGENT_OUTPUT else None,
+                    )
+                    meal_plan_collection.update_one({"_id": meal_plan_doc["_id"]}, {"$set": {"meal_plan": meal_plan}}); invalidate_user_data(phone_input)
+                    live_placeholder.empty()
+                    if failures: st.warning(f"Could not generate {len(failures)} recipe(s): {', '.join(f'{day} {meal}' for day, meal in failures)}. Click the button again to retry them.")
+                    else: st.success("✅ All recipes have been generated and saved!")
+                    st.session_state['recipes_generated'] = True
                 except Exception as e: st.error(f"An error occurred: {e}")
         if st.session_state.get('recipes_generated'):
-            user = user_collection.find_one({"phone": phone_input}); meal_plan_doc = meal_plan_collection.find_one({"user_id": user["_id"]})
+            meal_plan_doc = get_user_data(phone_input)["meal_plan"]
             if meal_plan_doc:
                 full_meal_plan = meal_plan_doc.get("meal_plan", {});
                 for day, meals in full_meal_plan.items():
@@ -276,37 +369,49 @@ with tab4:
         if st.button("🛒 Generate Shopping List & Prices"):
             with st.spinner("🧠 Analyzing recipes and forecasting prices..."):
                 try:
-                    user = user_collection.find_one({"phone": phone_input})
-                    user_id = user["_id"]
-                    meal_plan_doc = meal_plan_collection.find_one({"user_id": user_id})
+                    user_docs = get_user_data(phone_input)
+                    user_id = user_docs["user"]["_id"]
+                    meal_plan_doc = user_docs["meal_plan"]
                     meal_plan_data = meal_plan_doc.get("meal_plan", {})
                     
-                    response = shopping_agent.run(json.dumps(clean_mongo_doc(meal_plan_data), indent=2))
-                    match = re.search(r'(\{.*\})', response.content.strip(), re.DOTALL)
-                    shopping_list = json.loads(match.group(1))
+                    live_list = st.container()
+
+                    def show_category(path, value):
+                        if len(path) == 1 and isinstance(value, list):
+                            live_list.markdown(f"🛒 **{path[0]}:** {', '.join(str(item) for item in value)}")
+
+                    shopping_list = run_agent_json(shopping_agent, json.dumps(clean_mongo_doc(meal_plan_data), indent=2), on_object=show_category, event_depth=1)
                     
                     st.write("Forecasting prices for your list...")
-                    price_response = price_agent.run(json.dumps(shopping_list))
-                    price_match = re.search(r'(\{.*\})', price_response.content.strip(), re.DOTALL)
-                    pricing_details = json.loads(price_match.group(1))
+                    try:
+                        pricing_details = price_shopping_list(shopping_list)
+                    except Exception as e:
+                        pricing_details = None
+                        st.warning(f"Prices could not be forecast right now ({e}); they will be filled in by the next pricing run.")
 
                     ingredient_doc = {
                         "user_id": user_id,
                         "source_meal_plan_id": meal_plan_doc["_id"],
                         "shopping_list": shopping_list,
-                        "pricing_details": pricing_details,
+                        "shopping_list_hash": hash_payload(shopping_list),
                         "created_at": datetime.now(timezone.utc)
                     }
-                    ingredient_collection.update_one({"source_meal_plan_id": meal_plan_doc["_id"]}, {"$set": ingredient_doc}, upsert=True)
-                    st.success("✅ Shopping list and prices generated!")
+                    update = {"$set": ingredient_doc}
+                    if pricing_details is not None:
+                        ingredient_doc["pricing_details"] = pricing_details
+                        ingredient_doc["pricing_source_hash"] = hash_payload(shopping_list)
+                    else:
+                        # Without pricing the list is picked up by price_prediction_pipeline
+                        update["$unset"] = {"pricing_details": "", "pricing_source_hash": ""}
+                    ingredient_collection.update_one({"source_meal_plan_id": meal_plan_doc["_id"]}, update, upsert=True)
+                    invalidate_user_data(phone_input)
+                    st.success("✅ Shopping list and prices generated!" if pricing_details is not None else "✅ Shopping list generated!")
                     st.session_state['shopping_list_generated'] = True
                 except Exception as e:
                     st.error(f"An error occurred: {e}")
 
         if st.session_state.get('shopping_list_generated'):
-            user = user_collection.find_one({"phone": phone_input})
-            meal_plan_doc = meal_plan_collection.find_one({"user_id": user["_id"]})
-            shopping_list_doc = ingredient_collection.find_one({"source_meal_plan_id": meal_plan_doc["_id"]})
+            shopping_list_doc = get_user_data(phone_input)["shopping_list"]
             
             if shopping_list_doc:
                 # --- NEW "SEXY" UI FOR SHOPPING LIST ---
@@ -377,8 +482,8 @@ with tab5:
 
         days_available = []
         try:
-            user = user_collection.find_one({"phone": phone_input})
-            meal_plan_doc = meal_plan_collection.find_one({"user_id": user["_id"]})
+            user_docs = get_user_data(phone_input)
+            user, meal_plan_doc = user_docs["user"], user_docs["meal_plan"]
             if meal_plan_doc and "meal_plan" in meal_plan_doc:
                 days_available = sorted([day for day in meal_plan_doc["meal_plan"].keys() if day.lower() != "summary"])
         except Exception:
@@ -415,7 +520,8 @@ with tab5:
                             image_key = f"{selected_day}_{dish.replace(' ', '_')}"
                             image_url = image_urls.get(image_key)
 
-                            status = send_whatsapp_message(user, meal_name.title(), dish, image_url)
+                            teaser = stored_teaser(meal_plan_doc.get("teasers"), selected_day, meal_name, dish)
+                            status = send_whatsapp_message(user, meal_name.title(), dish, image_url, teaser)
                             st.write(status)
                             messages_sent += 1
 
@@ -437,19 +543,16 @@ with tab6:
     else:
         with st.spinner("🔍 Fetching your complete data profile..."):
             try:
-                user = user_collection.find_one({"phone": phone_input})
+                # One aggregation returns the user with their report, plan and shopping list
+                profile_view = get_profile_view(phone_input)
 
-                if not user:
+                if not profile_view:
                     st.info("No profile found for this phone number. Please create one in Tab 1.")
                 else:
-                    user_id = user["_id"]
-                    
-                    # Fetch all related data documents
-                    nutrition_report_doc = nutrition_collection.find_one({"user_id": user_id})
-                    meal_plan_doc = meal_plan_collection.find_one({"user_id": user_id})
-                    shopping_list_doc = None
-                    if meal_plan_doc:
-                        shopping_list_doc = ingredient_collection.find_one({"source_meal_plan_id": meal_plan_doc["_id"]})
+                    user_docs = profile_view
+                    nutrition_report_doc = user_docs["nutrition"]
+                    meal_plan_doc = user_docs["meal_plan"]
+                    shopping_list_doc = user_docs["shopping_list"]
 
                     # --- 1. Display Nutrition Report ---
                     st.subheader("🥗 Your Personalized Nutrition Summary")
@@ -476,6 +579,7 @@ with tab6:
                     if meal_plan_doc:
                         meal_plan_json = meal_plan_doc.get("meal_plan", {})
                         image_ids = meal_plan_doc.get("image_file_ids", {})
+                        plan_images = get_gridfs_files(image_ids.values(), variant=meal_card_image_variant(meal_plan_json))
                         for day in sorted(meal_plan_json.keys()):
                             day_data = meal_plan_json[day]
                             st.markdown(f"#### {day.replace('Day', 'Day ')}")
@@ -503,10 +607,9 @@ with tab6:
                                     st.markdown(f"<div class='dish-name'>{display_meal_name}: {dish}</div>", unsafe_allow_html=True)
                                     # st.markdown(f"<div class='dish-name'>{meal_key.title()}: {dish}</div>", unsafe_allow_html=True)
                                     image_key = f"{day}_{dish.replace(' ', '_')}"
-                                    fid = image_ids.get(image_key)
-                                    if fid:
-                                        img_bytes = fs.get(fid).read()
-                                        st.image(Image.open(BytesIO(img_bytes)), use_container_width=True)
+                                    img_bytes = plan_images.get(str(image_ids.get(image_key)))
+                                    if img_bytes:
+                                        st.image(img_bytes, use_container_width=True)
                                     st.markdown(f"<div class='metrics-row'><div>Calories: {meal_val.get('calories_percentage', 'N/A')}%</div><div>Protein: {meal_val.get('protein_percentage', 'N/A')}%</div></div>", unsafe_allow_html=True)
                     else:
                         st.warning("No Meal Plan found. Please generate one in Tab 2.")
@@ -565,7 +668,7 @@ with tab7:
     if not phone_input:
         st.warning("Please enter your phone number to generate and view your dashboard.")
     else:
-        user = user_collection.find_one({"phone": phone_input})
+        user = get_user(phone_input)
         if not user:
             st.info("No profile found for this phone number. Please create one in Tab 1.")
         else:
@@ -575,6 +678,8 @@ with tab7:
             if st.button("🚀 Generate My Interactive Dashboard"):
                 with st.spinner("🎨 Creating your personalized interactive charts..."):
                     success = generate_and_save_all_charts(user_id_str)
+                    if success and success["rendered"]:
+                        invalidate_user_data(phone_input)
                     if success:
                         st.success("✅ Your interactive dashboard has been generated!")
                         st.rerun()
@@ -584,38 +689,40 @@ with tab7:
             st.markdown("---")
 
             # --- Display Interactive Charts ---
-            chart_filenames = {
-                "Macro Distribution": f"user_{user['_id']}_macro_distribution.html",
-                "Calories vs Target": f"user_{user['_id']}_calories_vs_target.html",
-                "Shopping Breakdown": f"user_{user['_id']}_shopping_breakdown.html",
-                "Grocery Items": f"user_{user['_id']}_grocery_items.html" # Added new chart
-            }
+            def show_chart(chart_name, height):
+                chart = get_chart(phone_input, user["_id"], chart_name)
+                if not chart:
+                    return
+                chart_format, content = chart
+                if chart_format == "json":
+                    # theme=None keeps the plotly_dark template the charts were designed with
+                    st.plotly_chart(figure_from_spec(content, height=height), use_container_width=True, theme=None)
+                else:
+                    components.html(content, height=height)
 
             # Check if at least one chart exists
-            if fs.exists({"filename": chart_filenames["Macro Distribution"]}):
+            if get_chart(phone_input, user["_id"], "macro_distribution"):
                 st.subheader("Nutrition Insights")
                 col1, col2 = st.columns(2)
                 
                 with col1:
-                    macro_chart_file = fs.find_one({"filename": chart_filenames["Macro Distribution"]})
-                    if macro_chart_file: components.html(macro_chart_file.read().decode(), height=450)
+                    show_chart("macro_distribution", 450)
                 
                 with col2:
-                    calorie_chart_file = fs.find_one({"filename": chart_filenames["Calories vs Target"]})
-                    if calorie_chart_file: components.html(calorie_chart_file.read().decode(), height=450)
+                    show_chart("calories_vs_target", 450)
 
                 st.markdown("---")
                 st.subheader("Shopping Insights")
                 col3, col4 = st.columns(2)
 
                 with col3:
-                    shopping_chart_file = fs.find_one({"filename": chart_filenames["Shopping Breakdown"]})
-                    if shopping_chart_file: components.html(shopping_chart_file.read().decode(), height=500)
+                    show_chart("shopping_breakdown", 500)
 
                 with col4:
                     # Display the new grocery items chart
-                    grocery_chart_file = fs.find_one({"filename": chart_filenames["Grocery Items"]})
-                    if grocery_chart_file: components.html(grocery_chart_file.read().decode(), height=500)
+                    show_chart("grocery_items", 500)
             
             else:
-                st.write("Your dashboard is ready to be generated. Click the button above to see your charts!")
\ No newline at end of file
+                st.write("Your dashboard is ready to be generated. Click the button above to see your charts!")
+
+report_query_stats()
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# Tests never touch the real database: database.py uses the in-memory mongomock client for this URI
+os.environ["MONGO_URI"] = "mongomock://localhost"
+os.environ["MONGO_DB"] = "MealPlannerTest"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,42 @@
+import pytest
+from bson import ObjectId
+import charts
+from database import user_collection, nutrition_collection, ingredient_collection, fs_files_collection
+
+
+@pytest.fixture
+def user_id():
+    user_id = user_collection.insert_one({"name": "Asha"}).inserted_id
+    nutrition_collection.insert_one({"user_id": user_id, "report": {"nutrition_summary": {"calories": 1800, "protein_g": 110, "carbs_g": 200, "fat_g": 50}}})
+    ingredient_collection.insert_one({"user_id": user_id, "pricing_details": {
+        "Vegetables": {"items": [{"name": "onion", "price": 40}, {"name": "okra", "price": 60}], "total_price": 100},
+        "Grand_Total": 100,
+    }})
+    return user_id
+
+
+def test_unchanged_charts_are_not_rendered_again(user_id):
+    first = charts.generate_and_save_all_charts(str(user_id))
+    assert sorted(first["rendered"]) == sorted(charts.CHART_BUILDERS) and first["skipped"] == []
+    second = charts.generate_and_save_all_charts(str(user_id))
+    assert second["rendered"] == [] and sorted(second["skipped"]) == sorted(charts.CHART_BUILDERS)
+
+
+def test_changed_inputs_render_only_the_affected_charts(user_id):
+    charts.generate_and_save_all_charts(str(user_id))
+    ingredient_collection.update_one({"user_id": user_id}, {"$set": {"pricing_details.Grand_Total": 120, "pricing_details.Vegetables.total_price": 120}})
+    result = charts.generate_and_save_all_charts(str(user_id))
+    assert sorted(result["rendered"]) == ["grocery_items", "shopping_breakdown"]
+    # Replacing a chart keeps one stored file per chart
+    assert fs_files_collection.count_documents({"filename": charts.chart_filename(user_id, "shopping_breakdown")}) == 1
+
+
+def test_stored_spec_rebuilds_the_figure_without_the_template():
+    fig = charts.calorie_vs_target({"calories": 1800, "protein_g": 110, "carbs_g": 200, "fat_g": 50}, "Asha", ObjectId())
+    spec = charts.figure_to_spec(fig)
+    assert "template" not in spec["layout"]
+    assert len(charts.figure_from_spec(spec, height=300).data) == len(fig.data)
+
+
+def test_unknown_user_returns_false():
+    assert charts.generate_and_save_all_charts(str(ObjectId())) is False
@@ -0,0 +1,31 @@
+from io import BytesIO
+import pytest
+from PIL import Image
+import dish_images
+from database import fs, fs_files_collection, meal_plan_collection, read_gridfs_files
+
+
+def _png(size=800):
+    buffer = BytesIO()
+    Image.new("RGB", (size, size), "orange").save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize("pixels, variant", [(200, "thumb"), (320, "thumb"), (321, "medium"), (640, "medium"), (900, None)])
+def test_smallest_variant_that_fits(pixels, variant):
+    assert dish_images.image_variant_for_width(pixels) == variant
+
+
+def test_backfill_pages_the_referenced_images():
+    for name in ["fs.files", "fs.chunks", meal_plan_collection.name]:
+        fs_files_collection.database[name].delete_many({})
+    referenced = [fs.put(_png(), filename=f"plan_{i}.png") for i in range(5)]
+    meal_plan_collection.insert_one({"image_file_ids": {f"Day 1_Dish_{i}": file_id for i, file_id in enumerate(referenced)}})
+    unreferenced = fs.put(_png(), filename="orphan.png")
+
+    assert dish_images.backfill_image_variants(page_size=2) == 5
+    assert all(fs_files_collection.find_one({"_id": file_id})["metadata"]["variants"] for file_id in referenced)
+    assert "metadata" not in fs_files_collection.find_one({"_id": unreferenced})
+    thumb = read_gridfs_files([referenced[0]], variant="thumb")[referenced[0]]
+    assert max(Image.open(BytesIO(thumb)).size) == 320
+    assert dish_images.backfill_image_variants(page_size=2) == 0
@@ -0,0 +1,49 @@
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from bson import ObjectId
+from instrumentation import instrumented, pipeline_run, run_in_context, timeline_tags, get_run_timeline, metrics
+from database import run_timeline_collection
+
+
+@instrumented("fake_model")
+def fake_model(prompt):
+    if prompt == "fail":
+        raise RuntimeError("model down")
+    return prompt.upper()
+
+
+@pytest.fixture(autouse=True)
+def empty_timeline():
+    run_timeline_collection.delete_many({})
+
+
+def test_calls_in_worker_threads_are_tagged_with_their_user():
+    users = [ObjectId(), ObjectId()]
+    with pipeline_run("run-1"), ThreadPoolExecutor(max_workers=2) as executor:
+        for user_id in users:
+            with timeline_tags(user_id=user_id):
+                executor.submit(run_in_context(fake_model), "dal")
+        fake_model("untagged")
+
+    assert len(get_run_timeline("run-1")) == 3
+    for user_id in users:
+        events = get_run_timeline("run-1", user_id=user_id)
+        assert [(e["name"], e["ok"], e["output_chars"]) for e in events] == [("fake_model", True, 3)]
+
+
+def test_nested_run_with_the_same_id_shares_the_timeline():
+    with pipeline_run("run-2") as outer:
+        with pipeline_run("run-2") as inner, timeline_tags(job_id="job-1"):
+            fake_model("poha")
+        assert inner is outer
+        with pytest.raises(RuntimeError):
+            fake_model("fail")
+    events = get_run_timeline("run-2")
+    assert [(e.get("job_id"), e["ok"], e["error"]) for e in events] == [("job-1", True, None), (None, False, "model down")]
+
+
+def test_calls_are_counted_outside_a_run():
+    before = metrics.snapshot().get("fake_model", {}).get("calls", 0)
+    fake_model("idli")
+    assert metrics.snapshot()["fake_model"]["calls"] == before + 1
+    assert run_timeline_collection.count_documents({}) == 0
@@ -0,0 +1,110 @@
+import time
+from datetime import datetime, timedelta
+import pytest
+import job_queue
+from database import jobs_collection
+
+
+@pytest.fixture(autouse=True)
+def empty_queue():
+    jobs_collection.delete_many({})
+
+
+@pytest.fixture
+def handlers(monkeypatch):
+    handlers = {job_type: lambda payload: {} for job_type in job_queue.JOB_HANDLERS}
+    monkeypatch.setattr(job_queue, "JOB_HANDLERS", handlers)
+    monkeypatch.setattr(job_queue, "JOB_CHAIN", {})
+    return handlers
+
+
+def test_claims_each_job_once_in_order():
+    first = job_queue.enqueue("charts", {"user_id": "a"})
+    second = job_queue.enqueue("charts", {"user_id": "b"})
+    claimed = [job_queue.claim_job("w1"), job_queue.claim_job("w2"), job_queue.claim_job("w3")]
+    assert [job["_id"] for job in claimed[:2]] == [first, second]
+    assert claimed[2] is None
+    assert claimed[0]["lease_owner"] == "w1" and claimed[0]["attempts"] == 1
+
+
+def test_delayed_and_filtered_jobs_are_not_claimed():
+    job_queue.enqueue("charts", {"user_id": "a"}, delay_seconds=60)
+    job_queue.enqueue("pricing", {"user_id": "b"})
+    assert job_queue.claim_job("w1", job_types=["charts"]) is None
+    assert job_queue.claim_job("w1", job_types=["pricing"])["type"] == "pricing"
+
+
+def test_expired_lease_is_reclaimed_and_the_old_owner_is_locked_out():
+    job_queue.enqueue("charts", {"user_id": "a"})
+    stale = job_queue.claim_job("w1", lease_seconds=-1)
+    reclaimed = job_queue.claim_job("w2")
+    assert reclaimed["_id"] == stale["_id"] and reclaimed["attempts"] == 2
+    assert not job_queue.extend_lease(stale, "w1")
+    assert not job_queue.complete_job(stale, "w1")
+    assert job_queue.complete_job(reclaimed, "w2")
+    assert jobs_collection.find_one({"_id": stale["_id"]})["status"] == "done"
+
+
+def test_failed_job_is_retried_with_backoff_then_dead(monkeypatch):
+    monkeypatch.setattr(job_queue, "JOB_BACKOFF_SECONDS", 30)
+    job_queue.enqueue("charts", {"user_id": "a"}, max_attempts=2)
+    job = job_queue.claim_job("w1")
+    assert job_queue.fail_job(job, "w1", "boom") == "queued"
+    stored = jobs_collection.find_one({"_id": job["_id"]})
+    assert timedelta(seconds=25) < stored["available_at"] - datetime.utcnow() <= timedelta(seconds=30)
+    assert job_queue.claim_job("w1") is None
+
+    jobs_collection.update_one({"_id": job["_id"]}, {"$set": {"available_at": datetime.utcnow()}})
+    job = job_queue.claim_job("w1")
+    assert job_queue.fail_job(job, "w1", "boom again") == "dead"
+    stored = jobs_collection.find_one({"_id": job["_id"]})
+    assert stored["status"] == "dead" and [e["error"] for e in stored["errors"]] == ["boom", "boom again"]
+
+
+def test_job_error_is_not_retried():
+    job_queue.enqueue("charts", {"user_id": "a"})
+    job = job_queue.claim_job("w1")
+    assert job_queue.fail_job(job, "w1", "no such user", retryable=False) == "dead"
+
+
+def test_chained_jobs_are_enqueued_once_per_idempotency_key():
+    job_queue.enqueue("meal_plan", {"user_id": "a"}, idempotency_key="run:a")
+    assert job_queue.enqueue("meal_plan", {"user_id": "a"}, idempotency_key="run:a") == jobs_collection.find_one()["_id"]
+    job = job_queue.claim_job("w1")
+    assert job_queue.complete_job(job, "w1")
+    # A second completion (e.g. a replayed job) must not enqueue the next stages again
+    job_queue.enqueue("meal_plan", {"user_id": "a"}, idempotency_key="run:a")
+    jobs_collection.update_one({"_id": job["_id"]}, {"$set": {"status": "running"}})
+    assert job_queue.complete_job(job, "w1")
+    keys = sorted(doc["idempotency_key"] for doc in jobs_collection.find({"type": {"$ne": "meal_plan"}}))
+    assert keys == ["run:a>images", "run:a>recipes"]
+
+
+def test_handler_is_stopped_when_the_lease_is_lost(handlers):
+    def steal_lease_then_write(payload):
+        jobs_collection.update_one({}, {"$set": {"lease_owner": "w2"}})
+        time.sleep(0.2)
+        job_queue.check_lease()
+        raise AssertionError("the handler kept running after losing its lease")
+
+    handlers["charts"] = steal_lease_then_write
+    job_queue.enqueue("charts", {"user_id": "a"})
+    job = job_queue.claim_job("w1")
+    assert job_queue.process_job(job, "w1", lease_seconds=0.03) == "lease_lost"
+    assert jobs_collection.find_one()["status"] == "running"
+
+
+def test_result_is_not_recorded_when_the_lease_was_lost(handlers):
+    handlers["charts"] = lambda payload: jobs_collection.update_one({}, {"$set": {"lease_owner": "w2"}}) and {}
+    job_queue.enqueue("charts", {"user_id": "a"})
+    job = job_queue.claim_job("w1")
+    assert job_queue.process_job(job, "w1") == "lease_lost"
+    assert jobs_collection.find_one()["status"] == "running"
+
+
+def test_worker_with_max_jobs_stops_when_only_backed_off_jobs_remain(handlers):
+    job_queue.enqueue("charts", {"user_id": "a"})
+    job_queue.enqueue("charts", {"user_id": "b"}, delay_seconds=3600)
+    started = time.monotonic()
+    assert job_queue.run_worker("w", max_jobs=10, poll_seconds=5) == 1
+    assert time.monotonic() - started < 5
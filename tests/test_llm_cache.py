@@ -0,0 +1,101 @@
+import json
+import pytest
+import llm_cache
+from agents import _is_recipe_batch
+
+
+class FakeCollection:
+    def __init__(self):
+        self.docs = {}
+
+    def find_one(self, query, projection=None):
+        return self.docs.get(query["_id"])
+
+    def update_one(self, query, update, upsert=False):
+        self.docs[query["_id"]] = {"_id": query["_id"], **update["$set"]}
+
+
+class FakeResponse:
+    def __init__(self, content):
+        self.content = content
+
+
+class FakeAgent:
+    instructions = "Return a meal plan"
+
+    class model:
+        id = "fake-model"
+
+    def __init__(self, answer):
+        self.answer = answer
+        self.calls = 0
+
+    def run(self, message=None, stream=False):
+        self.calls += 1
+        return FakeResponse(self.answer)
+
+
+@pytest.fixture
+def collection(monkeypatch):
+    collection = FakeCollection()
+    monkeypatch.setattr(llm_cache, "llm_cache_collection", collection)
+    monkeypatch.setattr(llm_cache, "record_cache_stats", lambda *args, **kwargs: None)
+    monkeypatch.setattr(llm_cache, "LLM_CACHE_ENABLED", True)
+    monkeypatch.setattr(llm_cache, "_unflushed_stats", {})
+    llm_cache._lru.clear()
+    return collection
+
+
+def test_repeated_request_is_served_from_the_cache(collection):
+    agent = llm_cache.cache_agent(FakeAgent('{"Day 1": {"Lunch": {"dish_name": "Dal"}}}'), "test_agent")
+    first = agent.run('{"user": "a", "n": 1}')
+    second = agent.run('{"n": 1,  "user": "a"}')
+    assert agent.calls == 1
+    assert second.content == first.content
+    assert len(collection.docs) == 1
+
+
+@pytest.mark.parametrize("answer", [
+    '{"Day 1": {"Breakfast": {"dish_name": "Poha"}}, "Day 2": {"Lunch": {"dish_name": "Dal"}},}',
+    '{"a": {"b": 1}, "c": x}',
+    'Here is your plan: {"Day 1": {}}',
+])
+def test_malformed_response_is_not_cached(collection, answer):
+    agent = llm_cache.cache_agent(FakeAgent(answer), "test_agent")
+    agent.run("same request")
+    agent.run("same request")
+    assert agent.calls == 2
+    assert collection.docs == {}
+
+
+def test_response_rejected_by_validate_is_not_cached(collection):
+    agent = llm_cache.cache_agent(FakeAgent('{"Breakfast": {"dish_name": "Poha"}}'), "test_agent", validate=lambda v, message: "Day 1" in v)
+    agent.run("same request")
+    agent.run("same request")
+    assert agent.calls == 2
+    assert collection.docs == {}
+
+
+@pytest.mark.parametrize("answer, cached", [
+    ({"Poha": {"steps": {"1": "Rinse"}}, "Dal Tadka": {"steps": {"1": "Boil"}}}, True),
+    ({"poha": {"steps": {"1": "Rinse"}}, "Dal tadka!": {"steps": {"1": "Boil"}}}, True),
+    ({"Poha": {"steps": {"1": "Rinse"}}}, False),
+    ({"Poha": {"steps": {"1": "Rinse"}}, "Dal Tadka": {"ingredients": []}}, False),
+    ({}, False),
+])
+def test_recipe_batch_is_cached_only_when_it_covers_every_dish(collection, answer, cached):
+    agent = llm_cache.cache_agent(FakeAgent(json.dumps(answer)), "test_agent", validate=_is_recipe_batch)
+    agent.run(json.dumps({"Poha": {"meal": "Breakfast"}, "Dal Tadka": {"meal": "Lunch"}}))
+    assert bool(collection.docs) == cached
+
+
+def test_hit_counts_are_written_in_batches(collection, monkeypatch):
+    writes = []
+    monkeypatch.setattr(llm_cache, "record_cache_stats", lambda name, **counts: writes.append((name, counts)))
+    monkeypatch.setattr(llm_cache, "LLM_CACHE_STATS_FLUSH_SECONDS", 3600)
+    agent = llm_cache.cache_agent(FakeAgent('{"Day 1": {"Lunch": {"dish_name": "Dal"}}}'), "test_agent")
+    for _ in range(3):
+        agent.run("same request")
+    assert writes == []
+    llm_cache.flush_cache_stats()
+    assert writes == [("llm_test_agent", {"hits": 2, "misses": 1})]
@@ -0,0 +1,60 @@
+import pytest
+from bson import ObjectId
+import main
+from database import user_collection, pipeline_progress_collection, ingredient_collection, meal_plan_collection
+from utils import hash_payload
+
+
+@pytest.fixture(autouse=True)
+def empty_collections():
+    for collection in [user_collection, pipeline_progress_collection, ingredient_collection, meal_plan_collection]:
+        collection.delete_many({})
+
+
+def test_user_ids_are_read_in_id_ordered_pages():
+    ids = sorted(user_collection.insert_many([{"name": f"user {i}"} for i in range(5)]).inserted_ids)
+    assert list(main._iter_user_ids(page_size=2)) == ids
+
+
+def test_user_stages_resume_after_a_failed_stage(monkeypatch):
+    user_id = ObjectId()
+    calls = []
+    recipes_ok = False
+    monkeypatch.setattr(main, "generate_meal_plan_pipeline", lambda uid: calls.append("meal_plan") or {"_id": "plan"})
+    monkeypatch.setattr(main, "generate_recipes_pipeline", lambda doc: calls.append("recipes") or ({} if recipes_ok else None))
+    monkeypatch.setattr(main, "generate_shopping_list_pipeline", lambda doc: calls.append("shopping_list") or {})
+    meal_plan_collection.insert_one({"_id": "plan", "user_id": user_id})
+
+    assert main._run_user_stages(user_id, "run-1") == "failed"
+    recipes_ok = True
+    assert main._run_user_stages(user_id, "run-1") == "done"
+    assert main._run_user_stages(user_id, "run-1") == "skipped"
+    assert calls == ["meal_plan", "recipes", "recipes", "shopping_list"]
+
+
+def test_only_unpriced_or_changed_lists_are_priced(monkeypatch):
+    priced = []
+    monkeypatch.setattr(main, "price_shopping_list", lambda shopping_list: priced.append(shopping_list) or {"Grand_Total": 1})
+    unchanged = {"Vegetables": ["onion"]}
+    changed = {"Vegetables": ["tomato", "okra"]}
+    ingredient_collection.insert_many([
+        {"shopping_list": {"Fruits": ["apple"]}},
+        {"shopping_list": unchanged, "shopping_list_hash": hash_payload(unchanged),
+         "pricing_details": {"Grand_Total": 40}, "pricing_source_hash": hash_payload(unchanged)},
+        {"shopping_list": changed, "shopping_list_hash": hash_payload(changed),
+         "pricing_details": {"Grand_Total": 30}, "pricing_source_hash": hash_payload({"Vegetables": ["tomato"]})},
+    ])
+    main.price_prediction_pipeline(workers=2)
+    assert sorted(priced, key=str) == sorted([{"Fruits": ["apple"]}, changed], key=str)
+    assert ingredient_collection.count_documents({"pricing_details.Grand_Total": 1}) == 2
+
+
+def test_a_failed_pricing_is_retried_on_the_next_run(monkeypatch):
+    def failing(shopping_list):
+        raise ValueError("price_agent returned no price for 1 item(s): saffron")
+
+    monkeypatch.setattr(main, "price_shopping_list", failing)
+    ingredient_collection.insert_one({"shopping_list": {"Spices": ["saffron"]}})
+    main.price_prediction_pipeline()
+    document = ingredient_collection.find_one()
+    assert "pricing_details" not in document and "pricing_source_hash" not in document
@@ -0,0 +1,56 @@
+import threading
+import time
+import pytest
+from messaging import FakeTransport, RateLimitedError, send_with_retry, fan_out
+
+
+class FlakyTransport:
+    def __init__(self, rejections):
+        self.rejections = rejections
+        self.calls = 0
+
+    def send(self, to, body, media_url=None):
+        self.calls += 1
+        if self.calls <= self.rejections:
+            raise RateLimitedError("429", retry_after=0)
+        return f"SID{self.calls}"
+
+
+def test_rate_limited_send_is_retried():
+    transport = FlakyTransport(rejections=2)
+    assert send_with_retry(transport, "whatsapp:+91900", "hi", max_retries=3, backoff=0) == "SID3"
+
+
+def test_send_gives_up_after_max_retries():
+    transport = FlakyTransport(rejections=5)
+    with pytest.raises(RateLimitedError):
+        send_with_retry(transport, "whatsapp:+91900", "hi", max_retries=2, backoff=0)
+    assert transport.calls == 3
+
+
+def test_fan_out_counts_failures_and_bounds_concurrency():
+    running, peak, lock = 0, 0, threading.Lock()
+
+    def send(i):
+        nonlocal running, peak
+        with lock:
+            running += 1
+            peak = max(peak, running)
+        time.sleep(0.01)
+        with lock:
+            running -= 1
+        if i % 5 == 0:
+            raise ValueError(f"bad number {i}")
+
+    result = fan_out(range(20), send, workers=3, max_failures=2)
+    assert (result["sent"], result["failed"]) == (16, 4)
+    assert len(result["failures"]) == 2 and all(item % 5 == 0 for item, _ in result["failures"])
+    assert peak <= 3
+
+
+def test_fan_out_respects_the_rate_limit():
+    transport = FakeTransport(latency=0, jitter=0)
+    result = fan_out(range(6), lambda i: transport.send(f"to{i}", "hi"), workers=4, rate_per_second=20)
+    assert result["sent"] == 6 and len(transport.messages) == 6
+    # 6 sends at 20/s need at least 5 intervals of 50 ms
+    assert result["duration_seconds"] >= 0.24
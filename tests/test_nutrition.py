@@ -0,0 +1,38 @@
+import pandas as pd
+import pytest
+from nutrition import compute_nutrition, compute_nutrition_batch, build_report_base, merge_report_prose, MEAL_SLOT_SPLITS
+
+PEOPLE = [
+    {"age": 29, "gender": "Female", "weight": 58, "height": 162, "activity": "Lightly active", "goal": "Weight loss", "diet": "Vegetarian"},
+    {"age": 41, "gender": "Male", "weight": 82, "height": 178, "activity": "Very active", "goal": "Muscle gain", "diet": "Non-veg"},
+    {"age": 35, "gender": "male", "weight": 70, "height": 170, "activity": "", "goal": "", "diet": ""},
+]
+
+
+def test_batch_matches_the_single_person_computation():
+    batch = compute_nutrition_batch(pd.DataFrame(PEOPLE))
+    for person, row in zip(PEOPLE, batch.itertuples()):
+        single = compute_nutrition(**person)
+        assert (row.calories, row.protein_g, row.carbs_g, row.fat_g) == (single["calories"], single["protein_g"], single["carbs_g"], single["fat_g"])
+        assert row.vitamins == single["vitamins"]
+
+
+def test_rows_without_numbers_get_no_targets():
+    batch = compute_nutrition_batch(pd.DataFrame([{**PEOPLE[0], "weight": "unknown"}]))
+    assert batch["calories"].isna().all()
+
+
+@pytest.mark.parametrize("meals_per_day", sorted(MEAL_SLOT_SPLITS))
+def test_meal_targets_add_up_to_the_daily_targets(meals_per_day):
+    report = build_report_base({**PEOPLE[1], "meals_per_day": meals_per_day})
+    per_meal = report["meal_targets"]["per_meal"]
+    assert [meal["slot"] for meal in per_meal] == [slot for slot, _ in MEAL_SLOT_SPLITS[meals_per_day]]
+    assert abs(sum(meal["calories"] for meal in per_meal) - report["nutrition_summary"]["calories"]) <= meals_per_day
+
+
+def test_prose_never_overwrites_computed_fields():
+    base = build_report_base({**PEOPLE[0], "allergies": "peanut, gluten"})
+    report = merge_report_prose(base, {"human_summary": "Eat well.", "nutrition_summary": {"calories": 1}})
+    assert report["human_summary"] == "Eat well."
+    assert report["nutrition_summary"] == base["nutrition_summary"]
+    assert report["diet_constraints"]["allergies"] == ["peanut", "gluten"]
@@ -0,0 +1,55 @@
+import json
+import pytest
+import pandas as pd
+import pricing
+from database import price_catalog_collection
+
+
+class FakePriceAgent:
+    def __init__(self, answer):
+        self.answer = answer
+        self.requests = []
+
+    def run(self, message):
+        self.requests.append(json.loads(message))
+        return type("Response", (), {"content": json.dumps(self.answer)})()
+
+
+@pytest.fixture
+def catalog(monkeypatch):
+    price_catalog_collection.delete_many({})
+    monkeypatch.setattr(pricing, "load_price_catalog", lambda force=False: pricing._catalog)
+    monkeypatch.setattr(pricing, "_catalog", pd.Series({"onion": 40.0, "tomato": 30.0}, dtype="float64"))
+
+
+def _use_agent(monkeypatch, answer):
+    agent = FakePriceAgent(answer)
+    monkeypatch.setattr(pricing, "price_agent", agent)
+    return agent
+
+
+def test_known_items_are_priced_without_the_agent(catalog, monkeypatch):
+    agent = _use_agent(monkeypatch, {})
+    result = pricing.price_shopping_list({"Vegetables": ["Onions", "Tomatoes (ripe)"]})
+    assert agent.requests == []
+    assert result["Vegetables"]["total_price"] == 70
+    assert result["Grand_Total"] == 70
+
+
+def test_unknown_items_are_priced_by_the_agent_and_learned(catalog, monkeypatch):
+    _use_agent(monkeypatch, {"Fruits": {"items": [{"name": "Dragon fruit", "price": "₹1,200"}]}})
+    result = pricing.price_shopping_list({"Vegetables": ["onion"], "Fruits": ["dragon fruit"]})
+    assert result["Fruits"]["items"] == [{"name": "dragon fruit", "price": 1200}]
+    assert result["Grand_Total"] == 1240
+    assert price_catalog_collection.find_one({"_id": "dragon fruit"})["price"] == 1200
+
+
+@pytest.mark.parametrize("answer", [
+    {},
+    {"Spices": {"items": [{"name": "saffron threads", "price": 350}]}},
+    {"Spices": {"items": [{"name": "saffron", "price": 350}]}, "Fruits": {"items": [{"name": "dragon fruit", "price": "ask"}]}},
+])
+def test_empty_or_partial_agent_answer_raises(catalog, monkeypatch, answer):
+    _use_agent(monkeypatch, answer)
+    with pytest.raises(ValueError, match="no price"):
+        pricing.price_shopping_list({"Spices": ["saffron threads"], "Fruits": ["dragon fruit"]})
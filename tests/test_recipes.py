@@ -0,0 +1,41 @@
+import json
+import pytest
+import recipes
+from database import recipe_cache_collection
+
+
+class FakeRecipeAgent:
+    def __init__(self, answers):
+        self.answers = answers
+
+    def run(self, message):
+        dish_name = next(iter(json.loads(message)))
+        return type("Response", (), {"content": json.dumps(self.answers[dish_name])})()
+
+
+@pytest.fixture(autouse=True)
+def empty_cache(monkeypatch):
+    recipe_cache_collection.delete_many({})
+    monkeypatch.setattr(recipes, "record_cache_stats", lambda *args, **kwargs: None)
+
+
+def test_valid_recipe_is_shared(monkeypatch):
+    monkeypatch.setattr(recipes, "recipe_agent", FakeRecipeAgent({"Poha": {"steps": {"1": "Rinse the poha"}}}))
+    assert recipes.generate_recipe("Poha", {})["steps"] == {"1": "Rinse the poha"}
+    assert recipes.get_cached_recipe("poha") == {"steps": {"1": "Rinse the poha"}}
+
+
+@pytest.mark.parametrize("answer", [{"ingredients": ["poha"]}, {"steps": {}}, {"error": "quota"}])
+def test_malformed_single_recipe_is_not_shared(monkeypatch, answer):
+    monkeypatch.setattr(recipes, "recipe_agent", FakeRecipeAgent({"Poha": answer}))
+    with pytest.raises(ValueError):
+        recipes.generate_recipe("Poha", {})
+    assert recipe_cache_collection.count_documents({}) == 0
+
+
+def test_batch_fallback_reports_a_malformed_recipe_as_a_failure(monkeypatch):
+    monkeypatch.setattr(recipes, "_run_batch_request", lambda chunk, on_recipe=None: {})
+    monkeypatch.setattr(recipes, "recipe_agent", FakeRecipeAgent({"Poha": {"steps": {"1": "Rinse"}}, "Dal": {"steps": None}}))
+    found, failures = recipes.generate_recipes_batch({"Poha": {}, "Dal": {}})
+    assert list(found) == ["Poha"] and list(failures) == ["Dal"]
+    assert [doc["_id"] for doc in recipe_cache_collection.find()] == ["poha"]
@@ -0,0 +1,40 @@
+import pytest
+import upload_images
+from database import fs
+
+
+class FakeUploader:
+    def __init__(self, failures=None):
+        self.failures = dict(failures or {})
+        self.uploaded = []
+
+    def __call__(self, file_obj, public_id):
+        file_obj.read()
+        if self.failures.get(public_id, 0) > 0:
+            self.failures[public_id] -= 1
+            raise ConnectionError(f"upload of {public_id} failed")
+        self.uploaded.append(public_id)
+        return f"https://img.example/{public_id}"
+
+
+@pytest.fixture
+def plan_doc():
+    ids = {key: fs.put(b"png", filename=f"{key}.png") for key in ["Day 1_Poha", "Day 1_Dal", "Day 2_Idli"]}
+    return {"_id": "plan", "image_file_ids": ids, "image_urls": {"Day 2_Idli": "https://img.example/old"}}
+
+
+def test_uploads_missing_images_and_retries_failures(plan_doc):
+    uploader = FakeUploader({"meal_plans/plan/Day 1_Dal": 1})
+    result = upload_images.upload_plan_images(plan_doc, uploader=uploader, attempts=2, backoff=0)
+    assert result.ok
+    assert sorted(result.succeeded) == ["Day 1_Dal", "Day 1_Poha"]
+    assert result.urls["Day 2_Idli"] == "https://img.example/old"
+    assert result.urls["Day 1_Dal"] == "https://img.example/meal_plans/plan/Day 1_Dal"
+
+
+def test_a_failing_image_does_not_fail_the_others(plan_doc):
+    uploader = FakeUploader({"meal_plans/plan/Day 1_Dal": 5})
+    result = upload_images.upload_plan_images(plan_doc, uploader=uploader, attempts=2, backoff=0)
+    assert result.succeeded == ["Day 1_Poha"]
+    assert list(result.failed) == ["Day 1_Dal"]
+    assert "Day 1_Dal" not in result.urls
@@ -0,0 +1,24 @@
+import pytest
+from utils import extract_json, parse_json_stream, JSONExtractionError
+
+
+@pytest.mark.parametrize("text", [
+    '{"Day 1": {"Breakfast": {"dish_name": "Poha"}}, "Day 2": {"Lunch": {"dish_name": "Dal"}},}',
+    '{"a": {"b": 1}, "c": x}',
+    '{"a": [1}, "b": {"c": 1}}',
+])
+def test_malformed_object_never_returns_a_nested_fragment(text):
+    with pytest.raises(JSONExtractionError):
+        extract_json(text)
+
+
+def test_next_top_level_object_after_a_malformed_one():
+    assert extract_json('{"a": {"b": 1}, "c": x} then {"ok": true}') == {"ok": True}
+
+
+def test_fenced_object_with_braces_in_strings():
+    assert extract_json('```json\n{"s": "}{", "n": {"m": [1, 2]}}\n```') == {"s": "}{", "n": {"m": [1, 2]}}
+
+
+def test_stream_split_across_chunks():
+    assert parse_json_stream(['{"a": {"b"', ': 1}, "c": [1', ', 2]}']) == {"a": {"b": 1}, "c": [1, 2]}
@@ -0,0 +1,74 @@
+import time
+from datetime import datetime, date
+import pytest
+from bson import ObjectId
+import whatsapp_message
+from database import notification_deliveries_collection, notification_runs_collection
+
+
+def _target(meals_per_day=None, generated_at=None, user_id=None):
+    meals = meals_per_day or ["Breakfast", "Lunch", "Dinner"]
+    return {
+        "user": {"_id": user_id or ObjectId(), "name": "Asha", "phone": "9000000000"},
+        "generated_at": generated_at,
+        "days": [
+            {"day": f"Day {n}", "meals": [{"meal": meal, "dish": f"{meal} {n}"} for meal in meals]}
+            for n in (1, 2, 3)
+        ],
+    }
+
+
+@pytest.fixture
+def india_time(monkeypatch):
+    monkeypatch.setenv("TZ", "Asia/Kolkata")
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def test_plan_day_follows_the_generation_date():
+    target = _target(generated_at=datetime(2026, 10, 15, 6, 0))
+    assert whatsapp_message.pick_slot_meal(target, "dinner", date(2026, 10, 17)) == ("Day 3", "Dinner", "Dinner 3")
+    assert whatsapp_message.pick_slot_meal(target, "lunch", date(2026, 10, 18)) == ("Day 1", "Lunch", "Lunch 1")
+
+
+def test_plan_day_uses_the_local_date_of_a_utc_timestamp(india_time):
+    # 20:00 UTC on the 16th is 01:30 on the 17th in India, so the 17th is still day 1
+    target = _target(generated_at=datetime(2026, 10, 16, 20, 0))
+    assert whatsapp_message.pick_slot_meal(target, "breakfast", date(2026, 10, 17))[0] == "Day 1"
+
+
+@pytest.mark.parametrize("meals, slot, meal", [
+    (["Main Meal"], "lunch", "Main Meal"),
+    (["Brunch", "Dinner"], "breakfast", "Brunch"),
+    (["Brunch", "Dinner"], "dinner", "Dinner"),
+    (["Breakfast", "Snack 1", "Lunch", "Snack 2", "Dinner"], "lunch", "Lunch"),
+])
+def test_every_meal_layout_maps_to_a_slot(meals, slot, meal):
+    assert whatsapp_message.pick_slot_meal(_target(meals), slot)[1] == meal
+
+
+def test_snacks_are_not_sent():
+    assert whatsapp_message.pick_slot_meal(_target(["Snack 1"]), "lunch") is None
+
+
+def test_resumed_run_skips_users_already_messaged(monkeypatch):
+    notification_deliveries_collection.delete_many({})
+    notification_runs_collection.delete_many({})
+    targets = [_target() for _ in range(4)]
+    sent = []
+
+    def crashing_targets():
+        yield from targets[:2]
+        raise ConnectionError("cursor lost")
+
+    monkeypatch.setattr(whatsapp_message, "_notification_targets", crashing_targets)
+    monkeypatch.setattr(whatsapp_message, "deliver_whatsapp_message", lambda user, *args: sent.append(user["_id"]))
+    with pytest.raises(ConnectionError):
+        whatsapp_message.send_meal_notifications("lunch", workers=1, rate_per_second=0)
+
+    monkeypatch.setattr(whatsapp_message, "_notification_targets", lambda: iter(targets))
+    run = whatsapp_message.send_meal_notifications("lunch", workers=1, rate_per_second=0)
+    assert sent == [target["user"]["_id"] for target in targets]
+    assert run["sent"] == 2 and run["already_sent"] == 2
@@ -1,51 +1,152 @@
 import os
-from pymongo import MongoClient
-import gridfs
+import time
+import random
+from pathlib import Path
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import cloudinary
 import cloudinary.uploader
 from dotenv import load_dotenv
+from database import fs, meal_plan_collection
+from instrumentation import run_in_context
 
 load_dotenv()
 
 # --- CONFIG ---
-MONGO_URI = os.getenv("MONGO_URI")
-DB_NAME = os.getenv("MONGO_DB", "UserDBB")
 cloudinary.config(
     cloud_name=os.getenv("CLOUDINARY_CLOUD_NAME"),
     api_key=os.getenv("CLOUDINARY_API_KEY"),
     api_secret=os.getenv("CLOUDINARY_API_SECRET"),
 )
-client = MongoClient(MONGO_URI)
-db = client[DB_NAME]
-fs = gridfs.GridFS(db)
+# Max number of images uploaded at the same time for one plan
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "4"))
+# Attempts per image and the base delay of the exponential backoff between them
+UPLOAD_ATTEMPTS = int(os.getenv("UPLOAD_ATTEMPTS", "3"))
+UPLOAD_BACKOFF_SECONDS = float(os.getenv("UPLOAD_BACKOFF_SECONDS", "1.0"))
 
-def upload_images_and_get_urls(plan_doc):
+
+@dataclass
+class UploadResult:
+    """Outcome of uploading the images of one meal plan."""
+    urls: dict = field(default_factory=dict)
+    succeeded: list = field(default_factory=list)
+    failed: dict = field(default_factory=dict)
+
+    @property
+    def ok(self):
+        return not self.failed
+
+
+def cloudinary_uploader(file_obj, public_id):
+    """Uploads a file-like object to Cloudinary and returns its public URL."""
+    upload_result = cloudinary.uploader.upload(
+        file_obj,
+        public_id=public_id,
+        overwrite=True,
+        resource_type="image"
+    )
+    return upload_result["secure_url"]
+
+
+class LocalUploader:
     """
-    Uploads images from GridFS to Cloudinary for a given meal plan
-    and returns a dictionary of public URLs.
+    Stand-in for the Cloudinary uploader that writes files to a local directory.
+    `latency` (seconds) and `failure_rate` (0-1) simulate a slow or flaky service.
     """
-    updated_urls = plan_doc.get("image_urls", {})
-    file_ids = plan_doc.get("image_file_ids", {})
-    
-    # --- THIS IS THE FIX ---
+
+    def __init__(self, directory="local_uploads", latency=0.0, failure_rate=0.0):
+        self.directory = Path(directory)
+        self.latency = latency
+        self.failure_rate = failure_rate
+
+    def __call__(self, file_obj, public_id):
+        if self.latency:
+            time.sleep(self.latency)
+        if random.random() < self.failure_rate:
+            raise ConnectionError(f"Simulated upload failure for {public_id}")
+        path = self.directory / f"{public_id}.png"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "wb") as out:
+            while True:
+                chunk = file_obj.read(256 * 1024)
+                if not chunk:
+                    break
+                out.write(chunk)
+        return path.resolve().as_uri()
+
+
+def _upload_with_retry(uploader, oid, public_id, attempts, backoff):
+    for attempt in range(1, attempts + 1):
+        try:
+            # GridOut is file-like, so the image is streamed from GridFS instead of loaded first
+            return uploader(fs.get(oid), public_id)
+        except Exception:
+            if attempt == attempts:
+                raise
+            time.sleep(backoff * 2 ** (attempt - 1) * (1 + random.random() / 2))
+
+
+def upload_plan_images(plan_doc, max_workers=UPLOAD_WORKERS, uploader=None,
+                       attempts=UPLOAD_ATTEMPTS, backoff=UPLOAD_BACKOFF_SECONDS):
+    """
+    Uploads the GridFS images of a meal plan in parallel and returns an UploadResult.
+
+    Images that already have a URL are skipped. Each upload is retried with
+    exponential backoff; a dish that still fails is listed in `result.failed`
+    and never fails the others. `uploader(file_obj, public_id) -> url` defaults
+    to Cloudinary and can be replaced with a LocalUploader.
+    """
+    uploader = uploader or cloudinary_uploader
+    result = UploadResult(urls=dict(plan_doc.get("image_urls") or {}))
     # Use the user_id as a fallback if the database _id doesn't exist yet
     plan_id = plan_doc.get("_id") or plan_doc.get("user_id")
-    # --- END OF FIX ---
 
-    for dish_key, oid in file_ids.items():
-        if dish_key in updated_urls:
-            continue
-        try:
-            file_obj = fs.get(oid)
-            print(f"⬆️ Uploading {dish_key}...")
-            upload_result = cloudinary.uploader.upload(
-                file_obj,
-                public_id=f"meal_plans/{plan_id}/{dish_key}",
-                overwrite=True,
-                resource_type="image"
+    pending = {key: oid for key, oid in (plan_doc.get("image_file_ids") or {}).items() if key not in result.urls}
+    if not pending:
+        return result
+
+    workers = max(1, min(max_workers, len(pending)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(run_in_context(_upload_with_retry), uploader, oid, f"meal_plans/{plan_id}/{dish_key}", attempts, backoff): dish_key
+            for dish_key, oid in pending.items()
+        }
+        for future in as_completed(futures):
+            dish_key = futures[future]
+            try:
+                result.urls[dish_key] = future.result()
+                result.succeeded.append(dish_key)
+            except Exception as e:
+                result.failed[dish_key] = str(e)
+                print(f"❌ Failed to upload {dish_key}: {e}")
+
+    print(f"⬆️ Uploaded {len(result.succeeded)} image(s) for plan {plan_id}, {len(result.failed)} failed.")
+    return result
+
+
+def upload_images_and_get_urls(plan_doc, uploader=None):
+    """
+    Uploads images from GridFS to Cloudinary (or `uploader`) for a given meal plan
+    and returns a dictionary of public URLs.
+    """
+    return upload_plan_images(plan_doc, uploader=uploader).urls
+
+
+def upload_images(uploader=None):
+    """Uploads the missing images of every stored meal plan and saves their URLs."""
+    totals = {"plans": 0, "succeeded": 0, "failed": 0}
+    for plan_doc in meal_plan_collection.find(
+        {"image_file_ids": {"$exists": True}},
+        {"user_id": 1, "image_file_ids": 1, "image_urls": 1},
+    ):
+        result = upload_plan_images(plan_doc, uploader=uploader)
+        if result.succeeded or result.failed:
+            meal_plan_collection.update_one(
+                {"_id": plan_doc["_id"]},
+                {"$set": {"image_urls": result.urls, "image_upload_errors": result.failed}},
             )
-            updated_urls[dish_key] = upload_result["secure_url"]
-        except Exception as e:
-            print(f"❌ Failed to upload {dish_key}: {e}")
-    
-    return updated_urls
\ No newline at end of file
+        totals["plans"] += 1
+        totals["succeeded"] += len(result.succeeded)
+        totals["failed"] += len(result.failed)
+    print(f"☁️ Image upload finished: {totals}")
+    return totals
@@ -1,12 +1,20 @@
+import re
+import json
+import hashlib
 from bson import ObjectId
 from google import genai
-from PIL import Image
+from PIL import Image, features
 from io import BytesIO
 import os
 from dotenv import load_dotenv
+from instrumentation import instrumented, record_parse_failure
 load_dotenv()
 # Replace with your actual API key
 client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
+IMAGE_MODEL = "gemini-2.5-flash-image-preview"
+# Downscaled copies stored next to every dish image: {variant: longest side in pixels}
+IMAGE_VARIANTS = {"thumb": 320, "medium": 640}
+IMAGE_VARIANT_QUALITY = int(os.getenv("IMAGE_VARIANT_QUALITY", "80"))
 
 def clean_mongo_doc(doc):
     """Recursively convert MongoDB ObjectId to string for JSON serialization."""
@@ -20,14 +28,263 @@ def clean_mongo_doc(doc):
         return doc
 
 
+def hash_payload(payload):
+    """Returns a stable SHA-256 hash of a JSON-like payload (key order does not matter)."""
+    canonical = json.dumps(clean_mongo_doc(payload), sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def normalize_dish_name(dish_name):
+    """Normalizes a dish name so that spelling variants share cache entries."""
+    name = re.sub(r"[^\w\s&]", " ", str(dish_name).lower())
+    return re.sub(r"\s+", " ", name).strip()
+
+
+# -----------------------------
+# JSON extraction for agent output
+# -----------------------------
+_STRUCTURAL_CHARS = re.compile(r'[{}\[\]",:]')
+_STRING_SPECIAL_CHARS = re.compile(r'["\\]')
+
+
+class JSONExtractionError(ValueError):
+    """Raised when agent output does not contain a parseable JSON object."""
+
+    def __init__(self, reason, position=None, text=""):
+        self.reason = reason
+        self.position = position
+        message = reason
+        if position is not None:
+            message = f"{reason} at position {position}"
+            if text:
+                message += f" (near {text[max(0, position - 40):position + 40]!r})"
+        super().__init__(message)
+
+
+class _Frame:
+    __slots__ = ("kind", "start", "key", "pending_key", "index")
+
+    def __init__(self, kind, start, key):
+        self.kind = kind
+        self.start = start
+        self.key = key
+        self.pending_key = None
+        self.index = 0
+
+
+class JSONStreamExtractor:
+    """
+    Finds JSON objects in agent output in a single pass over the text.
+
+    Text can be fed in chunks as it is streamed. Anything outside a top-level
+    object (prose, markdown fences) is skipped, braces inside strings are
+    ignored, and scanning stops at the end of each object, so trailing text is
+    never parsed. `feed()` returns the top-level objects completed by the chunk.
+
+    With `on_object` and `event_depth`, nested objects and arrays are reported as
+    soon as they close: `on_object(path, value)` is called with the key path from
+    the root, e.g. ("Day 1", "Breakfast"), for values up to `event_depth` levels deep.
+    """
+
+    def __init__(self, on_object=None, event_depth=0, limit=None):
+        self.on_object = on_object
+        self.event_depth = event_depth
+        self.limit = limit
+        self.values = []
+        self.errors = []
+        self._buffer = ""
+        self._offset = 0
+        self._pos = 0
+        self._reset()
+
+    def _reset(self):
+        self._stack = []
+        self._failed = False
+        self._in_string = False
+        self._string_start = None
+        self._last_string = None
+
+    def _drop(self, count):
+        # Only called between top-level objects, so no open frame points into the buffer
+        self._buffer = self._buffer[count:]
+        self._offset += count
+        self._pos -= count
+
+    def _fail(self, reason, position):
+        # The rest of the failed candidate is still scanned to find where it ends, and
+        # none of its nested objects is reported: only a brace at depth 0 starts a new one
+        if not self._failed:
+            self.errors.append(JSONExtractionError(reason, self._offset + position, self._buffer))
+        self._failed = True
+
+    @property
+    def done(self):
+        return self.limit is not None and len(self.values) >= self.limit
+
+    def feed(self, chunk):
+        """Adds a chunk of text and returns the top-level objects it completed."""
+        self._buffer += chunk
+        completed = []
+        while not self.done and self._pos < len(self._buffer):
+            buf = self._buffer
+            if self._in_string:
+                match = _STRING_SPECIAL_CHARS.search(buf, self._pos)
+                if not match:
+                    self._pos = len(buf)
+                elif match.group() == "\\":
+                    if match.end() >= len(buf):
+                        # The escaped character is in the next chunk
+                        self._pos = match.start()
+                        break
+                    self._pos = match.end() + 1
+                else:
+                    self._in_string = False
+                    self._last_string = (self._string_start, match.end())
+                    self._pos = match.end()
+                continue
+
+            if not self._stack:
+                start = buf.find("{", self._pos)
+                if start == -1:
+                    self._drop(len(buf))
+                    break
+                self._drop(start)
+                self._stack.append(_Frame("{", 0, None))
+                self._pos = 1
+                continue
+
+            match = _STRUCTURAL_CHARS.search(buf, self._pos)
+            if not match:
+                self._pos = len(buf)
+                continue
+            char, index = match.group(), match.start()
+            self._pos = match.end()
+            frame = self._stack[-1]
+
+            if char == '"':
+                self._in_string = True
+                self._string_start = index
+            elif char == ":":
+                if frame.kind == "{" and self._last_string:
+                    try:
+                        frame.pending_key = json.loads(buf[self._last_string[0]:self._last_string[1]])
+                    except json.JSONDecodeError:
+                        frame.pending_key = None
+            elif char == ",":
+                frame.pending_key = None
+                frame.index += 1
+                self._last_string = None
+            elif char in "{[":
+                key = frame.pending_key if frame.kind == "{" else frame.index
+                self._stack.append(_Frame(char, index, key))
+                self._last_string = None
+            else:
+                if char != ("}" if frame.kind == "{" else "]"):
+                    # Treated as closing the open frame so the candidate's end can still be found
+                    self._fail(f"Unexpected '{char}'", index)
+                self._stack.pop()
+                self._last_string = None
+                if not self._stack:
+                    value = None
+                    if not self._failed:
+                        try:
+                            value = json.loads(buf[frame.start:index + 1])
+                        except json.JSONDecodeError as e:
+                            self._fail(e.msg, frame.start + e.pos)
+                    if self._failed:
+                        self._drop(index + 1)
+                        self._reset()
+                        continue
+                    self.values.append(value)
+                    completed.append(value)
+                    self._drop(index + 1)
+                elif self.on_object and not self._failed and len(self._stack) <= self.event_depth:
+                    try:
+                        value = json.loads(buf[frame.start:index + 1])
+                    except json.JSONDecodeError:
+                        continue
+                    path = tuple(f.key for f in self._stack[1:]) + (frame.key,)
+                    self.on_object(path, value)
+        return completed
+
+    def finish(self):
+        """Ends the stream; records an error if an object was left unterminated."""
+        if self._stack and not self.done and not self._failed:
+            self.errors.append(JSONExtractionError(
+                "Unterminated JSON object", self._offset + self._stack[0].start, self._buffer
+            ))
+        return self.values
+
+
+def extract_json(text):
+    """
+    Returns the first JSON object in agent output.
+
+    Handles markdown fences and text before or after the object. Raises
+    JSONExtractionError with the position where parsing failed otherwise.
+    """
+    if not text:
+        record_parse_failure()
+        raise JSONExtractionError("Agent returned empty response")
+    extractor = JSONStreamExtractor(limit=1)
+    extractor.feed(text)
+    values = extractor.finish()
+    if values:
+        return values[0]
+    record_parse_failure()
+    if extractor.errors:
+        raise extractor.errors[-1]
+    raise JSONExtractionError("No JSON object found in agent output")
+
+
+def parse_json_stream(chunks, on_object=None, event_depth=0):
+    """
+    Consumes streamed agent output and returns the first complete JSON object.
+
+    `on_object(path, value)` is called for nested values as soon as they close
+    (see JSONStreamExtractor), so callers can render partial results.
+    """
+    extractor = JSONStreamExtractor(on_object=on_object, event_depth=event_depth, limit=1)
+    for chunk in chunks:
+        if extractor.feed(chunk):
+            break
+    values = extractor.finish()
+    if values:
+        return values[0]
+    record_parse_failure()
+    if extractor.errors:
+        raise extractor.errors[-1]
+    raise JSONExtractionError("No JSON object found in agent output")
+
+
+@instrumented("dish_image")
 def generate_dish_image_bytes(dish_name):
     """Generates an image for a given dish name using Google GenAI."""
     prompt = f"Create a picture of {dish_name}"
     response = client.models.generate_content(
-    model="gemini-2.5-flash-image-preview",
+    model=IMAGE_MODEL,
     contents=[prompt],
     )
     for part in response.candidates[0].content.parts:
         if part.inline_data is not None:
             return part.inline_data.data  # raw bytes
-    return None
\ No newline at end of file
+    return None
+
+
+def make_image_variants(image_bytes, sizes=IMAGE_VARIANTS, quality=IMAGE_VARIANT_QUALITY):
+    """
+    Returns {variant: (bytes, content_type)} with a downscaled, compressed copy of
+    an image for each entry of `sizes`. Uses WebP, or JPEG when Pillow was built
+    without WebP support. Images smaller than a variant are not upscaled.
+    """
+    image_format = "WEBP" if features.check("webp") else "JPEG"
+    variants = {}
+    with Image.open(BytesIO(image_bytes)) as image:
+        image = image.convert("RGB")
+        for variant, max_side in sizes.items():
+            resized = image.copy()
+            resized.thumbnail((max_side, max_side), Image.LANCZOS)
+            buffer = BytesIO()
+            resized.save(buffer, format=image_format, quality=quality, optimize=True)
+            variants[variant] = (buffer.getvalue(), f"image/{image_format.lower()}")
+    return variants
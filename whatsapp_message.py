@@ -1,26 +1,56 @@
 import os
+import re
+import json
 import schedule
 import time
-from datetime import datetime
-from pymongo import MongoClient
-from twilio.rest import Client
-from agents import whatsapp_agent
+from datetime import datetime, date, timezone
+from agents import whatsapp_agent, teaser_batch_agent
+from database import user_collection, meal_plan_collection, notification_runs_collection, notification_deliveries_collection
+from dish_images import image_key, iter_plan_dishes
+from messaging import get_transport, send_with_retry, fan_out
+from nutrition import MEAL_SLOT_SPLITS
+from utils import extract_json, normalize_dish_name
 from dotenv import load_dotenv
 
 load_dotenv()
 
 # --- CONFIG ---
-MONGO_URI = os.getenv("MONGO_URI")
-DB_NAME = os.getenv("MONGO_DB", "UserDBB")
-TWILIO_SID = os.getenv("TWILIO_SID")
-TWILIO_AUTH = os.getenv("TWILIO_AUTH_TOKEN")
-TWILIO_WHATSAPP = os.getenv("TWILIO_WHATSAPP_NUMBER")
-
-# --- DB CONNECTION ---
-client = MongoClient(MONGO_URI)
-db = client[DB_NAME]
-user_collection = db["UserCo"]
-meal_plan_collection = db["Weekly_Meal_Plans"]
+# Messages sent at the same time, and the max number of messages started per second
+NOTIFY_WORKERS = int(os.getenv("NOTIFY_WORKERS", "8"))
+NOTIFY_RATE_PER_SECOND = float(os.getenv("NOTIFY_RATE_PER_SECOND", "10"))
+# Failures kept on a Notification_Runs document
+MAX_RECORDED_FAILURES = 100
+
+# slot -> send time and the plan meal keys (lowercase) that belong to it; see _slot_meal_keys
+MEAL_SLOTS = {
+    "breakfast": {"time": "07:00", "meal_keys": ["meal 1"]},
+    "lunch": {"time": "12:00", "meal_keys": ["meal 2"]},
+    "dinner": {"time": "20:00", "meal_keys": ["meal 3"]},
+}
+
+
+def _slot_meal_keys():
+    """
+    Adds the main (non-snack) meals of every nutrition.MEAL_SLOT_SPLITS layout to
+    MEAL_SLOTS. A meal named after a slot is sent with it; any other one
+    ("main meal", "brunch") is sent with the slot at its position among the
+    day's main meals, spread over the slots in time order.
+    """
+    slots = list(MEAL_SLOTS)
+    for splits in MEAL_SLOT_SPLITS.values():
+        meals = [meal for meal, _ in splits if not meal.startswith("snack")]
+        for i, meal in enumerate(meals):
+            if meal in MEAL_SLOTS:
+                slot = meal
+            elif len(meals) == 1:
+                slot = slots[len(slots) // 2]
+            else:
+                slot = slots[round(i * (len(slots) - 1) / (len(meals) - 1))]
+            if meal not in MEAL_SLOTS[slot]["meal_keys"]:
+                MEAL_SLOTS[slot]["meal_keys"].append(meal)
+
+
+_slot_meal_keys()
 
 # --- HELPER FUNCTIONS (can be imported) ---
 def generate_tempting_message(user_name, meal_name, dish):
@@ -28,43 +58,258 @@ def generate_tempting_message(user_name, meal_name, dish):
     response = whatsapp_agent.run(prompt)
     return response.content if hasattr(response, "content") else str(response)
 
-def send_whatsapp_message(user, meal_name, dish, image_url):
-    client_twilio = Client(TWILIO_SID, TWILIO_AUTH)
-    user_name = user.get("name", "Friend")
-    user_phone = user.get("phone")
-    if not user_phone: return
 
-    if not user_phone.startswith("+91"):
-        user_phone = f"+91{user_phone.lstrip('0')}"
+def teaser_key(day, meal_key):
+    """Returns the key of a meal in a plan's `teasers`."""
+    return f"{day}|{meal_key}"
+
+
+def generate_plan_teasers(user_name, meal_plan):
+    """
+    Writes the notification teaser of every meal of a plan with one
+    teaser_batch_agent request. Returns {teaser_key: {"dish", "text"}}; meals
+    missing from the response are left out and fall back to a live call at
+    send time.
+    """
+    meals = {
+        teaser_key(day, meal_key): {"meal": meal_key.title(), "dish": dish}
+        for day, meal_key, dish in iter_plan_dishes(meal_plan)
+    }
+    if not meals:
+        return {}
+    response = teaser_batch_agent.run(json.dumps({"user_name": user_name, "meals": meals}, ensure_ascii=False))
+    texts = extract_json(response.content)
+    return {
+        key: {"dish": meal["dish"], "text": texts[key].strip()}
+        for key, meal in meals.items()
+        if isinstance(texts.get(key), str) and texts[key].strip()
+    }
+
+
+def store_plan_teasers(user, plan_doc):
+    """Generates and saves the teasers of a saved meal plan; returns how many were stored."""
+    teasers = generate_plan_teasers(user.get("name", "Friend"), plan_doc.get("meal_plan") or {})
+    meal_plan_collection.update_one({"_id": plan_doc["_id"]}, {"$set": {"teasers": teasers}})
+    return len(teasers)
+
 
-    tempting_text = generate_tempting_message(user_name, meal_name, dish)
+def stored_teaser(teasers, day, meal_key, dish):
+    """Returns the pre-generated teaser of a meal, or None when missing or written for another dish."""
+    teaser = (teasers or {}).get(teaser_key(day, meal_key))
+    if teaser and normalize_dish_name(teaser.get("dish", "")) == normalize_dish_name(dish):
+        return teaser.get("text")
+    return None
+
+
+def _whatsapp_number(phone):
+    if not phone.startswith("+91"):
+        phone = f"+91{phone.lstrip('0')}"
+    return phone
+
+
+def deliver_whatsapp_message(user, meal_name, dish, image_url, teaser=None):
+    """
+    Sends one meal notification; raises on failure. Returns the Twilio message SID.
+    The teaser text is only generated live when no pre-generated `teaser` is given.
+    """
+    user_name = user.get("name", "Friend")
+    user_phone = _whatsapp_number(user["phone"])
+    tempting_text = teaser or generate_tempting_message(user_name, meal_name, dish)
 
     body = f"Hey {user_name}! 👋\n\nYour *{meal_name}* is ready: *{dish}*.\n\n_{tempting_text}_"
+    return send_with_retry(get_transport(), f"whatsapp:{user_phone}", body, image_url)
+
+
+def send_whatsapp_message(user, meal_name, dish, image_url, teaser=None):
+    user_name = user.get("name", "Friend")
+    user_phone = user.get("phone")
+    if not user_phone: return
 
     try:
-        msg = client_twilio.messages.create(
-            from_=TWILIO_WHATSAPP,
-            body=body,
-            to=f"whatsapp:{user_phone}",
-            media_url=[image_url] if image_url else None
-        )
+        deliver_whatsapp_message(user, meal_name, dish, image_url, teaser)
         print(f"✅ Sent {meal_name} to {user_name} ({user_phone})")
         return f"Message for {meal_name} sent successfully to {user_name}!"
     except Exception as e:
         print(f"❌ Failed to send to {user_phone}: {e}")
         return f"Failed to send message for {meal_name}. Error: {e}"
 
+
+# --- SCHEDULED FAN-OUT ---
+def _notification_targets():
+    """
+    Streams every meal plan joined with its user, in one aggregation. Only the
+    dish name of each meal is projected, so recipes are never transferred.
+    """
+    pipeline = [
+        {"$match": {"meal_plan": {"$type": "object"}}},
+        {"$lookup": {
+            "from": user_collection.name,
+            "let": {"uid": "$user_id"},
+            "pipeline": [
+                {"$match": {"$expr": {"$eq": ["$_id", "$$uid"]}}},
+                {"$project": {"name": 1, "phone": 1}},
+            ],
+            "as": "user",
+        }},
+        {"$unwind": "$user"},
+        {"$match": {"user.phone": {"$nin": [None, ""]}}},
+        {"$project": {
+            "user": 1,
+            "image_urls": 1,
+            "teasers": 1,
+            "generated_at": 1,
+            "days": {"$map": {
+                "input": {"$objectToArray": "$meal_plan"},
+                "as": "day",
+                "in": {
+                    "day": "$$day.k",
+                    "meals": {"$cond": [
+                        {"$eq": [{"$type": "$$day.v"}, "object"]},
+                        {"$map": {
+                            "input": {"$filter": {
+                                "input": {"$objectToArray": "$$day.v"},
+                                "as": "meal",
+                                "cond": {"$eq": [{"$type": "$$meal.v"}, "object"]},
+                            }},
+                            "as": "meal",
+                            "in": {"meal": "$$meal.k", "dish": "$$meal.v.dish_name"},
+                        }},
+                        [],
+                    ]},
+                },
+            }},
+        }},
+    ]
+    return meal_plan_collection.aggregate(pipeline, batchSize=500)
+
+
+def _day_number(day_key):
+    digits = re.findall(r"\d+", day_key)
+    return int(digits[0]) if digits else 0
+
+
+def _local_date(moment):
+    """Returns the date of a stored datetime in the host's time zone; naive values are UTC, as pymongo returns them."""
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.astimezone().date()
+
+
+def pick_slot_meal(target, slot, today=None):
+    """
+    Returns (day, meal_name, dish) of `slot` for a plan from _notification_targets,
+    or None. Plans repeat: day N of the plan is sent N-1 days after it was
+    generated. `today` is a host-local date, like the scheduled send times.
+    """
+    days = sorted((d for d in target.get("days", []) if d["meals"] and d["day"].lower() != "summary"), key=lambda d: _day_number(d["day"]))
+    if not days:
+        return None
+    today = today or date.today()
+    generated_at = target.get("generated_at")
+    offset = (today - _local_date(generated_at)).days if generated_at else 0
+    day = days[offset % len(days)]
+    meal_keys = MEAL_SLOTS[slot]["meal_keys"]
+    for meal in day["meals"]:
+        if meal["meal"].lower() in meal_keys and meal.get("dish"):
+            return day["day"], meal["meal"], meal["dish"]
+    return None
+
+
+def _current_slot(now=None):
+    """Returns the slot whose send time was most recently passed."""
+    now = (now or datetime.now()).strftime("%H:%M")
+    passed = [slot for slot, config in MEAL_SLOTS.items() if config["time"] <= now]
+    return passed[-1] if passed else list(MEAL_SLOTS)[-1]
+
+
+def send_meal_notifications(slot=None, workers=NOTIFY_WORKERS, rate_per_second=NOTIFY_RATE_PER_SECOND, force=False):
+    """
+    Sends the `slot` meal ("breakfast", "lunch", "dinner"; default: the slot
+    whose time last passed) of today's plan day to every user.
+
+    Users are streamed with their plans in one aggregation and messages are sent
+    by a bounded worker pool, at most `rate_per_second` per second. Each run is
+    recorded in Notification_Runs with its throughput and failures; a slot that
+    already completed today is not sent again unless `force` is set. Every sent
+    user is checkpointed in Notification_Deliveries, so a run resumed after a
+    crash skips them (`force` starts over). Returns the run document.
+    """
+    slot = slot or _current_slot()
+    today = date.today()
+    run_id = f"{slot}-{today.isoformat()}"
+    if not force and notification_runs_collection.find_one({"_id": run_id, "status": "done"}, {"_id": 1}):
+        print(f"⏭️ Notifications '{run_id}' were already sent.")
+        return None
+
+    started_at = datetime.utcnow()
+    notification_runs_collection.update_one(
+        {"_id": run_id},
+        {"$set": {"slot": slot, "status": "running", "started_at": started_at}},
+        upsert=True,
+    )
+
+    if force:
+        notification_deliveries_collection.delete_many({"run_id": run_id})
+    delivered = {doc["user_id"] for doc in notification_deliveries_collection.find({"run_id": run_id}, {"user_id": 1})}
+    skipped = 0
+
+    def messages():
+        nonlocal skipped
+        for target in _notification_targets():
+            if target["user"]["_id"] in delivered:
+                continue
+            choice = pick_slot_meal(target, slot, today)
+            if choice:
+                yield target, choice
+            else:
+                skipped += 1
+
+    def send(message):
+        target, (day, meal_name, dish) = message
+        deliver_whatsapp_message(
+            target["user"],
+            meal_name.title(),
+            dish,
+            (target.get("image_urls") or {}).get(image_key(day, dish)),
+            stored_teaser(target.get("teasers"), day, meal_name, dish),
+        )
+        notification_deliveries_collection.update_one(
+            {"run_id": run_id, "user_id": target["user"]["_id"]},
+            {"$setOnInsert": {"sent_at": datetime.utcnow()}},
+            upsert=True,
+        )
+
+    result = fan_out(messages(), send, workers, rate_per_second, max_failures=MAX_RECORDED_FAILURES)
+    counts = {"sent": result["sent"], "failed": result["failed"], "skipped": skipped, "already_sent": len(delivered)}
+    failures = [{"user_id": target["user"]["_id"], "error": error} for (target, _), error in result["failures"]]
+
+    duration = (datetime.utcnow() - started_at).total_seconds()
+    run = {
+        "slot": slot,
+        "status": "done",
+        "started_at": started_at,
+        "finished_at": datetime.utcnow(),
+        "duration_seconds": round(duration, 2),
+        "messages_per_second": round(counts["sent"] / duration, 2) if duration else 0.0,
+        **counts,
+        "failures": failures,
+    }
+    notification_runs_collection.update_one({"_id": run_id}, {"$set": run})
+    print(f"📨 Notifications '{run_id}': {counts} in {duration:.1f}s")
+    return {"_id": run_id, **run}
+
+
+def schedule_meal_notifications():
+    """Registers one daily send per meal slot with `schedule`."""
+    for slot, config in MEAL_SLOTS.items():
+        schedule.every().day.at(config["time"]).do(send_meal_notifications, slot)
+
+
 # --- MAIN SCHEDULER (only runs if script is executed directly) ---
 if __name__ == "__main__":
-    def scheduled_job():
-        # This function can be expanded with logic to determine the current day/meal
-        print("Running scheduled job... (Logic to send notifications would go here)")
-
-    schedule.every().day.at("07:00").do(scheduled_job)
-    schedule.every().day.at("12:00").do(scheduled_job)
-    schedule.every().day.at("20:00").do(scheduled_job)
+    schedule_meal_notifications()
 
     print("✅ WhatsApp notification scheduler started...")
     while True:
         schedule.run_pending()
-        time.sleep(60)
\ No newline at end of file
+        time.sleep(60)